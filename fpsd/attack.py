@@ -1,9 +1,14 @@
 #!/usr/bin/env python3.5
 import argparse
 import datetime
+import hashlib
 from itertools import product
+import numpy as np
+import os
+import pandas as pd
 import pdb
 import pickle
+import socket
 import yaml
 
 import classify, database
@@ -20,16 +25,91 @@ def run(options):
     with open(options, 'r') as f:
         options = yaml.load(f)
 
+    pool = get_experiment_pool(options)
+    search = options.get("search", {"strategy": "grid"})
+    if search["strategy"] == "grid":
+        pool.run(generate_experiments(options))
+    elif search["strategy"] == "successive_halving":
+        pool.successive_halving(generate_experiments(options),
+                                min_folds=search.get("min_folds", 1),
+                                eta=search.get("eta", 3))
+    else:
+        raise ValueError("Unsupported search strategy "
+                         "{}".format(search["strategy"]))
+
+
+def get_experiment_pool(options):
+    """Loads the dataset and sets up an ExperimentPool to run experiments
+    on it."""
+
     db = database.DatasetLoader()
+    world_type = options["world"]["type"]
+    dtype = np.dtype(options.get("feature_dtype", "float32"))
+
+    dataset_version = None
+    if options.get("dataset_cache", True):
+        dataset_cache = classify.DatasetCache(options.get("dataset_cache_dir"))
+        dataset_version = dataset_cache.version(db, world_type, dtype)
+        x, y, exampleids, feature_names, groups = dataset_cache.load(
+            db, world_type, dtype, dataset_version)
+    else:
+        x, y, exampleids, feature_names, groups = db.load_arrays(
+            world_type, dtype=dtype)
+    x = classify.impute_array(x)
+    if groups is not None:
+        # Open world folds are split by site (see classify.make_folds)
+        groups = pd.factorize(groups)[0]
+
+    return classify.ExperimentPool(x, y,
+                                   cpu_budget=options.get("cpu_budget"),
+                                   n_workers=options.get("experiment_workers"),
+                                   fold_cache_dir=options.get("fold_cache_dir"),
+                                   exampleids=exampleids,
+                                   predictions_dir=options.get(
+                                       "predictions_dir"),
+                                   groups=groups,
+                                   dataset_version=dataset_version)
+
+
+def get_sweep(config):
+    """Name the sweep of an attack file after its contents, so that every
+    host with the same attack file works on the same sweep."""
+
+    with open(config, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def enqueue(config, sweep):
+    """Takes an attack file and adds all its experiments to the
+    experiment queue in the database."""
+
+    with open(config, 'r') as f:
+        options = yaml.load(f)
 
-    df = db.load_world(options["world"]["type"])
+    experiment_queue = database.ExperimentQueue()
+    jobs = [experiment.to_job() for experiment
+            in generate_experiments(options)]
+    added = experiment_queue.enqueue(sweep, jobs)
+    print("Added {} of {} experiments to sweep {}".format(added, len(jobs),
+                                                          sweep))
 
-    df = classify.imputation(df)
-    x = df.drop(['exampleid', 'is_sd'], axis=1).values
-    y = df['is_sd'].astype(int).values
 
-    for experiment in generate_experiments(options):
-        experiment.train_eval_all_folds(x, y)
+def work(config, sweep):
+    """Loads the dataset once, then runs experiments from the experiment
+    queue until none are left."""
+
+    with open(config, 'r') as f:
+        options = yaml.load(f)
+
+    experiment_queue = database.ExperimentQueue(
+        lease_timeout=options.get("lease_timeout", 600))
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    pool = get_experiment_pool(options)
+    n_finished = pool.run_queue(experiment_queue, sweep, worker,
+                                heartbeat_interval=options.get(
+                                    "heartbeat_interval", 60))
+    print("Worker {} finished {} experiments; sweep {} is "
+          "drained".format(worker, n_finished, sweep))
 
 
 def generate_experiments(options):
@@ -65,7 +145,12 @@ def generate_experiments(options):
                                 world=options["world"],
                                 model_type=model,
                                 hyperparameters=parameters,
-                                feature_scaling=options["feature_scaling"]))
+                                feature_scaling=options["feature_scaling"],
+                                k=options["num_kfolds"],
+                                seed=options.get("fold_seed", 0),
+                                calibrated_scores=options.get(
+                                    "calibrated_scores", False),
+                                base_rates=options.get("base_rates")))
     return all_experiments
 
 
@@ -74,6 +159,21 @@ if __name__=='__main__':
     parser.add_argument("-c", "--config", dest="config", type=str,
                         default="attack.yaml",
                         help="point to attack config/setup file")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="add the experiments to the experiment queue "
+                        "in the database instead of running them")
+    parser.add_argument("--worker", action="store_true",
+                        help="run experiments from the experiment queue "
+                        "until it is drained")
+    parser.add_argument("--sweep", dest="sweep", type=str,
+                        help="name of the sweep in the experiment queue "
+                        "(default: derived from the attack file contents)")
     args = parser.parse_args()
 
-    run(args.config)
+    sweep = args.sweep or get_sweep(args.config)
+    if args.enqueue:
+        enqueue(args.config, sweep)
+    if args.worker:
+        work(args.config, sweep)
+    if not (args.enqueue or args.worker):
+        run(args.config)
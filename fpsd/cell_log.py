@@ -0,0 +1,201 @@
+#!/usr/bin/env python3.5
+#
+# Keeps track of our position in the Tor cell log written by our patched tor
+# (see roles/crawler/files/relay.c.patch), keeps it from growing without
+# bound, and parses the cells in it.
+#
+# The patched tor re-opens the cell log in append mode for every cell it logs,
+# so the log can safely be renamed out from under it: the next cell is simply
+# written to a freshly created file. We use this to rotate the log into a ring
+# of segment files once the traces it contains have been ingested.
+
+from collections import OrderedDict
+from io import SEEK_END, SEEK_SET
+import logging
+import os
+
+
+class CellLog:
+    """Reads the Tor cell log across rotations.
+
+    Positions in the log are ``(generation, offset)`` tuples, where the
+    generation is incremented every time the file at ``path`` is replaced
+    (whether by us or by an external tool like logrotate) and offset is a byte
+    offset into that generation's file. Positions compare in log order, so a
+    range of the log may span any number of rotations.
+
+    :param str path: The path of the cell log tor writes to.
+    :param int max_bytes: Rotate the log once it has grown to this many bytes
+                          and everything in it has been ingested. 0 disables
+                          rotation.
+    :param int backup_count: The number of rotated segment files
+                             (``path.1`` through ``path.<backup_count>``) to
+                             keep. If 0, the log is truncated instead.
+    """
+    def __init__(self, path, max_bytes=100*1024**2, backup_count=5,
+                 logger=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+        self.generation = 0
+        # Open file objects for every generation that may still be read from
+        self.segments = OrderedDict()
+        self.segments[self.generation] = self._open_live_log()
+
+
+    def _open_live_log(self):
+        # Create the log if tor has not (re-)created it yet. We launch tor as
+        # the same user, so it can append to a file we create.
+        with open(self.path, "ab"):
+            pass
+        fh = open(self.path, "rb")
+        self.live_log_size = os.fstat(fh.fileno()).st_size
+        return fh
+
+
+    @property
+    def live_log(self):
+        return self.segments[self.generation]
+
+
+    def follow(self):
+        """Start a new generation if the file at self.path has been replaced
+        or truncated since we last looked at it."""
+        try:
+            path_stat = os.stat(self.path)
+        except FileNotFoundError:
+            path_stat = None
+        live_stat = os.fstat(self.live_log.fileno())
+
+        if (path_stat and path_stat.st_ino == live_stat.st_ino
+                and path_stat.st_dev == live_stat.st_dev):
+            if path_stat.st_size >= self.live_log_size:
+                self.live_log_size = path_stat.st_size
+                return
+            self.logger.warning("The cell log {self.path} was truncated in "
+                                "place; cells logged since the last position "
+                                "was taken are lost.".format(**locals()))
+            self.live_log.close()
+
+        self.generation += 1
+        self.segments[self.generation] = self._open_live_log()
+
+
+    def tell(self):
+        """Return the position of the end of the cell log."""
+        self.follow()
+        return self.generation, self.live_log.seek(0, SEEK_END)
+
+
+    def read(self, start, end):
+        """Return the bytes logged between positions start and end."""
+        return b"".join(self.iter_read(start, end))
+
+
+    def iter_read(self, start, end, chunk_size=1024**2):
+        """Yield the bytes logged between positions start and end in chunks
+        of at most chunk_size bytes."""
+        for generation in range(start[0], end[0] + 1):
+            try:
+                fh = self.segments[generation]
+            except KeyError:
+                raise ValueError("Generation {generation} of the cell log has "
+                                 "already been released.".format(**locals()))
+            if fh.closed:
+                # Truncated in place, so there is nothing left to read
+                continue
+            lower = start[1] if generation == start[0] else 0
+            upper = end[1] if generation == end[0] else fh.seek(0, SEEK_END)
+            fh.seek(lower, SEEK_SET)
+            while lower < upper:
+                chunk = fh.read(min(chunk_size, upper - lower))
+                if not chunk:
+                    break
+                lower += len(chunk)
+                yield chunk
+
+
+    def release(self, position):
+        """Declare that nothing logged before position will be read again.
+        Closes segments of older generations and rotates the live log if it
+        has outgrown max_bytes."""
+        for generation in list(self.segments):
+            if generation < position[0]:
+                self.segments.pop(generation).close()
+
+        if (self.max_bytes and position[0] == self.generation
+                and position[1] >= self.max_bytes):
+            self.rotate()
+
+
+    def rotate(self):
+        """Move the live log into the ring of segment files, dropping the
+        oldest segment, and start a new generation."""
+        self.logger.info("Rotating the cell log {self.path}...".format(
+            **locals()))
+        try:
+            if self.backup_count > 0:
+                for i in range(self.backup_count - 1, 0, -1):
+                    segment = "{}.{}".format(self.path, i)
+                    if os.path.exists(segment):
+                        os.replace(segment, "{}.{}".format(self.path, i + 1))
+                os.replace(self.path, "{}.1".format(self.path))
+            else:
+                os.remove(self.path)
+        except OSError as exc:
+            self.logger.warning("Unable to rotate the cell log {self.path}: "
+                                "{exc}".format(**locals()))
+            return
+        self.follow()
+
+
+    def close(self):
+        for fh in self.segments.values():
+            fh.close()
+
+
+def parse_cells(chunks):
+    """Incrementally parse cell log entries from an iterable of byte chunks
+    (e.g., from CellLog.iter_read), yielding one dict per cell with the
+    columns of the raw.frontpage_traces table (minus exampleid). Entries may
+    be split across chunks. Each entry has the form:
+
+    1472598678.735375 INCOMING CIRC 3725647749, STREAM 0, COMMAND DATA(2), length 498
+
+    >>> cells = list(parse_cells([b"1.5 OUTGOING CIRC 7, STREAM 1, COMM",
+    ...                           b"AND DATA(2), length 498\\n\\n"]))
+    >>> len(cells)
+    1
+    >>> cells[0]['command'], cells[0]['length'], cells[0]['ingoing']
+    ('DATA(2)', 498, False)
+    """
+    remainder = b""
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b"\n")
+        # The last line is incomplete unless the chunk ended in a newline
+        remainder = lines.pop()
+        for line in lines:
+            cell = _parse_cell(line)
+            if cell:
+                yield cell
+    cell = _parse_cell(remainder)
+    if cell:
+        yield cell
+
+
+def _parse_cell(line):
+    fields = line.replace(b",", b" ").split()
+    # Skip blank lines and entries tor was still writing when the trace ended
+    if len(fields) != 10:
+        return None
+    try:
+        return {'t_trace': float(fields[0]),
+                'ingoing': fields[1] == b"INCOMING",
+                'circuit': int(fields[3]),
+                'stream': int(fields[5]),
+                'command': fields[7].decode(),
+                'length': int(fields[9])}
+    except ValueError:
+        return None
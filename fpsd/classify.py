@@ -1,14 +1,37 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 import datetime
+import hashlib
 import matplotlib.pyplot as plt
 import numpy as np
 import multiprocessing
+import os
 import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import traceback
+from os.path import abspath, dirname, join
 from sklearn import (cross_validation, ensemble, metrics, svm, tree,
                      linear_model, neighbors, naive_bayes,
                      preprocessing)
 
 
-import evaluation, database
+import evaluation, database, knn
+
+
+# Model types whose estimators can add to their ensemble with warm_start
+WARM_START_MODELS = ('RandomForest', 'ExtraTrees', 'GradientBoostingClassifier')
+# Model types whose decision_function ranks examples the same way as
+# predict_proba. AdaBoost models only do with algorithm SAMME.R: with SAMME,
+# decision_function is a weighted vote of hard predictions.
+DECISION_FUNCTION_MODELS = ('SVM', 'LogisticRegression', 'SGDClassifier',
+                            'GradientBoostingClassifier')
+SAMME_R_MODELS = ('AdaBoost', 'RandomForestBoosting')
+
+_dir = dirname(abspath(__file__))
+_predictions_dir = join(_dir, "logging", "predictions")
 
 
 def imputation(df):
@@ -25,10 +48,19 @@ def imputation(df):
     return df.fillna(0)
 
 
+def impute_array(x):
+    """imputation for feature matrices (see DatasetLoader.load_arrays):
+    fills NaNs to 0 in place, without copying x."""
+
+    x[np.isnan(x)] = 0
+    return x
+
+
 class Experiment:
     def __init__(self, model_timestamp, world, model_type, 
                  hyperparameters, feature_scaling=True,
-                 n_cores=multiprocessing.cpu_count(), k=10):
+                 n_cores=multiprocessing.cpu_count(), k=10, seed=0,
+                 calibrated_scores=False, base_rates=None):
         """
         Args:
             model [string]: machine learning algorithm to be used
@@ -37,6 +69,14 @@ class Experiment:
             k [int]: number of k-folds
             world [dict]: world type (open- or closed- world)
                           and parameters if necessary
+            seed [int]: seed of the random fold split, so that experiments
+                        with the same seed are evaluated on the same folds
+            calibrated_scores [bool]: score test sets with calibrated
+                                      probabilities rather than whatever
+                                      ranks them fastest (see score)
+            base_rates [list]: also evaluate each fold as if the positive
+                               class made up these fractions of the test set
+                               (see evaluation.get_base_rate_metrics)
         """
 
         self.model_timestamp = model_timestamp
@@ -46,11 +86,31 @@ class Experiment:
         self.frac_obs = world["observed_fraction"]
         self.n_cores = n_cores
         self.k = k
+        self.seed = seed
+        self.calibrated_scores = calibrated_scores
+        self.base_rates = list(base_rates or [])
         self.feature_scaling = feature_scaling
-        self.db = database.ModelStorage()
+        # Set to a FoldCache to use its pre-computed folds
+        self.fold_cache = None
+        # Set to a PredictionStore to keep the test set scores of every fold
+        self.prediction_store = None
+        # Connect to the database only once results are saved, so that
+        # experiments can be sent to worker processes (see ExperimentPool)
+        self._db = None
         self.train_class_balance = 'DEFAULT'
         self.base_rate = 'DEFAULT'
 
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = database.ModelStorage()
+        return self._db
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
+
     def train_single_fold(self, x_train, y_train):
         """Trains a model and saves it as self.trained_model
 
@@ -71,6 +131,14 @@ class Experiment:
     def score(self, x_test, trained_model):
         """Generates continuous risk scores for a testing set.
 
+        All our metrics depend only on how the scores rank the test set, so
+        unless calibrated_scores is set, models whose decision_function ranks
+        the test set the same way as predict_proba (see
+        DECISION_FUNCTION_MODELS) are scored with it. This skips the
+        probability estimation (and, for SVMs, the costly cross-validated
+        calibration that comes with it). Other models are scored with
+        predict_proba.
+
         Args:
             x_test [ndarray]: testing features
             trained_model [sklearn object]: trained classifier object
@@ -79,72 +147,174 @@ class Experiment:
             result_y [ndarray]: predictions on test set
         """
 
+        if not self.calibrated_scores and self._ranks_by_decision_function():
+            return trained_model.decision_function(x_test)
+
         result_y = trained_model.predict_proba(x_test)
         score_positive_class = result_y[:, 1]
         return score_positive_class
 
-    def train_eval_all_folds(self, x_val, y_val):
-        """Trains and evaluates models over all folds.
+    def _ranks_by_decision_function(self):
+        if self.model_type in DECISION_FUNCTION_MODELS:
+            return True
+        return (self.model_type in SAMME_R_MODELS
+                and self.hyperparameters.get('algorithm') == 'SAMME.R')
+
+    def train_eval_all_folds(self, x_val, y_val, exampleids=None,
+                             groups=None):
+        """Trains and evaluates models over all folds, and saves the
+        results in the database.
 
         Args:
-            timestamp [string]: timestamp of the time the model is run,
-                                used as model identifier
             x_val [ndarray]: feature matrix
             y_val [ndarray]: label vector
+            exampleids [ndarray]: exampleid of each row, stored with the
+                                  predictions (see PredictionStore)
+            groups [ndarray]: the site of each row, for open world folds
+        """
+
+        self.save_results(self.evaluate_all_folds(x_val, y_val,
+                                                  exampleids=exampleids,
+                                                  groups=groups))
+
+    def evaluate_all_folds(self, x_val, y_val, folds=None, exampleids=None,
+                           groups=None):
+        """Trains and evaluates models over all folds, without touching
+        the database.
+
+        Args:
+            x_val [ndarray]: feature matrix
+            y_val [ndarray]: label vector
+            folds [list of ints]: evaluate only the folds with these indices
+            exampleids [ndarray]: exampleid of each row, stored with the
+                                  predictions (see PredictionStore)
+            groups [ndarray]: the site of each row, for open world folds (see
+                              make_folds)
 
         Returns:
-            auc [float]: area under the ROC curve
-            mean_fpr [list of floats]: false positive rate averaged over
-                                       all kfolds
-            mean_tpr [list of floats]: true positive rate averaged over
-                                       all kfolds
-            trained_model [sklearn object]: trained object to be pickled
-                                            so that it can be used for
-                                            scoring 
+            fold_results [list of dicts]: the fold index, fold_timestamp, and
+                                          eval_metrics of each fold
         """
 
-        if self.world_type == "closed":
-            # Why we use stratified k-fold here:
-            # http://stats.stackexchange.com/questions/49540/understanding-stratified-cross-validation
-            cv = cross_validation.StratifiedKFold(y_val, n_folds=self.k,
-                                                  shuffle=True)
-        elif self.world_type == "open":
-            pass  # TODO
-
-        fpr_arr, tpr_arr, metrics_all_folds = [], [], []
-        for i, (train, test) in enumerate(cv):
+        fold_results = []
+        for i, (x_train, y_train, x_test, y_test), test in self.iter_folds(
+                x_val, y_val, folds, groups):
 
             fold_timestamp = datetime.datetime.now().isoformat()
-            y_train, y_test = y_val[train], y_val[test]
-
-            if self.feature_scaling:
-                scaler = preprocessing.StandardScaler().fit(x_val[train])
-                x_train = scaler.transform(x_val[train])
-                x_test = scaler.transform(x_val[test])
-            else:
-                x_train, x_test = x_val[train], x_val[test]
 
             trained_model = self.train_single_fold(x_train, y_train)
-            pred_probs = self.score(x_test, trained_model)
+            fold_results.append(self.evaluate_fold(
+                i, fold_timestamp, trained_model, x_test, y_test,
+                exampleids[test] if exampleids is not None else None))
+
+        return fold_results
+
+    def iter_folds(self, x_val, y_val, folds=None, groups=None):
+        """Yields the index, the (scaled) x_train, y_train, x_test, and
+        y_test, and the row indices of the test set of each fold, or only of
+        the folds with the given indices (in order, if the folds aren't
+        cached)."""
+
+        if self.fold_cache is not None:
+            if folds is None:
+                folds = range(len(self.fold_cache))
+            for i in folds:
+                yield (i, self.fold_cache.load_fold(i),
+                       self.fold_cache.load_test_index(i))
+        else:
+            # Folds are generated lazily, in order, so only the fold being
+            # evaluated is held in memory
+            if folds is not None:
+                folds = set(folds)
+            for i, (train, test) in enumerate(generate_folds(
+                    y_val, self.k, self.seed, self.world_type, groups,
+                    self.frac_obs)):
+                if folds is not None:
+                    if not folds:
+                        break
+                    if i not in folds:
+                        continue
+                    folds.remove(i)
+                yield i, split_fold(x_val, y_val, train, test,
+                                    feature_scaling=self.feature_scaling), test
 
-            filename_kfold = '{}_{}_undefended_frontpage_{}_model_{}_fold_{}_world.pkl'.format(
-                fold_timestamp, self.model_timestamp, self.model_type,  i, self.world_type)
-            fold_to_save = {'trained_object': trained_model,
-                            'y_true': y_test, 'y_predicted': pred_probs}
-            self.pickle_results(filename_kfold, fold_to_save)
+    def evaluate_fold(self, i, fold_timestamp, trained_model, x_test, y_test,
+                      exampleids=None):
+        """Scores the test set of a fold with a trained model, pickles both,
+        stores the scores in the prediction store (if any), and computes the
+        evaluation metrics of the fold."""
 
-            # Metrics computation
-            # Compute ROC curve and area under the ROC curve
-            eval_metrics = evaluation.get_metrics(y_test, pred_probs)
-            metrics_all_folds.append(eval_metrics)
-            fpr_arr.append(eval_metrics['fpr'])
-            tpr_arr.append(eval_metrics['tpr'])
+        pred_probs = self.score(x_test, trained_model)
 
+        filename_kfold = '{}_{}_undefended_frontpage_{}_model_{}_fold_{}_world.pkl'.format(
+            fold_timestamp, self.model_timestamp, self.model_type,  i, self.world_type)
+        fold_to_save = {'trained_object': trained_model,
+                        'y_true': y_test, 'y_predicted': pred_probs,
+                        'calibrated_scores': self.calibrated_scores}
+        self.pickle_results(filename_kfold, fold_to_save)
+
+        # Metrics computation
+        # Compute ROC curve and area under the ROC curve
+        eval_metrics = evaluation.get_metrics(y_test, pred_probs)
+        fold_result = {'fold': i,
+                       'fold_timestamp': fold_timestamp,
+                       'eval_metrics': eval_metrics}
+        if self.base_rates:
+            fold_result['base_rate_metrics'] = evaluation.get_base_rate_metrics(
+                y_test, pred_probs, self.base_rates)
+        if self.prediction_store is not None:
+            fold_result['predictions'] = self.prediction_store.save(
+                self.model_timestamp, i, y_test, pred_probs, exampleids)
+            fold_result['n_examples'] = len(y_test)
+        return fold_result
+
+    def warm_start_key(self):
+        """Experiments with the same key differ only in n_estimators, so
+        their models can be grown from one another with warm_start (see
+        evaluate_warm_started). Returns None for model types that can't be
+        warm-started."""
+
+        if (self.model_type not in WARM_START_MODELS
+                or 'n_estimators' not in self.hyperparameters):
+            return None
+        other_hyperparameters = sorted(
+            (name, repr(value)) for name, value
+            in self.hyperparameters.items() if name != 'n_estimators')
+        return (self.model_type, tuple(other_hyperparameters),
+                self.world_type, self.frac_obs, self.feature_scaling, self.k,
+                self.seed)
+
+    def save_results(self, fold_results):
+        """Saves the metrics of each fold and their average in the
+        database, and plots the ROC curves of all folds.
+
+        Args:
+            fold_results [list of dicts]: output of evaluate_all_folds
+        """
+
+        metrics_all_folds = [fold['eval_metrics'] for fold in fold_results]
+        fpr_arr = [eval_metrics['fpr'] for eval_metrics in metrics_all_folds]
+        tpr_arr = [eval_metrics['tpr'] for eval_metrics in metrics_all_folds]
+
+        for fold in fold_results:
             # Save results of metrics in database
-            self.db.save_fold_of_model(eval_metrics, self.model_timestamp, fold_timestamp)
+            self.db.save_fold_of_model(fold['eval_metrics'],
+                                       self.model_timestamp,
+                                       fold['fold_timestamp'])
+            if 'base_rate_metrics' in fold:
+                self.db.save_base_rate_metrics(fold['base_rate_metrics'],
+                                               self.model_timestamp,
+                                               fold['fold_timestamp'])
+            if 'predictions' in fold:
+                self.db.save_fold_predictions(self.model_timestamp,
+                                              fold['fold_timestamp'],
+                                              fold['fold'],
+                                              fold['predictions'],
+                                              fold['n_examples'],
+                                              self.calibrated_scores)
 
-        auc = evaluation.plot_allkfolds_ROC(self.model_timestamp, cv,
-                                            fpr_arr, tpr_arr)
+        auc = evaluation.plot_allkfolds_ROC(self.model_timestamp, fpr_arr,
+                                            tpr_arr)
 
         print("Classifier {} trained! AUC: {}".format(self.model_timestamp,
                                                       auc))
@@ -152,7 +322,47 @@ class Experiment:
         avg_metrics = evaluation.get_average_metrics(metrics_all_folds)
         # Save results of experiment (model evaluation averaged over all
         # folds) into the database
-        self.db.save_full_model(avg_metrics, self.model_timestamp, self.__dict__)
+        self.db.save_full_model(avg_metrics, self.model_timestamp,
+                                self.get_options())
+
+    def to_job(self):
+        """Describe this experiment as a job for a
+        database.ExperimentQueue."""
+        return {'model_timestamp': self.model_timestamp,
+                'model_type': self.model_type,
+                'hyperparameters': self.hyperparameters,
+                'options': {'world': {'type': self.world_type,
+                                      'observed_fraction': self.frac_obs},
+                            'feature_scaling': self.feature_scaling,
+                            'k': self.k,
+                            'seed': self.seed,
+                            'calibrated_scores': self.calibrated_scores,
+                            'base_rates': self.base_rates}}
+
+    @classmethod
+    def from_job(cls, job):
+        """Recreate an experiment from a job claimed from a
+        database.ExperimentQueue."""
+        model_timestamp = job['model_timestamp']
+        if isinstance(model_timestamp, datetime.datetime):
+            model_timestamp = model_timestamp.isoformat()
+        return cls(model_timestamp=model_timestamp,
+                   world=job['options']['world'],
+                   model_type=job['model_type'],
+                   hyperparameters=job['hyperparameters'],
+                   feature_scaling=job['options']['feature_scaling'],
+                   k=job['options']['k'],
+                   seed=job['options'].get('seed', 0),
+                   calibrated_scores=job['options'].get('calibrated_scores',
+                                                        False),
+                   base_rates=job['options'].get('base_rates'))
+
+    def get_options(self):
+        """The description of this experiment saved with its results."""
+        options = {key: value for key, value in self.__dict__.items()
+                   if key not in ('_db', 'fold_cache', 'prediction_store')}
+        options['numfolds'] = self.k
+        return options
 
     def pickle_results(self, pkl_file, to_save):
         with open(pkl_file, 'wb') as f:
@@ -210,9 +420,11 @@ class Experiment:
                 )
 
         elif self.model_type == 'SVM':
+            # Probability estimates need an internal 5-fold calibration,
+            # so only ask for them if they will be used
             return svm.SVC(C=self.hyperparameters['C_reg'],
                            kernel=self.hyperparameters['kernel'],
-                           probability=True)
+                           probability=self.calibrated_scores)
 
         elif self.model_type == 'LogisticRegression':
             return linear_model.LogisticRegression(
@@ -264,5 +476,813 @@ class Experiment:
                 algorithm=self.hyperparameters['algorithm'],
                 n_jobs=self.n_cores)
 
+        elif self.model_type == 'WeightedKNN':
+            return knn.WeightedKNN(
+                n_neighbors=self.hyperparameters['n_neighbors'],
+                reco_points=self.hyperparameters['reco_points'],
+                rounds=self.hyperparameters['rounds'],
+                n_weight_points=self.hyperparameters.get('n_weight_points'),
+                random_state=self.seed,
+                n_jobs=self.n_cores)
+
         else:
             raise ValueError("Unsupported classifier {}".format(self.model_type))
+
+
+def evaluate_warm_started(experiments, x_val, y_val, folds=None,
+                          exampleids=None, groups=None):
+    """Evaluate experiments that differ only in n_estimators (i.e., have
+    the same warm_start_key) by growing a single ensemble per fold, from the
+    smallest n_estimators to the largest, and scoring it at each size.
+
+    Returns:
+        fold_results [list of lists]: the fold results of each experiment,
+                                      in the order the experiments were
+                                      passed in
+    """
+
+    order = sorted(range(len(experiments)),
+                   key=lambda j: experiments[j].hyperparameters['n_estimators'])
+    smallest = experiments[order[0]]
+    fold_results = [[] for _ in experiments]
+    for i, (x_train, y_train, x_test, y_test), test in smallest.iter_folds(
+            x_val, y_val, folds, groups):
+        model = smallest._get_model_object(smallest.model_type,
+                                           smallest.hyperparameters,
+                                           smallest.n_cores)
+        model.set_params(warm_start=True)
+        for j in order:
+            experiment = experiments[j]
+            fold_timestamp = datetime.datetime.now().isoformat()
+            print("Growing {} classifier to {}".format(
+                experiment.model_type, experiment.hyperparameters))
+            model.set_params(
+                n_estimators=experiment.hyperparameters['n_estimators'])
+            model.fit(x_train, y_train)
+            fold_results[j].append(experiment.evaluate_fold(
+                i, fold_timestamp, model, x_test, y_test,
+                exampleids[test] if exampleids is not None else None))
+    return fold_results
+
+
+def group_warm_start(experiments):
+    """Group experiments that can be evaluated together by
+    evaluate_warm_started. Experiments that can't be warm-started are in
+    groups of their own.
+
+    Returns:
+        groups [list of lists]: experiments, grouped
+    """
+
+    groups = OrderedDict()
+    for i, experiment in enumerate(experiments):
+        key = experiment.warm_start_key()
+        groups.setdefault(key if key is not None else i, []).append(experiment)
+    return list(groups.values())
+
+
+def make_folds(y, k, seed=0, world_type="closed", groups=None,
+               observed_fraction=1.0):
+    """Split a dataset into k folds, the same way for the same labels and
+    seed.
+
+    Args:
+        y [ndarray]: label vector
+        k [int]: number of folds
+        seed [int]: seed of the random split
+        world_type [string]: 'closed' or 'open' (see open_world_folds)
+        groups [ndarray]: the site (e.g., hs_url) of each row; required for
+                          open world folds
+        observed_fraction [float]: fraction of the unmonitored sites outside
+                                   each test set the adversary trains on
+                                   (open world only)
+
+    Returns:
+        folds [list of tuples]: the training and test indices of each fold
+    """
+
+    return list(generate_folds(y, k, seed, world_type, groups,
+                               observed_fraction))
+
+
+def generate_folds(y, k, seed=0, world_type="closed", groups=None,
+                   observed_fraction=1.0):
+    """Like make_folds, but generates the folds one at a time.
+
+    Returns:
+        folds [iterator of tuples]: the training and test indices of each fold
+    """
+
+    if world_type == "closed":
+        # Why we use stratified k-fold here:
+        # http://stats.stackexchange.com/questions/49540/understanding-stratified-cross-validation
+        return iter(cross_validation.StratifiedKFold(
+            y, n_folds=k, shuffle=True, random_state=seed))
+    elif world_type == "open":
+        if groups is None:
+            raise ValueError("Open world folds need the site of each example")
+        return open_world_folds(y, groups, k, seed, observed_fraction)
+    raise ValueError("Unsupported world type {}".format(world_type))
+
+
+def open_world_folds(y, groups, k, seed=0, observed_fraction=1.0):
+    """Generate open world folds, which keep every unmonitored site on one
+    side of each split.
+
+    Monitored (positive) examples are shuffled into k folds by example, as in
+    the closed world. Unmonitored sites are shuffled into k folds by site, so
+    all the examples of an unmonitored site are in the same test set and no
+    model is tested on a site it was trained on. The adversary can only
+    measure part of the unmonitored world, so each training set only gets the
+    examples of a random observed_fraction of the unmonitored sites outside
+    its test set.
+
+    Folds are generated one at a time, as index arrays into the dataset, so
+    when iterated over (as by generate_folds) only the fold in use is held in
+    memory however large the unmonitored world is.
+
+    Yields:
+        train, test [ndarrays]: the training and test indices of each fold
+    """
+
+    y = np.asarray(y)
+    rng = np.random.RandomState(seed)
+    positive = np.flatnonzero(y == 1)
+    negative = np.flatnonzero(y != 1)
+    positive_fold = np.empty(len(positive), dtype=int)
+    positive_fold[rng.permutation(len(positive))] = (
+        np.arange(len(positive)) % k)
+
+    sites, negative_site = np.unique(np.asarray(groups)[negative],
+                                     return_inverse=True)
+    site_fold = np.empty(len(sites), dtype=int)
+    site_fold[rng.permutation(len(sites))] = np.arange(len(sites)) % k
+    negative_fold = site_fold[negative_site]
+
+    for i in range(k):
+        training_sites = np.flatnonzero(site_fold != i)
+        # At least one site is observed, if there is any to observe
+        n_observed = int(round(observed_fraction * len(training_sites)))
+        n_observed = min(max(1, n_observed), len(training_sites))
+        observed = np.zeros(len(sites), dtype=bool)
+        if n_observed:
+            observed[rng.choice(training_sites, n_observed,
+                                replace=False)] = True
+
+        train = np.concatenate((positive[positive_fold != i],
+                                negative[observed[negative_site]]))
+        test = np.concatenate((positive[positive_fold == i],
+                               negative[negative_fold == i]))
+        yield np.sort(train), np.sort(test)
+
+
+def split_fold(x, y, train, test, feature_scaling=True):
+    """Split a dataset into the training and test sets of a fold, scaling
+    both with a StandardScaler fit to the training set if feature_scaling.
+
+    Returns:
+        x_train, y_train, x_test, y_test [ndarrays]
+    """
+
+    if feature_scaling:
+        scaler = preprocessing.StandardScaler().fit(x[train])
+        x_train = scaler.transform(x[train])
+        x_test = scaler.transform(x[test])
+    else:
+        x_train, x_test = x[train], x[test]
+    return x_train, y[train], x_test, y[test]
+
+
+class FoldCache:
+    """The folds of a dataset, split and scaled once and kept on disk as
+    .npy files that every experiment can memory-map.
+
+    Use FoldCache.build() to get the cache for a dataset, which reuses the
+    folds already computed for the same dataset version, k, seed, and
+    feature scaling. When the folds of a new version of a dataset are
+    cached, those of its other versions (with the same world type, k, seed,
+    and feature scaling) are removed, since each takes about k times the
+    space of the dataset. FoldCache objects only hold the directory the folds
+    are in, so they are cheap to send to worker processes.
+
+    Args:
+        directory [string]: the directory the folds are in
+        k [int]: number of folds
+    """
+
+    def __init__(self, directory, k):
+        self.directory = directory
+        self.k = k
+
+    def __len__(self):
+        return self.k
+
+    @classmethod
+    def build(cls, x, y, k, seed=0, feature_scaling=True,
+              world_type="closed", cache_dir=None, version=None, groups=None,
+              observed_fraction=1.0):
+        """Get the FoldCache of a dataset, computing its folds if they
+        aren't already cached.
+
+        Args:
+            x [ndarray]: feature matrix
+            y [ndarray]: label vector
+            groups [ndarray]: the site of each row (open world only, see
+                              make_folds)
+            observed_fraction [float]: see make_folds (open world only)
+            cache_dir [string]: where fold caches are kept (default: a
+                                directory in the system's temporary
+                                directory)
+            version [string]: identifies the dataset (default: a hash of x,
+                              y, and groups)
+        """
+
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'fpsd-fold-cache')
+        if version is None:
+            digest = hashlib.sha1()
+            for array in (x, y, groups):
+                if array is None:
+                    continue
+                array = np.ascontiguousarray(array)
+                digest.update(str((array.dtype, array.shape)).encode())
+                digest.update(array.data)
+            version = digest.hexdigest()
+        world = world_type
+        if world_type == "open":
+            world = '{}{}'.format(world_type, observed_fraction)
+        directory = os.path.join(cache_dir, '{}_{}_k{}_seed{}_{}'.format(
+            version, world, k, seed,
+            'scaled' if feature_scaling else 'unscaled'))
+        if os.path.isdir(directory):
+            return cls(directory, k)
+
+        print("Computing {} folds for fold cache {}".format(k, directory))
+        os.makedirs(cache_dir, exist_ok=True)
+        # Build the cache under a temporary name, then rename it into place,
+        # so that concurrent builders never see a partial cache
+        tmp_directory = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            for i, (train, test) in enumerate(generate_folds(
+                    y, k, seed, world_type, groups, observed_fraction)):
+                arrays = zip(('x_train', 'y_train', 'x_test', 'y_test'),
+                             split_fold(x, y, train, test, feature_scaling))
+                for name, array in arrays:
+                    np.save(os.path.join(tmp_directory,
+                                         '{}_{}.npy'.format(name, i)), array)
+                np.save(os.path.join(tmp_directory,
+                                     'test_index_{}.npy'.format(i)), test)
+            os.rename(tmp_directory, directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        finally:
+            if os.path.isdir(tmp_directory):
+                shutil.rmtree(tmp_directory)
+        _remove_other_versions(cache_dir, os.path.basename(directory))
+        return cls(directory, k)
+
+    def load_fold(self, i):
+        """Memory-map the i-th fold.
+
+        Returns:
+            x_train, y_train, x_test, y_test [ndarrays]
+        """
+
+        return tuple(np.load(os.path.join(self.directory,
+                                          '{}_{}.npy'.format(name, i)),
+                             mmap_mode='r')
+                     for name in ('x_train', 'y_train', 'x_test', 'y_test'))
+
+    def load_test_index(self, i):
+        """The row indices (in the dataset the cache was built from) of
+        the test set of the i-th fold."""
+
+        return np.load(os.path.join(self.directory,
+                                    'test_index_{}.npy'.format(i)))
+
+
+class DatasetCache:
+    """The arrays DatasetLoader.load_arrays returns, kept on disk as .npy
+    files so that repeated attack runs on an unchanged dataset skip loading
+    it from the database.
+
+    Cached datasets are keyed on DatasetLoader.dataset_version, and loaded
+    memory-mapped copy-on-write, so that they can be imputed in place without
+    changing the cache. Only the latest version of each world type and dtype
+    is kept.
+
+    Args:
+        cache_dir [string]: where to keep cached datasets (default: a
+                            directory in the system's temporary directory)
+    """
+
+    ARRAYS = ('x', 'y', 'exampleids', 'feature_names', 'groups')
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(),
+                                                   'fpsd-dataset-cache')
+
+    def version(self, db, world_type, dtype=np.float32):
+        """Name the current version of a dataset.
+
+        Args:
+            db [database.DatasetLoader]: where the dataset is loaded from
+            world_type [string]: 'closed' or 'open'
+            dtype [numpy dtype]: type of the feature matrix
+        """
+
+        return '{}_{}_{}'.format(db.dataset_version(), world_type,
+                                 np.dtype(dtype).name)
+
+    def load(self, db, world_type, dtype=np.float32, version=None):
+        """Load a dataset from the cache, first loading it from the
+        database if the cache doesn't have its current version.
+
+        Returns:
+            x, y, exampleids, feature_names, groups: see
+            DatasetLoader.load_arrays
+        """
+
+        version = version or self.version(db, world_type, dtype)
+        directory = os.path.join(self.cache_dir, version)
+        if not os.path.isdir(directory):
+            self._build(version, db.load_arrays(world_type, dtype=dtype))
+        else:
+            print("Loading dataset {} from {}".format(version, directory))
+
+        arrays = []
+        for name in self.ARRAYS:
+            path = os.path.join(directory, '{}.npy'.format(name))
+            if not os.path.exists(path):
+                arrays.append(None)
+            elif name == 'x':
+                arrays.append(np.load(path, mmap_mode='c'))
+            else:
+                arrays.append(np.load(path))
+        arrays[3] = [str(name) for name in arrays[3]]
+        return tuple(arrays)
+
+    def _build(self, version, arrays):
+        """Write a loaded dataset into the cache, and remove the older
+        versions of it."""
+
+        directory = os.path.join(self.cache_dir, version)
+        print("Caching dataset in {}".format(directory))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # As in FoldCache.build, write under a temporary name and rename
+        # into place
+        tmp_directory = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            for name, array in zip(self.ARRAYS, arrays):
+                if array is not None:
+                    np.save(os.path.join(tmp_directory, '{}.npy'.format(name)),
+                            np.asarray(array))
+            os.rename(tmp_directory, directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        finally:
+            if os.path.isdir(tmp_directory):
+                shutil.rmtree(tmp_directory)
+
+        # Versions are named <hash>_<world type>_<dtype>
+        _remove_other_versions(self.cache_dir, version)
+
+
+def _remove_other_versions(cache_dir, name):
+    """Remove the entries of a cache directory whose names only differ from
+    name in the dataset hash before their first underscore."""
+
+    suffix = name[name.index('_'):]
+    for other in os.listdir(cache_dir):
+        if (other != name and not other.startswith('.') and '_' in other
+                and other[other.index('_'):] == suffix):
+            shutil.rmtree(os.path.join(cache_dir, other), ignore_errors=True)
+
+
+class PredictionStore:
+    """Keeps the scores a model gave the test set of each fold, with the
+    exampleids and true labels of the test set, in one compact .npz file per
+    model and fold. The files are registered in the
+    models.undefended_frontpage_predictions table, so that new metrics,
+    thresholds, or base rates can be computed over every past experiment
+    without retraining (see recompute_metrics).
+
+    Args:
+        directory [string]: where to keep the predictions (default:
+                            logging/predictions)
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or _predictions_dir
+
+    def save(self, model_timestamp, fold, y_true, y_score, exampleids=None):
+        """Store the predictions of one fold of a model.
+
+        Returns:
+            path [string]: the file the predictions were saved to
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}_fold_{}.npz'.format(
+            model_timestamp, fold))
+        arrays = {'y_true': np.asarray(y_true, dtype=np.int8),
+                  'y_score': np.asarray(y_score, dtype=np.float32)}
+        if exampleids is not None:
+            arrays['exampleids'] = np.asarray(exampleids, dtype=np.int64)
+        # Write under a temporary name so that readers never see a partial
+        # file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    @staticmethod
+    def load(path):
+        """Load the predictions of one fold.
+
+        Returns:
+            predictions [dict]: y_true, y_score, and (if they were stored)
+                                exampleids ndarrays
+        """
+
+        with np.load(path) as npz:
+            return {name: npz[name] for name in npz.files}
+
+
+def recompute_metrics(metric=evaluation.get_metrics, model_timestamps=None,
+                      db=None):
+    """Compute a metric over the stored predictions of past experiments,
+    without retraining them.
+
+    Args:
+        metric [function]: takes the y_true and y_score of a fold
+        model_timestamps [list]: only these experiments (default: all of
+                                 them)
+        db [database.ModelStorage]: where the predictions are registered
+
+    Returns:
+        results [dict]: the metric of each fold, keyed by (model_timestamp,
+                        fold)
+    """
+
+    db = db or database.ModelStorage()
+    results = {}
+    for row in db.get_fold_predictions(model_timestamps).itertuples():
+        predictions = PredictionStore.load(row.path)
+        results[(row.model_timestamp, row.fold)] = metric(
+            predictions['y_true'], predictions['y_score'])
+    return results
+
+
+# The dataset shared by the worker processes of an ExperimentPool
+_dataset = {}
+
+
+def _load_dataset(x_path, y_path, exampleids_path=None):
+    """Pool initializer: map the dataset into this worker read-only."""
+    _dataset['x'] = np.load(x_path, mmap_mode='r')
+    _dataset['y'] = np.load(y_path, mmap_mode='r')
+    _dataset['exampleids'] = (np.load(exampleids_path, mmap_mode='r')
+                              if exampleids_path else None)
+
+
+def _evaluate_group(experiments, folds=None):
+    """Run a group of experiments from group_warm_start in a worker
+    process. Returns a list of what _evaluate_experiment returns for each."""
+    if len(experiments) == 1:
+        return [_evaluate_experiment(experiments[0], folds)]
+    try:
+        fold_results = evaluate_warm_started(experiments, _dataset['x'],
+                                             _dataset['y'], folds,
+                                             _dataset['exampleids'])
+        return [(experiment, results, None) for experiment, results
+                in zip(experiments, fold_results)]
+    except Exception:
+        error = traceback.format_exc()
+        return [(experiment, None, error) for experiment in experiments]
+
+
+def _evaluate_experiment(experiment, folds=None):
+    """Run one experiment (on only the given folds, if any) in a worker
+    process. Returns the experiment, its fold results, and a formatted
+    traceback if it failed."""
+    try:
+        fold_results = experiment.evaluate_all_folds(
+            _dataset['x'], _dataset['y'], folds, _dataset['exampleids'])
+        return experiment, fold_results, None
+    except Exception:
+        return experiment, None, traceback.format_exc()
+
+
+class ExperimentPool:
+    """Runs experiments in a pool of worker processes.
+
+    The dataset is written to disk once and memory-mapped read-only by every
+    worker, rather than being copied to each of them. Workers only train and
+    evaluate; results are collected and saved to the database by the calling
+    process as experiments finish.
+
+    Args:
+        x [ndarray]: feature matrix
+        y [ndarray]: label vector
+        cpu_budget [int]: the total number of cores to use, split evenly
+                          between the workers (default: all of them)
+        n_workers [int]: the number of experiments to run at once
+                         (default: one per core in cpu_budget)
+        work_dir [string]: where to write the dataset (default: a temporary
+                           directory)
+        fold_cache_dir [string]: where to keep the FoldCaches experiments
+                                 share (default: see FoldCache.build)
+        exampleids [ndarray]: exampleid of each row, stored with the
+                              predictions of each fold
+        predictions_dir [string]: where to store predictions (default: see
+                                  PredictionStore)
+        groups [ndarray]: the site of each row, for open world folds (see
+                          make_folds)
+        dataset_version [string]: identifies the dataset, e.g. its
+                                  DatasetCache version, so that fold caches
+                                  don't need to hash it
+    """
+
+    def __init__(self, x, y, cpu_budget=None, n_workers=None, work_dir=None,
+                 fold_cache_dir=None, exampleids=None, predictions_dir=None,
+                 groups=None, dataset_version=None):
+        self.x = x
+        self.y = y
+        self.groups = groups
+        self.dataset_version = dataset_version
+        self.exampleids = exampleids
+        self.prediction_store = PredictionStore(predictions_dir)
+        self.fold_cache_dir = fold_cache_dir
+        self.fold_caches = {}
+        self.cpu_budget = cpu_budget or multiprocessing.cpu_count()
+        self.n_workers = min(n_workers or self.cpu_budget, self.cpu_budget)
+        # Each experiment's models get an equal share of the budget
+        self.n_cores = max(1, self.cpu_budget // self.n_workers)
+        self.work_dir = work_dir
+
+    def prepare(self, experiment):
+        """Give an experiment its share of the cores and the cached folds
+        it should be evaluated on."""
+        experiment.n_cores = self.n_cores
+        key = (experiment.k, experiment.seed, experiment.feature_scaling,
+               experiment.world_type, experiment.frac_obs)
+        if key not in self.fold_caches:
+            self.fold_caches[key] = FoldCache.build(
+                self.x, self.y, experiment.k, seed=experiment.seed,
+                feature_scaling=experiment.feature_scaling,
+                world_type=experiment.world_type,
+                cache_dir=self.fold_cache_dir,
+                version=self.dataset_version, groups=self.groups,
+                observed_fraction=experiment.frac_obs)
+        experiment.fold_cache = self.fold_caches[key]
+        experiment.prediction_store = self.prediction_store
+
+    @contextmanager
+    def workers(self):
+        """Write the dataset to disk and start the worker processes, which
+        map it into memory."""
+        data_dir = tempfile.mkdtemp(prefix='fpsd-experiments-',
+                                    dir=self.work_dir)
+        try:
+            x_path = os.path.join(data_dir, 'x.npy')
+            y_path = os.path.join(data_dir, 'y.npy')
+            np.save(x_path, self.x)
+            np.save(y_path, self.y)
+            exampleids_path = None
+            if self.exampleids is not None:
+                exampleids_path = os.path.join(data_dir, 'exampleids.npy')
+                np.save(exampleids_path, self.exampleids)
+            with multiprocessing.Pool(self.n_workers,
+                                      initializer=_load_dataset,
+                                      initargs=(x_path, y_path,
+                                                exampleids_path)) as pool:
+                yield pool
+        finally:
+            shutil.rmtree(data_dir)
+
+    def run(self, experiments):
+        """Run all experiments, saving the results of each.
+
+        Returns:
+            failed [list]: the experiments that raised an exception
+        """
+
+        experiments = list(experiments)
+        for experiment in experiments:
+            self.prepare(experiment)
+
+        print("Running {} experiments in {} workers with {} cores "
+              "each".format(len(experiments), self.n_workers, self.n_cores))
+        failed = []
+        n_done = 0
+        with self.workers() as pool:
+            for group_results in pool.imap_unordered(
+                    _evaluate_group, group_warm_start(experiments)):
+                for experiment, fold_results, error in group_results:
+                    n_done += 1
+                    if error:
+                        print("Experiment {} ({}, {}) failed:\n{}".format(
+                            experiment.model_timestamp, experiment.model_type,
+                            experiment.hyperparameters, error))
+                        failed.append(experiment)
+                        continue
+                    experiment.save_results(fold_results)
+                    print("Finished {} of {} experiments".format(
+                        n_done, len(experiments)))
+        return failed
+
+    def run_queue(self, experiment_queue, sweep, worker,
+                  heartbeat_interval=60):
+        """Claim and run experiments from a sweep in a
+        database.ExperimentQueue until none are left to claim, keeping the
+        leases on running experiments alive from a background thread.
+
+        Results are only saved for experiments whose lease this worker still
+        holds. If a worker process dies (e.g., killed for running out of
+        memory), the experiments running in the pool are failed (so they go
+        back in the queue) and the pool is restarted.
+
+        Returns:
+            n_finished [int]: the number of experiments this worker finished
+        """
+
+        running = {}
+        finished = queue.Queue()
+        stop_heartbeats = threading.Event()
+
+        def send_heartbeats():
+            while not stop_heartbeats.wait(heartbeat_interval):
+                try:
+                    jobids = list(running)
+                    held = experiment_queue.heartbeat(jobids, worker)
+                except Exception:
+                    # Leases only expire after the queue's lease_timeout, so
+                    # keep trying
+                    print("Failed to renew leases:\n{}".format(
+                        traceback.format_exc()))
+                    continue
+                for jobid in set(jobids) - set(held):
+                    print("Lost the lease on job {}".format(jobid))
+
+        def submit(pool, jobid, experiment):
+            def failed(error):
+                finished.put((jobid, (experiment, None, "".join(
+                    traceback.format_exception_only(type(error), error)))))
+            pool.apply_async(_evaluate_experiment, (experiment,),
+                             callback=lambda result: finished.put(
+                                 (jobid, result)),
+                             error_callback=failed)
+
+        heartbeats = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeats.start()
+        n_finished = 0
+        try:
+            pool_broken = True
+            while pool_broken:
+                pool_broken = False
+                with self.workers() as pool:
+                    worker_pids = {process.pid for process in
+                                   multiprocessing.active_children()}
+                    while True:
+                        while len(running) < self.n_workers:
+                            job = experiment_queue.claim(sweep, worker)
+                            if job is None:
+                                break
+                            experiment = Experiment.from_job(job)
+                            self.prepare(experiment)
+                            running[job['jobid']] = experiment
+                            submit(pool, job['jobid'], experiment)
+                        if not running:
+                            break
+
+                        try:
+                            jobid, (experiment, fold_results, error) = \
+                                finished.get(timeout=heartbeat_interval)
+                        except queue.Empty:
+                            # A multiprocessing.Pool silently replaces workers
+                            # that die, losing their tasks
+                            alive = {process.pid for process in
+                                     multiprocessing.active_children()}
+                            if worker_pids <= alive:
+                                continue
+                            print("A worker process died; failing jobs {} "
+                                  "and restarting the pool".format(
+                                      sorted(running)))
+                            for jobid in running:
+                                experiment_queue.fail(
+                                    jobid, worker, "Worker process died")
+                            running.clear()
+                            pool_broken = True
+                            break
+                        if jobid not in running:
+                            # Finished after its pool was found broken
+                            continue
+                        del running[jobid]
+                        if error:
+                            print("Experiment {} ({}, {}) failed:\n{}".format(
+                                experiment.model_timestamp,
+                                experiment.model_type,
+                                experiment.hyperparameters, error))
+                            experiment_queue.fail(jobid, worker, error)
+                            continue
+                        if not experiment_queue.finish(jobid, worker):
+                            print("Lost the lease on job {}; not saving its "
+                                  "results".format(jobid))
+                            continue
+                        try:
+                            experiment.save_results(fold_results)
+                        except Exception:
+                            error = traceback.format_exc()
+                            print("Failed to save the results of job "
+                                  "{}:\n{}".format(jobid, error))
+                            experiment_queue.fail(jobid, worker, error)
+                            continue
+                        n_finished += 1
+                        print("Finished job {}; {} jobs left in sweep "
+                              "{}".format(jobid,
+                                          experiment_queue.count_unfinished(
+                                              sweep), sweep))
+        finally:
+            stop_heartbeats.set()
+        return n_finished
+
+    def successive_halving(self, experiments, min_folds=1, eta=3):
+        """Search for the best experiments by successive halving: evaluate
+        every experiment on min_folds folds, promote the best 1/eta of them
+        (by mean AUC) to eta times as many folds, and so on until the
+        remaining experiments have been evaluated on all their folds. Folds
+        evaluated in earlier rungs aren't evaluated again.
+
+        The mean AUC of every experiment in every rung but the last is saved
+        in the models.search_rungs table; the experiments that make it
+        through the last rung are saved like any other.
+
+        Returns:
+            finalists [list]: the experiments evaluated on all folds
+        """
+
+        candidates = [(experiment, []) for experiment in experiments]
+        for experiment, _ in candidates:
+            self.prepare(experiment)
+        k = max(experiment.k for experiment, _ in candidates)
+        n_folds, rung = min(max(1, min_folds), k), 0
+
+        with self.workers() as pool:
+            while candidates:
+                print("Rung {}: evaluating {} experiments on {} "
+                      "folds".format(rung, len(candidates), n_folds))
+                # Only evaluate the folds not already evaluated in earlier
+                # rungs
+                tasks = OrderedDict()
+                for j, (experiment, results) in enumerate(candidates):
+                    folds = tuple(range(len(results),
+                                        min(n_folds, experiment.k)))
+                    key = (experiment.warm_start_key(), folds)
+                    if key[0] is None:
+                        key = (j, folds)
+                    tasks.setdefault(key, []).append(j)
+                group_results = pool.starmap(_evaluate_group, [
+                    ([candidates[j][0] for j in group], list(key[1]))
+                    for key, group in tasks.items()])
+                new_results = {}
+                for group, results in zip(tasks.values(), group_results):
+                    new_results.update(zip(group, results))
+
+                evaluated = []
+                for j, (experiment, results) in enumerate(candidates):
+                    _, results_of_rung, error = new_results[j]
+                    if error:
+                        print("Experiment {} ({}, {}) failed:\n{}".format(
+                            experiment.model_timestamp, experiment.model_type,
+                            experiment.hyperparameters, error))
+                        continue
+                    evaluated.append((experiment, results + results_of_rung))
+
+                if n_folds >= k:
+                    for experiment, results in evaluated:
+                        experiment.save_results(results)
+                    return [experiment for experiment, _ in evaluated]
+
+                ranked = sorted(
+                    ((np.mean([fold['eval_metrics']['auc']
+                               for fold in results]), experiment, results)
+                     for experiment, results in evaluated),
+                    key=lambda x: x[0], reverse=True)
+                n_promoted = max(1, int(np.ceil(len(ranked) / eta)))
+                for i, (auc, experiment, _) in enumerate(ranked):
+                    experiment.db.save_search_rung(
+                        experiment.model_timestamp, experiment.model_type,
+                        experiment.hyperparameters, rung, n_folds, auc,
+                        i < n_promoted)
+                candidates = [(experiment, results) for _, experiment, results
+                              in ranked[:n_promoted]]
+                n_folds, rung = min(n_folds * eta, k), rung + 1
+        return []
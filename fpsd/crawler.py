@@ -6,9 +6,10 @@
 
 from ast import literal_eval
 import codecs
+from concurrent.futures import ThreadPoolExecutor
 import http.client
-from io import SEEK_END, SEEK_SET
-from os import mkdir
+import json
+from os import getpid, mkdir, replace
 from os.path import abspath, dirname, join
 import pickle
 import platform
@@ -19,7 +20,7 @@ import stem
 from stem.process import launch_tor_with_config
 from stem.control import Controller
 from sys import exc_info
-from time import sleep
+from time import sleep, time
 from traceback import format_exception
 import urllib.parse
 from urllib.request import urlopen
@@ -27,6 +28,7 @@ from tbselenium.tbdriver import TorBrowserDriver
 from tbselenium.common import USE_RUNNING_TOR
 from tbselenium.utils import start_xvfb, stop_xvfb
 
+from cell_log import CellLog, parse_cells
 from database import RawStorage
 from utils import (find_free_port, get_config, get_timestamp, panic,
                    setup_logging, symlink_cur_to_latest, timestamp_file)
@@ -34,6 +36,9 @@ from version import __version__ as _version
 
 _dir = dirname(abspath(__file__))
 _log_dir = join(_dir, "logging")
+# IP and ASN lookups are slow and rarely change, so they are shared between
+# Crawler restarts and concurrently launched Crawlers through this file
+_ip_asn_cache = join(_log_dir, "ip-asn-cache.json")
 
 # The Crawler handles most errors internally so the user does not have to worry
 # about exception handling
@@ -63,6 +68,9 @@ class Crawler:
                  torrc_config={"CookieAuth": "1"},
                  tor_log="/var/log/tor/tor.log",
                  tor_cell_log="/var/log/tor/tor_cell_seq.log",
+                 cell_log_max_bytes=100*1024**2,
+                 cell_log_backup_count=5,
+                 trace_chunk_size=1024**2,
                  control_port=9051,
                  socks_port=9050,
                  run_in_xvfb=True,
@@ -74,31 +82,58 @@ class Crawler:
                  wait_after_closing_circuits=0,
                  restart_on_sketchy_exception=True,
                  additional_control_fields={},
+                 control_data_cache_ttl=3600,
                  db_handler=None):
 
         self.logger = setup_logging(_log_dir, "crawler")
         # Set stem logging level to INFO - "high level library activity"
         stem.util.log.get_logger().setLevel(stem.util.log.Runlevel.INFO)
 
-        self.torrc_config = torrc_config
-        self.socks_port = find_free_port(socks_port, control_port)
-        self.torrc_config.update({"SocksPort": str(self.socks_port)})
-        self.control_port = find_free_port(control_port, self.socks_port)
-        self.torrc_config.update({"ControlPort": str(self.control_port)})
-        self.torrc_config.update({"Log": "INFO file {}".format(tor_log)})
-        self.logger.info("Starting tor process with config "
-                         "{torrc_config}.".format(**locals()))
-        self.tor_process = launch_tor_with_config(config=self.torrc_config,
-                                                  take_ownership=take_ownership)
-        self.authenticate_to_tor_controlport()
-
-        self.logger.info("Opening cell log stream...")
-        self.cell_log = open(tor_cell_log, "rb")
+        # Launching tor, starting Xvfb, and looking up our IP and ASN do not
+        # depend on one another, so we overlap them and only wait on their
+        # results once they are needed.
+        self.control_data_cache_ttl = control_data_cache_ttl
+        self.startup_executor = ThreadPoolExecutor(max_workers=2)
+        self.ip_asn_future = self.startup_executor.submit(
+            self.get_ip_asn_data, control_data_cache_ttl)
 
         if run_in_xvfb:
             self.logger.info("Starting Xvfb...")
             self.run_in_xvfb = True
-            self.virtual_framebuffer = start_xvfb()
+            xvfb_future = self.startup_executor.submit(start_xvfb)
+
+        try:
+            self.torrc_config = torrc_config
+            self.socks_port = find_free_port(socks_port, control_port)
+            self.torrc_config.update({"SocksPort": str(self.socks_port)})
+            self.control_port = find_free_port(control_port, self.socks_port)
+            self.torrc_config.update({"ControlPort": str(self.control_port)})
+            self.torrc_config.update({"Log": "INFO file {}".format(tor_log)})
+            self.logger.info("Starting tor process with config "
+                             "{torrc_config}.".format(**locals()))
+            self.tor_process = launch_tor_with_config(
+                config=self.torrc_config, take_ownership=take_ownership)
+            self.authenticate_to_tor_controlport()
+
+            self.logger.info("Opening cell log stream...")
+            self.trace_chunk_size = trace_chunk_size
+            self.cell_log = CellLog(tor_cell_log, max_bytes=cell_log_max_bytes,
+                                    backup_count=cell_log_backup_count,
+                                    logger=self.logger)
+        except BaseException:
+            # Xvfb isn't yet owned by this Crawler, so close() wouldn't stop
+            # it (panic() raises SystemExit, hence BaseException)
+            if run_in_xvfb:
+                self.logger.info("Closing the virtual framebuffer...")
+                try:
+                    stop_xvfb(xvfb_future.result())
+                except Exception:
+                    pass
+            self.startup_executor.shutdown(wait=False)
+            raise
+
+        if run_in_xvfb:
+            self.virtual_framebuffer = xvfb_future.result()
 
         self.logger.info("Starting Tor Browser...")
         self.tb_driver = TorBrowserDriver(tbb_path=tbb_path,
@@ -153,19 +188,13 @@ class Crawler:
         control_data["kernel_version"] = platform.release()
         control_data["os"] = platform.version()
         control_data["python_version"] = platform.python_version()
-        ip = urlopen("https://api.ipify.org").read().decode()
-        control_data["ip"] = ip
-        # This API seems to be unstable and we haven't found a suitable
-        # alternative :(
-        try:
-            asn_geoip = urlopen("http://api.moocher.io/ip/{}".format(ip))
-            asn_geoip = literal_eval(asn_geoip.read().decode())
-            control_data["asn"] = asn_geoip.get("ip").get("as").get("asn")
-            control_data["city"] = asn_geoip.get("ip").get("city")
-            control_data["country"] = asn_geoip.get("ip").get("country")
-        except urllib.error.HTTPError:
-            self.logger.warning("Unable to query ASN API and thus some "
-                                "control data may be missing from this run.")
+        # Usually resolved in the background while tor and Tor Browser were
+        # starting up
+        if "ip_asn_future" in dir(self):
+            ip_asn_data = self.ip_asn_future.result()
+        else:
+            ip_asn_data = self.get_ip_asn_data(self.control_data_cache_ttl)
+        control_data.update(ip_asn_data)
         control_data["tor_version"] = self.controller.get_version().version_str
         control_data["tb_version"] = self.tb_driver.tb_version
         # Tor will have multiple entry nodes in its state file, but will
@@ -178,6 +207,45 @@ class Crawler:
         return control_data
 
 
+    def get_ip_asn_data(self, ttl):
+        """Return the IP, ASN, city, and country of this machine. Lookups are
+        cached in a file and reused for ttl seconds."""
+        try:
+            with open(_ip_asn_cache, "r") as fh:
+                cache = json.load(fh)
+            if time() - cache["t_lookup"] < ttl:
+                self.logger.info("Using cached IP and ASN data.")
+                return cache["ip_asn_data"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.logger.info("Looking up IP and ASN data...")
+        ip_asn_data = {}
+        ip = urlopen("https://api.ipify.org").read().decode()
+        ip_asn_data["ip"] = ip
+        # This API seems to be unstable and we haven't found a suitable
+        # alternative :(
+        try:
+            asn_geoip = urlopen("http://api.moocher.io/ip/{}".format(ip))
+            asn_geoip = literal_eval(asn_geoip.read().decode())
+            ip_asn_data["asn"] = asn_geoip.get("ip").get("as").get("asn")
+            ip_asn_data["city"] = asn_geoip.get("ip").get("city")
+            ip_asn_data["country"] = asn_geoip.get("ip").get("country")
+        except urllib.error.HTTPError:
+            self.logger.warning("Unable to query ASN API and thus some "
+                                "control data may be missing from this run.")
+            # Don't cache incomplete data
+            return ip_asn_data
+
+        # Write to a temporary file first so concurrently starting Crawlers
+        # never read a partially written cache
+        tmp_cache = "{}.{}".format(_ip_asn_cache, getpid())
+        with open(tmp_cache, "w") as fh:
+            json.dump({"t_lookup": time(), "ip_asn_data": ip_asn_data}, fh)
+        replace(tmp_cache, _ip_asn_cache)
+        return ip_asn_data
+
+
     def __enter__(self):
         return self
 
@@ -210,6 +278,8 @@ class Crawler:
         if "tor_process" in dir(self):
             self.logger.info("Killing the tor process...")
             self.tor_process.kill()
+        if "startup_executor" in dir(self):
+            self.startup_executor.shutdown(wait=False)
         self.logger.info("Crawler exit completed.")
 
 
@@ -236,6 +306,9 @@ class Crawler:
         trace_name = urllib.parse.quote(url, safe="") + "-" + str(iteration)
         trace_path = join(trace_dir, trace_name)
 
+        # Everything logged before this trace has been ingested (or given up
+        # on), so the cell log may be rotated
+        self.cell_log.release(self.get_cell_log_pos())
         start_idx = self.get_cell_log_pos()
 
         try:
@@ -264,7 +337,9 @@ class Crawler:
 
         self.logger.info("{url}: saving full trace...".format(**locals()))
         end_idx = self.get_cell_log_pos()
-        full_trace = self.get_full_trace(start_idx, end_idx)
+        # Stream the trace from the cell log in chunks rather than reading it
+        # into memory all at once
+        trace_chunks = self.iter_full_trace(start_idx, end_idx)
 
         # Save the trace to the database or write to file
         if self.db_handler:
@@ -276,10 +351,12 @@ class Crawler:
                 panic("If using the database, and calling collect_onion_trace "
                       "directly, you must specify the hsid of the site.")
             exampleid = self.db_handler.add_example(new_example)
-            self.db_handler.add_trace(str(full_trace), exampleid)
+            self.db_handler.add_trace_cells(parse_cells(trace_chunks),
+                                            exampleid)
         else:
             with open(trace_path+"-full", "wb") as fh:
-                fh.write(full_trace)
+                for chunk in trace_chunks:
+                    fh.write(chunk)
 
         return "succeeded"
 
@@ -298,8 +375,9 @@ class Crawler:
 
 
     def get_cell_log_pos(self):
-        """Returns the current position of the last byte in the Tor cell log."""
-        return self.cell_log.seek(0, SEEK_END)
+        """Returns the current position of the last byte in the Tor cell log
+        as a (generation, offset) tuple (see cell_log.CellLog)."""
+        return self.cell_log.tell()
 
 
     def crawl_url(self, url):
@@ -369,23 +447,29 @@ class Crawler:
     def save_debug_log(self, url, trace_path, start_idx):
         self.logger.warning("{url}: saving debug log...".format(**locals()))
         exc_time = self.get_cell_log_pos()
-        trace = self.get_full_trace(start_idx, exc_time)
         with open(trace_path + "@debug", "wb") as fh:
-            fh.write(trace)
+            for chunk in self.iter_full_trace(start_idx, exc_time):
+                fh.write(chunk)
 
 
 
     def get_full_trace(self, start_idx, end_idx):
         """Returns the Tor DATA cells transmitted over a circuit during a
         specified time period."""
+        return b"".join(self.iter_full_trace(start_idx, end_idx))
+
+
+    def iter_full_trace(self, start_idx, end_idx):
+        """Like get_full_trace, but yields the trace in chunks of at most
+        self.trace_chunk_size bytes."""
         # Sanity check
-        assert start_idx >= 0 and end_idx > 0, ("Invalid (negative) logfile "
-                                                "position")
+        assert start_idx[1] >= 0 and end_idx[1] >= 0, ("Invalid (negative) "
+                                                        "logfile position")
         assert end_idx > start_idx, ("logfile section end_idx must come "
                                      "after start_idx")
 
-        self.cell_log.seek(start_idx, SEEK_SET)
-        return self.cell_log.read(end_idx - start_idx)
+        return self.cell_log.iter_read(start_idx, end_idx,
+                                       chunk_size=self.trace_chunk_size)
 
 
     def restart_tb(self):
@@ -518,6 +602,9 @@ def _securedrop_crawl():
                  wait_on_page=config.getint("wait_on_page"),
                  wait_after_closing_circuits=config.getint("wait_after_closing_circuits"),
                  restart_on_sketchy_exception=config.getboolean("restart_on_sketchy_exception"),
+                 control_data_cache_ttl=config.getint("control_data_cache_ttl"),
+                 cell_log_max_bytes=config.getint("cell_log_max_bytes"),
+                 cell_log_backup_count=config.getint("cell_log_backup_count"),
                  db_handler=fpdb,
                  torrc_config={"CookieAuthentication": "1",
                                "EntryNodes": config["entry_nodes"]}) as crawler:
@@ -2,12 +2,14 @@
 from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime as dt
+import hashlib
 import json
+import numpy as np
 import os
 import pandas as pd
 from psycopg2 import OperationalError
 import re
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, MetaData, text
 from sqlalchemy.engine.url import URL as SQL_connect_URL
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session
@@ -75,30 +77,75 @@ class RawStorage(Database):
         self.Example = Base.classes.frontpage_examples
         self.Cell = Base.classes.frontpage_traces
         self.Crawl = Base.classes.crawls
+        # The latest state of every onion service in hs_history. Databases set
+        # up before it was introduced may not have it yet.
+        self.CurrentOnion = getattr(Base.classes, 'hs_current', None)
 
     def _wipe_raw_schema(self):
         """Like with a cloth. Delete entries while keeping table structure
         intact."""
         with self.safe_session() as session:
-            for table in self.Cell, self.Example, self.Onion, self.Crawl:
-                session.query(table).delete()
-
-    def add_onions(self, class_data):
-        """Add sorted onions into the HS history table"""
-        onions = []
+            for table in (self.Cell, self.Example, self.CurrentOnion,
+                          self.Onion, self.Crawl):
+                if table is not None:
+                    session.query(table).delete()
+
+    def add_onions(self, class_data, seen_urls=None):
+        """Add sorted onions into the HS history table.
+
+        seen_urls are all the onion services that were sorted in this run,
+        including ones left out of class_data because their class hasn't
+        changed (see sorter.SortCache). It defaults to the onions in
+        class_data. The latest row of every onion service in seen_urls is
+        marked current, and every other row in hs_history not current. If the
+        hs_current table exists, it is brought up to date as well.
+        """
         ts = get_timestamp("db")
+        onions = []
         for class_name, class_urls in class_data.items():
-            onions += [self.Onion(
-                hs_url='{}{}'.format(hs_url.split('onion')[0], 'onion'),
+            onions += [dict(
+                hs_url=_normalize_hs_url(hs_url),
                 is_sd=True if 'sd' in class_name else False,
                 sd_version=class_name.split('_')[1] if 'sd' in class_name else 'N/A',
                 is_current=True,
                 sorted_class=class_name,
                 t_sort=ts)
                 for hs_url in class_urls]
+        if seen_urls is None:
+            seen_urls = [onion['hs_url'] for onion in onions]
+        else:
+            seen_urls = [_normalize_hs_url(hs_url) for hs_url in seen_urls]
 
         with self.safe_session() as session:
-            session.bulk_save_objects(onions)
+            if onions:
+                # One multi-row INSERT rather than a round trip per row
+                session.execute(self.Onion.__table__.insert().values(onions))
+            if self.CurrentOnion is None:
+                return
+            # Point each onion service we saw at its latest row, inserted
+            # above or in an earlier run
+            session.execute(text(
+                "INSERT INTO raw.hs_current "
+                "(hs_url, hsid, is_sd, sd_version, sorted_class, t_sort, "
+                "t_seen) "
+                "SELECT DISTINCT ON (hs_url) hs_url, hsid, is_sd, sd_version, "
+                "sorted_class, t_sort, CAST(:ts AS TIMESTAMP) "
+                "FROM raw.hs_history WHERE hs_url = ANY(:seen_urls) "
+                "ORDER BY hs_url, t_sort DESC, hsid DESC "
+                "ON CONFLICT (hs_url) DO UPDATE SET hsid = EXCLUDED.hsid, "
+                "is_sd = EXCLUDED.is_sd, sd_version = EXCLUDED.sd_version, "
+                "sorted_class = EXCLUDED.sorted_class, "
+                "t_sort = EXCLUDED.t_sort, t_seen = EXCLUDED.t_seen"),
+                {'ts': ts, 'seen_urls': seen_urls})
+            # Then flip is_current across the whole history in one statement,
+            # touching only the rows whose currency changed
+            session.execute(text(
+                "UPDATE raw.hs_history h SET is_current = NOT h.is_current "
+                "WHERE (h.is_current OR h.hsid IN "
+                "(SELECT hsid FROM raw.hs_current WHERE t_seen = :ts)) "
+                "AND h.is_current <> EXISTS (SELECT 1 FROM raw.hs_current c "
+                "WHERE c.hsid = h.hsid AND c.t_seen = :ts)"),
+                {'ts': ts})
 
     def get_onion_class(self, timespan, is_monitored):
         """Get a class of onions from the database.
@@ -122,9 +169,18 @@ class RawStorage(Database):
         onion_class = {}
         class_name = ""
         with self.safe_session() as session:
-            for row in session.query(self.Onion).\
-                       filter(self.Onion.t_sort >= start_sort_time).\
-                       filter(self.Onion.is_sd == is_monitored):
+            if self.CurrentOnion is not None:
+                # An index scan of the latest state of each onion service
+                # seen since start_sort_time
+                query = session.query(self.CurrentOnion).\
+                        filter(self.CurrentOnion.t_seen >= start_sort_time).\
+                        filter(self.CurrentOnion.is_sd == is_monitored).\
+                        order_by(self.CurrentOnion.t_sort)
+            else:
+                query = session.query(self.Onion).\
+                        filter(self.Onion.t_sort >= start_sort_time).\
+                        filter(self.Onion.is_sd == is_monitored)
+            for row in query:
                 onion_class.update({row.hs_url: row.hsid})
                 class_name = row.sorted_class
         return onion_class, class_name
@@ -180,6 +236,27 @@ class RawStorage(Database):
             session.bulk_save_objects(cells)
         return None
 
+    def add_trace_cells(self, cells, exampleid, batch_size=10000):
+        """Insert rows for a trace into the frontpage_traces table from an
+        iterable of cells (e.g., from cell_log.parse_cells), writing them in
+        batches so memory use does not grow with the size of the trace."""
+        batch = []
+        with self.safe_session() as session:
+            for cell in cells:
+                cell['exampleid'] = exampleid
+                batch.append(cell)
+                if len(batch) >= batch_size:
+                    session.bulk_insert_mappings(self.Cell, batch)
+                    batch = []
+            if batch:
+                session.bulk_insert_mappings(self.Cell, batch)
+        return None
+
+
+def _normalize_hs_url(hs_url):
+    """Strip anything after the .onion address from a URL."""
+    return '{}{}'.format(hs_url.split('onion')[0], 'onion')
+
 
 class DatasetLoader(Database):
     """Load train/test sets"""
@@ -194,7 +271,7 @@ class DatasetLoader(Database):
         :returns: a pandas DataFrame df containing the dataset
         """
 
-        select_hs_urls = ', t3.hs_url' if world_type is 'open' else ''
+        select_hs_urls = ', t3.hs_url' if world_type == 'open' else ''
 
         labeled_query = ('select t1.*, t3.is_sd {} '
                            'from features.frontpage_features t1 '
@@ -206,6 +283,106 @@ class DatasetLoader(Database):
         df = pd.read_sql(labeled_query, self.engine)
         return df
 
+    def dataset_version(self):
+        """Identify the current contents of the dataset, by the definition
+        of the feature view (i.e., the set of feature tables and columns)
+        and the watermark (highest exampleid) of the examples features were
+        computed for. Sort runs that don't add examples, e.g., only adding to
+        raw.hs_history, leave it unchanged.
+
+        :returns: a short hash that changes whenever features are added or
+                  recomputed for new examples
+        """
+
+        query = ("select pg_get_viewdef(                             "
+                 "'features.frontpage_features'::regclass),          "
+                 "(select max(exampleid)                             "
+                 "from features.undefended_frontpage_examples)       ")
+        row = self.engine.execute(query).fetchone()
+        return hashlib.sha1(repr(tuple(row)).encode()).hexdigest()[:16]
+
+    def load_arrays(self, world_type, dtype=np.float32, chunk_size=10000):
+        """Load the same dataset as load_world, but straight into arrays.
+
+        Rather than materializing a DataFrame, rows are streamed through a
+        server-side cursor chunk_size at a time and copied into a feature
+        matrix allocated up front with the given dtype. Missing features are
+        NaN. The dataset is read in one repeatable read transaction, so the
+        matrix is sized for exactly the rows that are read.
+
+        :returns: x, the feature matrix; y, whether each example is of a
+                  SecureDrop site; exampleids; feature_names, the name of
+                  each column of x; and for the open world (else None)
+                  groups, the hs_url of each example
+        """
+
+        open_world = world_type == 'open'
+        from_clause = ('from features.frontpage_features t1 '
+                       'inner join raw.frontpage_examples t2 '
+                       'on t1.exampleid = t2.exampleid '
+                       'inner join raw.hs_history t3 '
+                       'on t3.hsid = t2.hsid')
+
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, '
+                           'READ ONLY')
+            cursor.execute('select * from features.frontpage_features limit 0')
+            feature_names = [column[0] for column in cursor.description
+                             if column[0] != 'exampleid']
+            cursor.execute('select count(*) {}'.format(from_clause))
+            n_rows = cursor.fetchone()[0]
+            cursor.close()
+
+            # A named cursor is a server-side cursor
+            cursor = connection.cursor(name='fpsd_load_arrays')
+            cursor.itersize = chunk_size
+            cursor.execute('select t1.exampleid, t3.is_sd{}, {} {}'.format(
+                ', t3.hs_url' if open_world else '',
+                ', '.join('t1."{}"'.format(name) for name in feature_names),
+                from_clause))
+            chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
+            x, y, exampleids, groups = _fill_arrays(
+                chunks, n_rows, len(feature_names), dtype, open_world)
+            cursor.close()
+        finally:
+            connection.rollback()
+            connection.close()
+        return x, y, exampleids, feature_names, groups
+
+
+def _fill_arrays(chunks, n_rows, n_features, dtype=np.float32,
+                 with_groups=False):
+    """Copy chunks of rows of (exampleid, is_sd, [hs_url,] features...) into
+    preallocated arrays.
+
+    :returns: x, y, exampleids, and groups (None unless with_groups)
+    """
+
+    x = np.empty((n_rows, n_features), dtype=dtype)
+    y = np.empty(n_rows, dtype=int)
+    exampleids = np.empty(n_rows, dtype=np.int64)
+    groups = [] if with_groups else None
+    n_meta = 3 if with_groups else 2
+
+    start = 0
+    for rows in chunks:
+        end = start + len(rows)
+        if end > n_rows:
+            raise ValueError("Got more than the {} rows expected".format(
+                n_rows))
+        exampleids[start:end] = [row[0] for row in rows]
+        y[start:end] = [row[1] for row in rows]
+        if with_groups:
+            groups.extend(row[2] for row in rows)
+        # None (NULL) becomes NaN
+        x[start:end] = [row[n_meta:] for row in rows]
+        start = end
+    if with_groups:
+        groups = np.array(groups)
+    return x[:start], y[:start], exampleids[:start], groups
+
 
 class ModelStorage(Database):
     """Store trained models in the database"""
@@ -266,6 +443,35 @@ class ModelStorage(Database):
         with self.safe_session() as session:
             session.execute(query)
 
+    def save_hard_decision_model(self, tpr, fpr, model_timestamp, options):
+        """Save a model that only makes hard decisions (e.g., lib/knn.go),
+        and so only has one point on its ROC curve."""
+        auc = (1 + tpr - fpr) / 2
+        query = ("INSERT INTO models.undefended_frontpage_attacks  "
+                 "(model_timestamp, numfolds, world_type,          "
+                 "model_type, hyperparameters, auc, tpr, fpr)      "
+                 "VALUES ('{}', {}, '{}', '{}', '{}', {},          "
+                 "'{{0, {}, 1}}', '{{0, {}, 1}}')                  "
+                 ).format(model_timestamp, options["numfolds"],
+                    options["world_type"], options["model_type"],
+                    json.dumps(options["hyperparameters"]), auc, tpr, fpr)
+        with self.safe_session() as session:
+            session.execute(query)
+
+    def save_search_rung(self, model_timestamp, model_type, hyperparameters,
+                         rung, numfolds, auc, promoted):
+        """Record how an experiment did in a rung of a successive halving
+        search, and whether it was promoted to the next one."""
+        query = ("INSERT INTO models.search_rungs                  "
+                 "(model_timestamp, model_type, hyperparameters,   "
+                 "rung, numfolds, auc, promoted)                   "
+                 "VALUES ('{}', '{}', '{}', {}, {}, {}, {})        "
+                 ).format(model_timestamp, model_type,
+                    json.dumps(hyperparameters), rung, numfolds, auc,
+                    promoted)
+        with self.safe_session() as session:
+            session.execute(query)
+
     def save_fold_of_model(self, eval_metrics, model_timestamp, fold_timestamp):
         query = ("INSERT INTO models.undefended_frontpage_folds    "
                  "(model_timestamp, fold_timestamp, {}) VALUES     "
@@ -274,3 +480,177 @@ class ModelStorage(Database):
                     self.metric_formatter(eval_metrics)))
         with self.safe_session() as session:
             session.execute(query)
+
+    def save_base_rate_metrics(self, base_rate_metrics, model_timestamp,
+                               fold_timestamp):
+        """Save the output of evaluation.get_base_rate_metrics for a
+        fold."""
+        values = ', '.join(
+            "('{}', '{}', {}, {}, {}, {}, {})".format(
+                model_timestamp, fold_timestamp, row['base_rate'],
+                row['x_proportion'], row['precision'], row['recall'],
+                row['f1'])
+            for row in base_rate_metrics)
+        query = ("INSERT INTO models.undefended_frontpage_base_rates   "
+                 "(model_timestamp, fold_timestamp, base_rate,         "
+                 "x_proportion, precision, recall, f1) VALUES {}       "
+                 ).format(values)
+        with self.safe_session() as session:
+            session.execute(query)
+
+    def save_fold_predictions(self, model_timestamp, fold_timestamp, fold,
+                              path, n_examples, calibrated_scores):
+        """Register the file the predictions of a fold were stored in (see
+        classify.PredictionStore)."""
+        query = ("INSERT INTO models.undefended_frontpage_predictions "
+                 "(model_timestamp, fold_timestamp, fold, path,        "
+                 "n_examples, calibrated_scores)                       "
+                 "VALUES ('{}', '{}', {}, '{}', {}, {})                "
+                 ).format(model_timestamp, fold_timestamp, fold, path,
+                    n_examples, calibrated_scores)
+        with self.safe_session() as session:
+            session.execute(query)
+
+    def get_fold_predictions(self, model_timestamps=None):
+        """Get the stored predictions of every fold of the given models
+        (default: of all models).
+
+        :returns: a pandas DataFrame with the model_timestamp, fold, path,
+                  n_examples, and calibrated_scores of each fold
+        """
+        query = ("SELECT model_timestamp, fold, path, n_examples,      "
+                 "calibrated_scores                                    "
+                 "FROM models.undefended_frontpage_predictions         ")
+        if model_timestamps is not None:
+            query += "WHERE model_timestamp IN ({}) ".format(
+                ', '.join("'{}'".format(model_timestamp)
+                          for model_timestamp in model_timestamps))
+        query += "ORDER BY model_timestamp, fold"
+        return pd.read_sql(query, self.engine)
+
+
+class ExperimentQueue(Database):
+    """A queue of attack experiments in the models.experiment_queue table,
+    shared by workers on any number of hosts.
+
+    Jobs belong to a sweep (e.g., one attack.yaml). A worker claims a job by
+    locking its row with FOR UPDATE SKIP LOCKED, so concurrent workers never
+    claim the same job or wait on each other, and holds a lease on it that it
+    renews with heartbeat(). Jobs whose lease hasn't been renewed in
+    lease_timeout seconds (e.g., because their worker died) are handed out
+    again, up to max_attempts times in all, after which they are marked
+    failed.
+    """
+    def __init__(self, lease_timeout=600, max_attempts=3, **kwargs):
+        super().__init__(**kwargs)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+    def enqueue(self, sweep, jobs):
+        """Add jobs (dicts with the keys model_timestamp, model_type,
+        hyperparameters, and options) to a sweep. Jobs already in the sweep
+        are left alone, so a sweep can safely be enqueued more than once.
+
+        :returns: the number of jobs added
+        """
+        rows = [dict(job, sweep=sweep,
+                     hyperparameters=json.dumps(job['hyperparameters'],
+                                                sort_keys=True),
+                     options=json.dumps(job['options'], sort_keys=True))
+                for job in jobs]
+        if not rows:
+            return 0
+        with self.safe_session() as session:
+            result = session.execute(text(
+                "INSERT INTO models.experiment_queue "
+                "(sweep, model_timestamp, model_type, hyperparameters, options) "
+                "VALUES (:sweep, :model_timestamp, :model_type, "
+                "CAST(:hyperparameters AS JSONB), CAST(:options AS JSONB)) "
+                "ON CONFLICT (sweep, model_type, hyperparameters) DO NOTHING"),
+                rows)
+            return result.rowcount
+
+    def claim(self, sweep, worker):
+        """Claim the next pending (or abandoned) job of a sweep for worker.
+
+        :returns: a dict describing the job, or None if there is none left to
+                  claim
+        """
+        with self.safe_session() as session:
+            # Abandoned jobs that have used up their attempts won't be
+            # handed out again
+            session.execute(text(
+                "UPDATE models.experiment_queue SET status = 'failed', "
+                "t_finished = now(), error = 'Lease expired on the last "
+                "attempt' WHERE sweep = :sweep AND status = 'running' "
+                "AND attempts >= :max_attempts "
+                "AND t_heartbeat < now() - :lease_timeout * interval '1 second'"),
+                {'sweep': sweep, 'max_attempts': self.max_attempts,
+                 'lease_timeout': self.lease_timeout})
+            row = session.execute(text(
+                "UPDATE models.experiment_queue SET status = 'running', "
+                "worker = :worker, attempts = attempts + 1, "
+                "t_claimed = now(), t_heartbeat = now() "
+                "WHERE jobid = (SELECT jobid FROM models.experiment_queue "
+                "WHERE sweep = :sweep AND attempts < :max_attempts "
+                "AND (status = 'pending' OR (status = 'running' AND "
+                "t_heartbeat < now() - :lease_timeout * interval '1 second')) "
+                "ORDER BY jobid LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                "RETURNING jobid, model_timestamp, model_type, "
+                "hyperparameters, options"),
+                {'sweep': sweep, 'worker': worker,
+                 'max_attempts': self.max_attempts,
+                 'lease_timeout': self.lease_timeout}).first()
+        if row is None:
+            return None
+        return dict(row.items())
+
+    def heartbeat(self, jobids, worker):
+        """Renew worker's leases on jobids.
+
+        :returns: the jobids whose lease worker still holds
+        """
+        if not jobids:
+            return []
+        with self.safe_session() as session:
+            rows = session.execute(text(
+                "UPDATE models.experiment_queue SET t_heartbeat = now() "
+                "WHERE jobid = ANY(:jobids) AND worker = :worker "
+                "AND status = 'running' RETURNING jobid"),
+                {'jobids': list(jobids), 'worker': worker})
+            return [row.jobid for row in rows]
+
+    def finish(self, jobid, worker):
+        """Record that a job is done, if worker still holds its lease.
+
+        :returns: whether worker still held the lease (if not, the job has
+                  been handed out to another worker, or marked failed)
+        """
+        with self.safe_session() as session:
+            result = session.execute(text(
+                "UPDATE models.experiment_queue SET status = 'done', "
+                "t_finished = now(), error = NULL "
+                "WHERE jobid = :jobid AND worker = :worker "
+                "AND status = 'running'"),
+                {'jobid': jobid, 'worker': worker})
+            return result.rowcount == 1
+
+    def fail(self, jobid, worker, error):
+        """Record that a job failed, putting it back in the queue unless it
+        has used up its attempts."""
+        with self.safe_session() as session:
+            session.execute(text(
+                "UPDATE models.experiment_queue SET status = CASE WHEN "
+                "attempts < :max_attempts THEN 'pending' ELSE 'failed' END, "
+                "t_finished = now(), error = :error "
+                "WHERE jobid = :jobid AND worker = :worker"),
+                {'jobid': jobid, 'worker': worker, 'error': error,
+                 'max_attempts': self.max_attempts})
+
+    def count_unfinished(self, sweep):
+        """The number of jobs of a sweep that are pending or running."""
+        with self.safe_session() as session:
+            return session.execute(text(
+                "SELECT count(*) FROM models.experiment_queue "
+                "WHERE sweep = :sweep AND status IN ('pending', 'running')"),
+                {'sweep': sweep}).scalar()
@@ -32,9 +32,10 @@ def get_metrics(truth, predicted):
     eval_metrics["recall"] = {}  # TODO
     eval_metrics["f1"] = {}  # TODO
 
-    for threshold in THRESHOLDS:
-        precision, recall, f1 = precision_recall_at_x_proportion(truth,
-            predicted, x_proportion=threshold/100)
+    precisions, recalls, f1s = precision_recall_at_x_proportions(truth,
+        predicted, [threshold/100 for threshold in THRESHOLDS])
+    for threshold, precision, recall, f1 in zip(THRESHOLDS, precisions,
+                                                recalls, f1s):
         eval_metrics.update({threshold: {'precision': precision, 
                                          'recall': recall,
                                          'f1': f1}})
@@ -86,19 +87,60 @@ def precision_recall_at_x_proportion(test_labels, test_predictions, x_proportion
     :returns float f1: 
     """
 
-    cutoff_index = int(len(test_predictions) * x_proportion)
-    cutoff_index = min(cutoff_index, len(test_predictions) - 1)
+    precision, recall, f1, cutoff_probability = \
+        precision_recall_at_x_proportions(test_labels, test_predictions,
+                                          [x_proportion], return_cutoff=True)
+    precision, recall, f1 = precision[0], recall[0], f1[0]
 
-    sorted_by_probability = np.sort(test_predictions)[::-1]
-    cutoff_probability = sorted_by_probability[cutoff_index]
+    if return_cutoff:
+        return precision, recall, f1, cutoff_probability[0]
+    else:
+        return precision, recall, f1
 
-    test_predictions_binary = [1 if x > cutoff_probability else 0 for x in test_predictions]
 
-    precision, recall, f1, _ = metrics.precision_recall_fscore_support(
-        test_labels, test_predictions_binary)
+def precision_recall_at_x_proportions(test_labels, test_predictions,
+                                      x_proportions, return_cutoff=False):
+    """Compute precision, recall, F1 at any number of fractions of the test
+    set at once. Equivalent to calling precision_recall_at_x_proportion for
+    each fraction, but sorts the predictions only once and reads the true
+    positives flagged at each cutoff off their cumulative sum.
 
-    # Only interested in metrics for label 1
-    precision, recall, f1 = precision[1], recall[1], f1[1]
+    As there, the test set is cut off at the prediction ranked at the given
+    fraction, and only predictions strictly above it are flagged.
+
+    :params list test_labels: true labels on test set
+    :params list test_predictions: predicted scores on test set
+    :params list x_proportions: proportions of the test set to flag
+    :params bool return_cutoff: if True also return the cutoff scores
+    :returns ndarray precision: fraction correctly flagged at each proportion
+    :returns ndarray recall: fraction of the positive class recovered at each
+                             proportion
+    :returns ndarray f1:
+    """
+
+    test_labels = np.asarray(test_labels) == 1
+    test_predictions = np.asarray(test_predictions)
+    x_proportions = np.asarray(x_proportions, dtype=float)
+    n = len(test_predictions)
+
+    order = np.argsort(-test_predictions, kind='mergesort')
+    sorted_predictions = test_predictions[order]
+    true_positives = np.concatenate(([0], np.cumsum(test_labels[order])))
+
+    cutoff_index = np.minimum((n * x_proportions).astype(int), n - 1)
+    cutoff_probability = sorted_predictions[cutoff_index]
+    # The number of predictions strictly greater than each cutoff
+    n_flagged = np.searchsorted(-sorted_predictions, -cutoff_probability,
+                                side='left')
+    n_true_positives = true_positives[n_flagged]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(n_flagged > 0,
+                             n_true_positives / n_flagged, 0.)
+        recall = np.where(true_positives[-1] > 0,
+                          n_true_positives / true_positives[-1], 0.)
+        f1 = np.where(precision + recall > 0,
+                      2 * precision * recall / (precision + recall), 0.)
 
     if return_cutoff:
         return precision, recall, f1, cutoff_probability
@@ -106,6 +148,96 @@ def precision_recall_at_x_proportion(test_labels, test_predictions, x_proportion
         return precision, recall, f1
 
 
+def get_base_rate_metrics(truth, predicted, base_rates):
+    """Compute precision, recall, and F1 at each of our thresholds, as if
+    the positive class made up each of the given base rates of the test set.
+
+    Args:
+        truth [list]: List of labels
+        predicted [list]: List of predicted scores
+        base_rates [list]: fractions of the population in the positive class
+
+    Returns:
+        base_rate_metrics [list of dicts]: the base_rate, x_proportion,
+                                           precision, recall, and f1 of each
+                                           base rate and threshold
+    """
+
+    x_proportions = [threshold/100 for threshold in THRESHOLDS]
+    precisions, recalls, f1s = precision_recall_at_base_rates(
+        truth, predicted, base_rates, x_proportions)
+    return [{'base_rate': base_rate, 'x_proportion': x_proportion,
+             'precision': precisions[i, j], 'recall': recalls[i, j],
+             'f1': f1s[i, j]}
+            for i, base_rate in enumerate(base_rates)
+            for j, x_proportion in enumerate(x_proportions)]
+
+
+def precision_recall_at_base_rates(test_labels, test_predictions, base_rates,
+                                   x_proportions):
+    """Compute precision, recall, F1 at fractions of the test set, with the
+    test set re-weighted so that the positive class makes up each of the given
+    base rates of it. This estimates how an attack would do on a population
+    with far fewer (or more) positives than the test set without building a
+    dataset for each base rate.
+
+    Positives are weighted by base_rate / n_positives and negatives by
+    (1 - base_rate) / n_negatives. Like precision_recall_at_x_proportions,
+    which this reproduces when the base rate is that of the test set, ties are
+    never split: at each proportion, only the predictions strictly above the
+    cutoff are flagged. The predictions are sorted once for all base rates and
+    proportions.
+
+    :params list test_labels: true labels on test set
+    :params list test_predictions: predicted scores on test set
+    :params list base_rates: fractions of the population in the positive class
+    :params list x_proportions: proportions of the population to flag
+    :returns ndarray precision: fraction correctly flagged, with a row for
+                                each base rate and a column for each
+                                proportion
+    :returns ndarray recall: fraction of the positive class recovered
+    :returns ndarray f1:
+    """
+
+    test_labels = np.asarray(test_labels) == 1
+    test_predictions = np.asarray(test_predictions)
+    base_rates = np.asarray(base_rates, dtype=float)[:, np.newaxis]
+    x_proportions = np.asarray(x_proportions, dtype=float)
+    n = len(test_predictions)
+
+    order = np.argsort(-test_predictions, kind='mergesort')
+    sorted_predictions = test_predictions[order]
+    true_positives = np.concatenate(([0], np.cumsum(test_labels[order])))
+    false_positives = np.arange(n + 1) - true_positives
+    # Only flag whole groups of tied predictions: cut the sorted predictions
+    # where they change, leaving out the cut after the last one (as
+    # precision_recall_at_x_proportions never flags everything)
+    cuts = np.flatnonzero(np.concatenate(
+        ([True], sorted_predictions[1:] != sorted_predictions[:-1])))
+    n_positive, n_negative = true_positives[-1], false_positives[-1]
+    tpr = true_positives[cuts] / max(n_positive, 1)
+    fpr = false_positives[cuts] / max(n_negative, 1)
+
+    # The weighted fraction of the population flagged at each cut, which
+    # grows along each row
+    flagged = base_rates * tpr + (1 - base_rates) * fpr
+    # The last cut at which at most each proportion is flagged (with some
+    # slack for rounding, so the test set's own base rate gives the same cuts
+    # as precision_recall_at_x_proportions)
+    cut_index = np.array([np.searchsorted(row, x_proportions * (1 + 1e-9),
+                                          side='right') - 1
+                          for row in flagged])
+    rows = np.arange(len(base_rates))[:, np.newaxis]
+    flagged = flagged[rows, cut_index]
+    recall = tpr[cut_index]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(flagged > 0, base_rates * recall / flagged, 0.)
+        f1 = np.where(precision + recall > 0,
+                      2 * precision * recall / (precision + recall), 0.)
+    return precision, recall, f1
+
+
 def plot_ROC(test_labels, test_predictions):
     fpr, tpr, thresholds = metrics.roc_curve(
         test_labels, test_predictions, pos_label=1)
@@ -124,7 +256,7 @@ def plot_ROC(test_labels, test_predictions):
     return fig
 
 
-def plot_allkfolds_ROC(timestamp, cv, fpr_arr, tpr_arr):
+def plot_allkfolds_ROC(timestamp, fpr_arr, tpr_arr):
 
     sns.set(style="white", palette="muted", color_codes=True)
 
@@ -134,17 +266,17 @@ def plot_allkfolds_ROC(timestamp, cv, fpr_arr, tpr_arr):
     bins_roc = np.linspace(0, 1, 300)
     with plt.style.context(('seaborn-muted')):
         fig, ax = plt.subplots(figsize=(10, 8))
-        for i, (train, test) in enumerate(cv):
-            mean_tpr += interp(bins_roc, fpr_arr[i], tpr_arr[i])
+        for i, (fpr, tpr) in enumerate(zip(fpr_arr, tpr_arr)):
+            mean_tpr += interp(bins_roc, fpr, tpr)
             mean_tpr[0] = 0.0
-            mean_fpr += interp(bins_roc, fpr_arr[i], tpr_arr[i])
+            mean_fpr += interp(bins_roc, fpr, tpr)
             mean_fpr[0] = 0.0
-            roc_auc = metrics.auc(fpr_arr[i], tpr_arr[i])
+            roc_auc = metrics.auc(fpr, tpr)
             all_roc_auc.append(roc_auc)
-            ax.plot(fpr_arr[i], tpr_arr[i], lw=1, label='KFold %d (AUC = %0.2f)' % (i, roc_auc))
+            ax.plot(fpr, tpr, lw=1, label='KFold %d (AUC = %0.2f)' % (i, roc_auc))
         ax.plot([0, 1], [0, 1], '--', color=(0.6, 0.6, 0.6), label='Random')
 
-        mean_tpr /= len(cv)
+        mean_tpr /= len(fpr_arr)
         mean_tpr[-1] = 1.0
         mean_auc = np.mean(all_roc_auc)
         ax.plot(bins_roc, mean_tpr, 'k--',
@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+
+def weighted_l1_distances(a, b, weights, n_jobs=1, block_elements=2**22):
+    """Compute the weighted L1 distance between every row of a and every row
+    of b.
+
+    The distances are computed in tiles of rows of a and b, so that no more
+    than about block_elements differences are held in memory per thread at
+    once, and the tiles are spread over n_jobs threads (numpy releases the GIL
+    while it computes them). They are computed in the floating point type of a
+    and b, so float32 features take half the memory of float64 ones.
+
+    Args:
+        a [ndarray]: m x d matrix
+        b [ndarray]: n x d matrix
+        weights [ndarray]: weight of each of the d features
+        n_jobs [int]: number of threads to use
+        block_elements [int]: number of differences to compute at once
+
+    Returns:
+        distances [ndarray]: m x n matrix
+    """
+
+    a, b = _as_float(a), _as_float(b)
+    dtype = np.result_type(a, b)
+    weights = np.asarray(weights, dtype=dtype)
+    m, n, d = len(a), len(b), a.shape[1]
+    distances = np.empty((m, n), dtype=dtype)
+
+    # Tile b first, so that the distances from a single row of a to every row
+    # of b are still split between threads
+    b_block = max(1, min(n, block_elements // max(d, 1)))
+    a_block = max(1, block_elements // (b_block * max(d, 1)))
+    tiles = [(i, j) for i in range(0, m, a_block) for j in range(0, n, b_block)]
+
+    def compute_tile(tile):
+        i, j = tile
+        differences = np.abs(a[i:i + a_block, np.newaxis, :]
+                             - b[np.newaxis, j:j + b_block, :])
+        distances[i:i + a_block, j:j + b_block] = differences.dot(weights)
+
+    if n_jobs > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            list(executor.map(compute_tile, tiles))
+    else:
+        for tile in tiles:
+            compute_tile(tile)
+    return distances
+
+
+class WeightedKNN(BaseEstimator, ClassifierMixin):
+    """The k-nearest neighbors attack of Wang et al. ("Effective Attacks and
+    Provable Defenses for Website Fingerprinting", USENIX Security 2014), as
+    implemented by lib/knn.go, for our feature matrices.
+
+    Neighbors are found by a weighted L1 distance. The weights are learned on
+    the training set: for each of n_weight_points training points, rounds
+    times, the weights of the features that fail to bring the reco_points
+    nearest points of the same class closer than the nearest points of other
+    classes are reduced, and the weights of the other features increased.
+
+    Scores are the fraction of the n_neighbors nearest training points in the
+    positive class, so only points all of whose neighbors agree get the top
+    score, as with the consensus rule of the original attack. Test points are
+    scored in blocks, so only the distances from one block to the training
+    set are held in memory at once.
+
+    Args:
+        n_neighbors [int]: number of neighbors to classify by
+        reco_points [int]: number of neighbors of each class to learn weights
+                           from
+        rounds [int]: weight learning rounds per point
+        n_weight_points [int]: number of training points to learn weights
+                               from (default: all of them)
+        random_state [int]: seed of the initial weights and of the choice of
+                            weight learning points
+        n_jobs [int]: number of threads to compute distances with
+        block_elements [int]: see weighted_l1_distances; also the number of
+                              distances to the training set held in memory
+                              at once when scoring
+    """
+
+    def __init__(self, n_neighbors=2, reco_points=5, rounds=10,
+                 n_weight_points=None, random_state=0, n_jobs=1,
+                 block_elements=2**22):
+        self.n_neighbors = n_neighbors
+        self.reco_points = reco_points
+        self.rounds = rounds
+        self.n_weight_points = n_weight_points
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.block_elements = block_elements
+
+    def fit(self, X, y):
+        X = _as_float(X)
+        y = np.asarray(y)
+        self.classes_ = np.unique(y)
+        rng = np.random.RandomState(self.random_state)
+
+        weights = rng.rand(X.shape[1]) + 0.5
+        points = np.arange(len(X))
+        if self.n_weight_points is not None and self.n_weight_points < len(X):
+            points = rng.choice(points, self.n_weight_points, replace=False)
+        for i in points:
+            for _ in range(self.rounds):
+                self._update_weights(X, y, i, weights)
+            positive = weights > 0
+            weights[positive] *= 0.9 + rng.rand(positive.sum()) * 0.2
+
+        self.weights_ = weights
+        self._fit_X = X
+        self._fit_y = y
+        return self
+
+    def _update_weights(self, X, y, i, weights):
+        """One round of weight learning on training point i."""
+
+        distances = weighted_l1_distances(X[i:i + 1], X, weights,
+                                          self.n_jobs, self.block_elements)[0]
+        distances[i] = np.inf
+        same = np.flatnonzero(y == y[i])
+        other = np.flatnonzero(y != y[i])
+        same = same[same != i]
+        if not len(same) or not len(other):
+            return
+        good = _nearest(distances[same], self.reco_points, same)
+        bad = _nearest(distances[other], self.reco_points, other)
+
+        point_badness = (np.mean(distances[bad] <= distances[good].max())
+                         + 0.2)
+        max_good = np.abs(X[good] - X[i]).max(axis=0)
+        bad_differences = np.abs(X[bad] - X[i])
+        feature_distances = bad_differences.sum(axis=0)
+        # How many of the nearest points of other classes each feature fails
+        # to set further apart than the nearest points of the same class
+        n_bad = (bad_differences <= max_good).sum(axis=0)
+
+        worse = n_bad != n_bad.min()
+        change = (weights[worse] * 0.01 * n_bad[worse] / len(bad)
+                  * point_badness)
+        weights[worse] -= change
+        better = ~worse & (weights > 0)
+        total_feature_distance = feature_distances[better].sum()
+        if total_feature_distance > 0:
+            weights[better] += ((change * feature_distances[worse]).sum()
+                                / total_feature_distance)
+
+    def predict_proba(self, X):
+        X = _as_float(X)
+        n_train = len(self._fit_X)
+        n_neighbors = min(self.n_neighbors, n_train)
+        block = max(1, self.block_elements // n_train)
+        neighbors = np.empty((len(X), n_neighbors), dtype=int)
+        for i in range(0, len(X), block):
+            distances = weighted_l1_distances(X[i:i + block], self._fit_X,
+                                              self.weights_, self.n_jobs,
+                                              self.block_elements)
+            neighbors[i:i + block] = np.argpartition(
+                distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        neighbor_classes = self._fit_y[neighbors]
+        return np.column_stack([(neighbor_classes == label).mean(axis=1)
+                                for label in self.classes_])
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def _as_float(X):
+    """X as an array, keeping its floating point type (if any)."""
+    X = np.asarray(X)
+    if X.dtype.kind != 'f':
+        X = X.astype(float)
+    return X
+
+
+def _nearest(distances, k, indices):
+    """The indices of the (at most) k smallest distances."""
+    k = min(k, len(distances))
+    return indices[np.argpartition(distances, k - 1)[:k]]
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3.5
+"""Run the kNN attack of lib/knn.go on our dataset.
+
+lib/knn.go reads one feature file per instance from batch/ and has the size of
+its dataset compiled in. This exports the dataset into that layout, builds a
+copy of knn.go with its constants set to match, runs it, and saves the true
+positive and true negative rates it reports in
+models.undefended_frontpage_attacks.
+"""
+import argparse
+import datetime
+import multiprocessing
+import numpy as np
+import os
+from os.path import abspath, dirname, join
+import re
+import shutil
+import subprocess
+import tempfile
+
+import database
+from utils import panic
+
+_dir = dirname(abspath(__file__))
+_knn_go = join(_dir, "lib", "knn.go")
+
+# The directory knn.go reads its features from, relative to where it runs,
+# and the suffix of its feature files
+BATCH_DIR = "batch"
+FEATURE_SUFFIX = "s"
+
+
+def select_instances(df, site_num, train_num, test_num, open_test_num,
+                     seed=0):
+    """Choose the instances of the monitored sites (SecureDrop sites) and of
+    the open world that knn.go will be run on.
+
+    Args:
+        df [pandas DataFrame]: an open world dataset (with hs_url and is_sd
+                               columns, see DatasetLoader.load_world)
+        site_num [int]: maximum number of monitored sites
+        train_num, test_num [int]: number of instances of each monitored site
+                                   used for weight learning and for testing
+        open_test_num [int]: maximum number of open world instances
+        seed [int]: seed of the choice of open world instances
+
+    Returns:
+        monitored [list of pandas DataFrames]: the instances of each monitored
+                                               site
+        open_world [pandas DataFrame]: the open world instances
+    """
+
+    inst_num = train_num + test_num
+    is_sd = df['is_sd'].astype(bool)
+    monitored = [site for _, site in df[is_sd].groupby('hs_url')
+                 if len(site) >= inst_num]
+    monitored = [site.sort_values('exampleid').head(inst_num)
+                 for site in monitored[:site_num]]
+
+    unmonitored = df[~is_sd]
+    rng = np.random.RandomState(seed)
+    chosen = rng.choice(len(unmonitored), min(open_test_num, len(unmonitored)),
+                        replace=False)
+    open_world = unmonitored.iloc[np.sort(chosen)]
+    return monitored, open_world
+
+
+def format_features(row):
+    """Format a feature vector the way knn.go reads it: space-separated, with
+    missing features as 'X'."""
+    return ' '.join("'X'" if np.isnan(value) else repr(float(value))
+                    for value in row)
+
+
+def _write_feature_files(files):
+    """Pool worker: write a chunk of (path, feature vector) pairs."""
+    for path, row in files:
+        with open(path, 'w') as f:
+            f.write(format_features(row))
+    return len(files)
+
+
+def export_batch(batch_dir, monitored, open_world, feature_names,
+                 n_workers=None, chunk_size=500):
+    """Write the feature file of every instance into batch_dir, in parallel:
+    <site>-<instance>s for monitored instances, and <site>s for open world
+    instances (which knn.go treats as one site each)."""
+
+    files = []
+    for site, instances in enumerate(monitored):
+        for instance, row in enumerate(instances[feature_names].values):
+            files.append((join(batch_dir, '{}-{}{}'.format(
+                site, instance, FEATURE_SUFFIX)), row))
+    for site, row in enumerate(open_world[feature_names].values):
+        files.append((join(batch_dir, '{}{}'.format(site, FEATURE_SUFFIX)),
+                      row))
+
+    os.makedirs(batch_dir, exist_ok=True)
+    chunks = [files[i:i + chunk_size] for i in range(0, len(files),
+                                                     chunk_size)]
+    with multiprocessing.Pool(n_workers) as pool:
+        n_written = sum(pool.imap_unordered(_write_feature_files, chunks))
+    print("Exported {} feature files to {}".format(n_written, batch_dir))
+    return n_written
+
+
+def set_constants(source, constants):
+    """Replace the values of integer constants in the source of knn.go."""
+    for name, value in constants.items():
+        source, n = re.subn(r'(\b{}\s+int\s*=\s*)\d+'.format(name),
+                            r'\g<1>{}'.format(value), source)
+        if n != 1:
+            raise ValueError("Constant {} not found in knn.go".format(name))
+    return source
+
+
+def build(build_dir, constants):
+    """Build a copy of knn.go with the given constants.
+
+    Returns:
+        binary [string]: path to the built binary
+    """
+
+    with open(_knn_go) as f:
+        source = set_constants(f.read(), constants)
+    with open(join(build_dir, 'knn.go'), 'w') as f:
+        f.write(source)
+    binary = join(build_dir, 'knn')
+    subprocess.check_call(['go', 'build', '-o', binary, 'knn.go'],
+                          cwd=build_dir)
+    return binary
+
+
+def parse_accuracy(output):
+    """Parse the true positive and true negative rates from the log output
+    of knn.go.
+
+    >>> parse_accuracy('2017/03/01 12:00:00 Accuracy: 0.850000 0.990000')
+    (0.85, 0.99)
+    """
+
+    match = re.search(r'Accuracy: (\S+) (\S+)', output)
+    if match is None:
+        raise ValueError("No accuracy in knn.go output")
+    return float(match.group(1)), float(match.group(2))
+
+
+def run(site_num=100, train_num=60, test_num=30, open_test_num=9000,
+        rounds=10, neighbour_num=2, reco_points_num=5, seed=0, n_workers=None,
+        work_dir=None, keep_work_dir=False):
+    """Export the dataset, run knn.go on it, and save its results.
+
+    Returns:
+        tp, tn [floats]: the true positive and true negative rates
+    """
+
+    model_timestamp = datetime.datetime.now().isoformat()
+    db = database.DatasetLoader()
+    df = db.load_world('open')
+    feature_names = [column for column in df.columns
+                     if column not in ('exampleid', 'is_sd', 'hs_url')]
+    monitored, open_world = select_instances(df, site_num, train_num,
+                                             test_num, open_test_num, seed)
+    if not monitored:
+        panic("No monitored site has {} instances".format(train_num +
+                                                          test_num))
+
+    constants = {'SiteNum': len(monitored),
+                 'InstNum': train_num + test_num,
+                 'TrainNum': train_num,
+                 'TestNum': test_num,
+                 'OpenTestNum': len(open_world),
+                 'Rounds': rounds,
+                 'FeatNum': len(feature_names),
+                 'NeighbourNum': neighbour_num,
+                 'RecoPointsNum': reco_points_num}
+    print("Running knn.go with {}".format(constants))
+
+    run_dir = tempfile.mkdtemp(prefix='fpsd-knn-go-', dir=work_dir)
+    try:
+        export_batch(join(run_dir, BATCH_DIR), monitored, open_world,
+                     feature_names, n_workers)
+        binary = build(run_dir, constants)
+        # knn.go logs to stderr, and its progress to stdout
+        result = subprocess.run([binary], cwd=run_dir, check=True,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        tp, tn = parse_accuracy(result.stderr)
+    finally:
+        if keep_work_dir:
+            print("Kept knn.go inputs and outputs in {}".format(run_dir))
+        else:
+            shutil.rmtree(run_dir)
+
+    print("knn.go {}: TP rate {}, TN rate {}".format(model_timestamp, tp, tn))
+    database.ModelStorage().save_hard_decision_model(
+        tp, 1 - tn, model_timestamp,
+        {'numfolds': 1, 'world_type': 'open', 'model_type': 'knn.go',
+         'hyperparameters': constants})
+    return tp, tn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sites", type=int, default=100,
+                        help="maximum number of monitored sites")
+    parser.add_argument("--train-instances", type=int, default=60,
+                        help="instances of each monitored site to learn "
+                        "weights on")
+    parser.add_argument("--test-instances", type=int, default=30,
+                        help="instances of each monitored site to test on")
+    parser.add_argument("--open-instances", type=int, default=9000,
+                        help="maximum number of open world instances")
+    parser.add_argument("--rounds", type=int, default=10,
+                        help="weight learning rounds")
+    parser.add_argument("--neighbours", type=int, default=2,
+                        help="number of neighbours to classify by")
+    parser.add_argument("--reco-points", type=int, default=5,
+                        help="number of neighbours to learn weights from")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the choice of open world instances")
+    parser.add_argument("--workers", type=int,
+                        help="number of processes to export features with "
+                        "(default: one per core)")
+    parser.add_argument("--work-dir", type=str,
+                        help="where to export features and build knn.go "
+                        "(default: a temporary directory)")
+    parser.add_argument("--keep-work-dir", action="store_true",
+                        help="keep the exported features, weights, and "
+                        "logs of knn.go")
+    args = parser.parse_args()
+
+    run(site_num=args.sites, train_num=args.train_instances,
+        test_num=args.test_instances, open_test_num=args.open_instances,
+        rounds=args.rounds, neighbour_num=args.neighbours,
+        reco_points_num=args.reco_points, seed=args.seed,
+        n_workers=args.workers, work_dir=args.work_dir,
+        keep_work_dir=args.keep_work_dir)
@@ -5,7 +5,8 @@ import doctest
 import getpass
 import subprocess
 
-unit_tests = ['utils', 'database', 'features', 'evaluation']
+unit_tests = ['utils', 'database', 'features', 'evaluation', 'cell_log', 'sorter',
+              'classify', 'knn', 'knn_go']
 if getpass.getuser() != 'travis':
     #     # This test can take a long time because I've yet to implement my own
     #     # timeout function for page loads, and the selenium implementation is not
@@ -15,7 +16,7 @@ if getpass.getuser() != 'travis':
         subprocess.call('python3 -m pytest tests/test_{}.py'.format(unit_test),
                         shell=True)
 
-doctests = ['utils']
+doctests = ['utils', 'cell_log', 'knn_go']
 for doctest in doctests:
     subprocess.call('python3 -m doctest {}.py'.format(doctest),
                     shell=True)
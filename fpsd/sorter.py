@@ -10,27 +10,47 @@
 # `fpsd/logging/class-data_<timestamp>.pickle`. Either way, `fpsd/crawler.py`
 # has the utilities to fetch and operate on the data.
 
+import ast
 import asyncio
 from ast import literal_eval
 PYTHONASYNCIODEBUG = 1 # Enable asyncio debug mode
 import aiohttp
 import aiosocks
 from aiosocks.connector import SocksConnector
-from collections import OrderedDict
+import base64
+import binascii
+import codecs
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import os
 from os.path import abspath, dirname, join
 import pickle
 import random
 import re
+from statistics import median
 from stem.process import launch_tor_with_config
 import socket
 import ssl
+from tempfile import gettempdir
+from time import time
 
 from database import RawStorage
 from utils import (coalesce_ordered_dict, find_free_port, get_config,
-                   get_timestamp, setup_logging, symlink_cur_to_latest)
+                   get_lookback, get_timestamp, setup_logging,
+                   symlink_cur_to_latest)
 
 _repo_root = dirname(abspath(__file__))
 _log_dir = join(_repo_root, "logging")
+_sort_cache = join(_log_dir, "sort-cache.pickle")
+_onion_regex = re.compile("[0-9a-z]{16}\.onion")
+_onion_url_regex = re.compile("http://([0-9a-z]{16})\.onion")
+# The length of the longest match of _onion_regex
+_onion_length = 22
+# Smaller pages are classified on the event loop even with classify_workers:
+# sending them to a worker costs about as much as classifying them
+_offload_min_size = 64*1024
 
 # The Sorter handles most errors internally so the user does not have to worry
 # about exception handling
@@ -53,20 +73,736 @@ class SorterCertError(SorterLoggedError):
     """Raised when a SSL certificate fails to be validated. This is common in
     onionspace due to limited availability of CA certs."""
 
+class SorterNotModified(SorterException):
+    """Raised when a conditional request finds a page unchanged."""
+
 class SorterEmptyDirectoryError(SorterException):
     """Raised when a directory URL seems to load correctly, but contains no
     .onion links."""
 
 
+class ClassTests:
+    """The class tests used to sort onion services, compiled once.
+
+    Tests of the form ``'<substring>' in text`` (or ``not in``) are pulled out
+    of every class test and answered together by a single scan of the page
+    text, so the cost of sorting a page does not grow with the number of
+    classes. What remains of each class test is compiled to a code object
+    that is evaluated against the results of that scan.
+
+    :param dict class_tests: An ordered mapping of class names to boolean
+                             expressions operating on the HTML text of a page,
+                             ``text`` (see the `class_tests` option in
+                             fpsd.ini).
+    """
+    def __init__(self, class_tests):
+        self.class_tests = OrderedDict(class_tests)
+        self.substrings = []
+        self.code = OrderedDict()
+        # Class tests made up only of substring tests combined with and, or,
+        # and not can often be decided before the whole page has been seen
+        self.partial_tests = OrderedDict()
+        for class_name, class_test in self.class_tests.items():
+            tree = ast.parse(class_test.strip(), mode="eval")
+            tree = _SubstringTestTransformer(self.substrings).visit(tree)
+            self.code[class_name] = compile(ast.fix_missing_locations(tree),
+                                            "<{} class test>".format(class_name),
+                                            "eval")
+            try:
+                _evaluate_partially(tree.body, set())
+                self.partial_tests[class_name] = tree.body
+            except ValueError:
+                pass
+
+        # The zero-width lookahead lets us find substrings that overlap one
+        # another. Only one alternative can match at a given position, so we
+        # try the longest first and record any others it starts with as found
+        # too.
+        if self.substrings:
+            alternatives = sorted(self.substrings, key=len, reverse=True)
+            self.substring_regex = re.compile("(?=({}))".format(
+                "|".join(re.escape(x) for x in alternatives)))
+        else:
+            self.substring_regex = None
+        self.implied_substrings = {
+            x: [i for i, y in enumerate(self.substrings) if x.startswith(y)]
+            for x in self.substrings}
+
+
+    def __reduce__(self):
+        # Code objects can't be pickled, so recompile instead
+        return ClassTests, (self.class_tests,)
+
+
+    def find_substrings(self, text, found=None):
+        """Add the indices (into self.substrings) of all the substrings that
+        occur in text to the set found, and return it."""
+        found = set() if found is None else found
+        if not self.substring_regex:
+            return found
+        for match in self.substring_regex.finditer(text):
+            found.update(self.implied_substrings[match.group(1)])
+            if len(found) == len(self.substrings):
+                break
+        return found
+
+
+    def classify(self, text, found=None):
+        """Return the name of the first class whose test the page text
+        passes, or None if it passes none of them."""
+        if found is None:
+            found = self.find_substrings(text)
+        namespace = {"text": text, "_found": found}
+        for class_name, code in self.code.items():
+            if eval(code, globals(), namespace):
+                return class_name
+        return None
+
+
+    def decide(self, found):
+        """Try to sort a page having only seen part of it, given the set of
+        substrings found in it so far (see find_substrings). Returns a tuple
+        (True, class_name) once the class the whole page would be sorted into
+        is certain (class_name is None if it passes none of the class tests),
+        and (False, None) otherwise."""
+        for class_name in self.code:
+            if class_name not in self.partial_tests:
+                return False, None
+            passes = _evaluate_partially(self.partial_tests[class_name], found)
+            if passes is None:
+                return False, None
+            if passes:
+                return True, class_name
+        return True, None
+
+
+class ResponseScanner:
+    """Scans the body of a response as it is read in chunks, extracting
+    .onion addresses and/or sorting the page with a ClassTests object.
+    Matches that cross chunk boundaries are found by re-scanning the end of
+    the previous chunk.
+
+    :param ClassTests class_tests: The class tests to sort the page with.
+    :param bool find_onions: Whether to extract .onion addresses.
+    :param int max_size: Stop reading the body after this many bytes.
+    """
+    def __init__(self, class_tests=None, find_onions=False, max_size=None):
+        self.class_tests = class_tests
+        self.find_onions = find_onions
+        self.max_size = max_size
+
+        self.size = 0
+        self.onions = set()
+        self.found = set()
+        self.class_name = None
+        self.decided = False
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.digest = hashlib.sha1()
+
+        pattern_lengths = [_onion_length] if find_onions else []
+        if class_tests:
+            pattern_lengths += [len(x) for x in class_tests.substrings]
+        self.overlap = max(pattern_lengths + [1]) - 1
+        self.tail = ""
+        # Class tests that aren't made up only of substring tests need the
+        # full text of the page
+        if class_tests and len(class_tests.partial_tests) < len(class_tests.code):
+            self.text = []
+        else:
+            self.text = None
+
+
+    def set_encoding(self, encoding):
+        """Decode the body with the given encoding rather than UTF-8. Must
+        be called before the first chunk is fed."""
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding)(
+                errors="replace")
+        except (LookupError, TypeError):
+            pass
+
+
+    def feed(self, chunk):
+        """Scan the next chunk of the body. Returns True once reading more
+        of it would be pointless."""
+        self.size += len(chunk)
+        self.digest.update(chunk)
+        self.scan(self.decoder.decode(chunk))
+        if self.class_tests and not self.decided and not self.find_onions:
+            self.decided, self.class_name = self.class_tests.decide(self.found)
+        return (self.decided and not self.find_onions) or self.truncated
+
+
+    @property
+    def truncated(self):
+        """Whether reading stopped at max_size, before the end of the body
+        (possibly) had been seen."""
+        return bool(self.max_size and self.size >= self.max_size)
+
+
+    def scan(self, text):
+        window = self.tail + text
+        if self.class_tests:
+            self.class_tests.find_substrings(window, self.found)
+        if self.find_onions:
+            self.onions.update(_onion_regex.findall(window))
+        if self.text is not None:
+            self.text.append(text)
+        self.tail = window[-self.overlap:] if self.overlap else ""
+
+
+    @property
+    def body_hash(self):
+        """A hash of the part of the body that has been fed."""
+        return self.digest.hexdigest()
+
+
+    def close(self):
+        """Finish scanning once the body has been read, or reading has been
+        stopped early."""
+        self.scan(self.decoder.decode(b"", final=True))
+        if self.class_tests and not self.decided:
+            text = "".join(self.text) if self.text is not None else ""
+            self.class_name = self.class_tests.classify(text, self.found)
+            self.decided = True
+
+
+class _SubstringTestTransformer(ast.NodeTransformer):
+    """Rewrites ``'<substring>' in text`` (and ``not in``) as a test for
+    membership of the substring's index in the set ``_found``."""
+    def __init__(self, substrings):
+        self.substrings = substrings
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        substring = _literal(node.left)
+        if (not isinstance(substring, str) or len(node.ops) != 1
+                or not isinstance(node.ops[0], (ast.In, ast.NotIn))
+                or not isinstance(node.comparators[0], ast.Name)
+                or node.comparators[0].id != "text"):
+            return node
+        if substring not in self.substrings:
+            self.substrings.append(substring)
+        op = "in" if isinstance(node.ops[0], ast.In) else "not in"
+        membership_test = ast.parse("{} {} _found".format(
+            self.substrings.index(substring), op), mode="eval").body
+        return ast.copy_location(membership_test, node)
+
+
+def _evaluate_partially(node, found):
+    """Evaluate a class test rewritten by _SubstringTestTransformer, given
+    that the substrings in found occur in a page and that the others may or
+    may not. Returns True, False, or None if the result is still uncertain.
+    Raises ValueError for class tests that aren't made up only of substring
+    tests combined with and, or, and not."""
+    if isinstance(node, ast.BoolOp):
+        values = [_evaluate_partially(x, found) for x in node.values]
+        if isinstance(node.op, ast.And):
+            if any(x is False for x in values):
+                return False
+            return True if all(values) else None
+        if any(values):
+            return True
+        return False if all(x is False for x in values) else None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        value = _evaluate_partially(node.operand, found)
+        return None if value is None else not value
+    if isinstance(_literal(node), bool):
+        return _literal(node)
+    if (isinstance(node, ast.Compare) and isinstance(_literal(node.left), int)
+            and isinstance(node.comparators[0], ast.Name)
+            and node.comparators[0].id == "_found"):
+        # Once found, a substring is in the page for good, but we can't know
+        # it isn't until we've seen the whole page
+        if _literal(node.left) in found:
+            return isinstance(node.ops[0], ast.In)
+        return None
+    raise ValueError("Not a substring test: {}".format(ast.dump(node)))
+
+
+def _literal(node):
+    """Return the value of an AST node if it is a string, number, or
+    True/False/None literal, otherwise None."""
+    # Literals are parsed to ast.Str, ast.Num, and ast.NameConstant nodes
+    # before Python 3.8 and to ast.Constant nodes from then on
+    node_type = type(node).__name__
+    if node_type == "Str":
+        return node.s
+    if node_type == "Num":
+        return node.n
+    if node_type in ("NameConstant", "Constant"):
+        return node.value
+    return None
+
+
+class OnionSet:
+    """A set of onion service URLs compact enough to hold millions of them.
+
+    URLs of the form http://<onion address>.onion are stored as the 80-bit
+    values their onion addresses encode, bucketed by their first 16 bits into
+    bytearrays of the remaining 64 bits. Any other URLs are kept in a regular
+    set. Iterating yields URLs in the same form they were added in.
+    """
+    _prefix_bytes = 2
+    _suffix_bytes = 8
+
+    def __init__(self, onions=()):
+        self.buckets = [None] * 2**(8 * self._prefix_bytes)
+        self.other_urls = set()
+        self.size = 0
+        for onion in onions:
+            self.add(onion)
+
+
+    @staticmethod
+    def _digest(url):
+        match = _onion_url_regex.fullmatch(url)
+        if not match:
+            return None
+        try:
+            return base64.b32decode(match.group(1).upper())
+        except binascii.Error:
+            # Not a valid onion address, e.g., it contains 0, 1, 8, or 9
+            return None
+
+
+    def _find(self, digest):
+        """Return the bucket a digest belongs in and whether it is there."""
+        bucket = self.buckets[int.from_bytes(digest[:self._prefix_bytes],
+                                             "big")]
+        if bucket is None:
+            return None, False
+        suffix = digest[self._prefix_bytes:]
+        i = bucket.find(suffix)
+        while i != -1:
+            if i % self._suffix_bytes == 0:
+                return bucket, True
+            i = bucket.find(suffix, i + 1)
+        return bucket, False
+
+
+    def add(self, url):
+        """Add a URL to the set. Returns True if it was not already in it."""
+        digest = self._digest(url)
+        if digest is None:
+            if url in self.other_urls:
+                return False
+            self.other_urls.add(url)
+        else:
+            bucket, present = self._find(digest)
+            if present:
+                return False
+            if bucket is None:
+                bucket = bytearray()
+                self.buckets[int.from_bytes(digest[:self._prefix_bytes],
+                                            "big")] = bucket
+            bucket.extend(digest[self._prefix_bytes:])
+        self.size += 1
+        return True
+
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+
+    def __contains__(self, url):
+        digest = self._digest(url)
+        if digest is None:
+            return url in self.other_urls
+        return self._find(digest)[1]
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __iter__(self):
+        for prefix, bucket in enumerate(self.buckets):
+            if bucket is None:
+                continue
+            prefix = prefix.to_bytes(self._prefix_bytes, "big")
+            for i in range(0, len(bucket), self._suffix_bytes):
+                digest = prefix + bytes(bucket[i:i + self._suffix_bytes])
+                address = base64.b32encode(digest).decode().lower()
+                yield "http://{}.onion".format(address)
+        yield from self.other_urls
+
+
+class ConcurrencyController:
+    """Limits the number of fetches in progress at once. With adaptive=True,
+    the limit is tuned additive-increase/multiplicative-decrease style (as in
+    TCP congestion control) to what our tor circuits can carry.
+
+    The outcomes of fetches are collected in windows of window_size fetches.
+    After each window, the limit is multiplied by decrease_factor if more than
+    max_error_rate of the fetches timed out or failed to connect, or if their
+    median latency rose to more than max_latency_inflation times the lowest
+    median latency seen so far. Otherwise, the limit is increased by one.
+
+    Use as an asynchronous context manager around a fetch and report its
+    outcome with record().
+    """
+    def __init__(self, max_tasks, min_tasks=1, initial_tasks=None,
+                 adaptive=True, window_size=20, max_error_rate=0.2,
+                 max_latency_inflation=2.0, decrease_factor=0.5,
+                 logger=None):
+        self.max_tasks = max_tasks
+        self.min_tasks = min(min_tasks, max_tasks)
+        self.adaptive = adaptive
+        if not adaptive:
+            self.limit = max_tasks
+        elif initial_tasks:
+            self.limit = max(self.min_tasks, min(initial_tasks, max_tasks))
+        else:
+            self.limit = self.min_tasks
+        self.window_size = window_size
+        self.max_error_rate = max_error_rate
+        self.max_latency_inflation = max_latency_inflation
+        self.decrease_factor = decrease_factor
+        self.logger = logger
+
+        self.active = 0
+        self.outcomes = []
+        self.min_latency = None
+        self.slot_freed = asyncio.Condition()
+
+
+    async def __aenter__(self):
+        async with self.slot_freed:
+            while self.active >= int(self.limit):
+                await self.slot_freed.wait()
+            self.active += 1
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self.slot_freed:
+            self.active -= 1
+            self.slot_freed.notify_all()
+
+
+    def record(self, latency, error):
+        """Record the outcome of a fetch: how long it took, and whether it
+        failed in a way that suggests congestion."""
+        if not self.adaptive:
+            return
+        self.outcomes.append((latency, error))
+        if len(self.outcomes) < self.window_size:
+            return
+
+        error_rate = sum(1 for _, error in self.outcomes
+                         if error) / len(self.outcomes)
+        latencies = [latency for latency, error in self.outcomes if not error]
+        self.outcomes = []
+        latency = median(latencies) if latencies else None
+        if latency is not None:
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+
+        old_limit = int(self.limit)
+        if (error_rate > self.max_error_rate or
+                (latency is not None and self.min_latency and latency >
+                 self.max_latency_inflation * self.min_latency)):
+            self.limit = max(self.min_tasks,
+                             self.limit * self.decrease_factor)
+        else:
+            self.limit = min(self.max_tasks, self.limit + 1)
+
+        if self.logger and int(self.limit) != old_limit:
+            self.logger.info("Concurrency limit changed from {old_limit} to "
+                             "{} (error rate {error_rate:.2f}, median latency "
+                             "{latency}).".format(int(self.limit), **locals()))
+
+
+class SortCache:
+    """What we learned about each onion service the last time it was sorted:
+    the validators (ETag and Last-Modified header values) and a hash of its
+    response, the class it was sorted into, and when that class was last
+    saved (e.g., written to raw.hs_history). Kept in a pickle file between
+    runs.
+
+    Entries only hold for the class tests they were made with, so loading the
+    cache with different class tests starts over with an empty one.
+    """
+    def __init__(self, path, class_tests):
+        self.path = path
+        self.class_tests_key = repr(list(class_tests.class_tests.items()))
+        self.entries = {}
+        try:
+            with open(path, "rb") as fh:
+                cache = pickle.load(fh)
+            if cache["class_tests_key"] == self.class_tests_key:
+                self.entries = cache["entries"]
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            pass
+
+
+    def get(self, url):
+        return self.entries.get(url)
+
+
+    def subset(self, urls):
+        """Return a copy of the cache holding only the entries for urls
+        (e.g., for a shard of the onions to sort)."""
+        cache = SortCache.__new__(SortCache)
+        cache.path = self.path
+        cache.class_tests_key = self.class_tests_key
+        cache.entries = {url: self.entries[url] for url in urls
+                         if url in self.entries}
+        return cache
+
+
+    @staticmethod
+    def conditional_headers(entry):
+        """Return the headers for a conditional request revalidating a cache
+        entry."""
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+    def update(self, url, class_name, body_hash, etag=None,
+               last_modified=None):
+        """Record the outcome of sorting a freshly fetched page. If its class
+        has changed, it needs saving again."""
+        entry = self.entries.get(url)
+        if entry and entry["class_name"] == class_name:
+            t_saved = entry["t_saved"]
+        else:
+            t_saved = None
+        self.entries[url] = {"class_name": class_name,
+                             "body_hash": body_hash,
+                             "etag": etag,
+                             "last_modified": last_modified,
+                             "t_saved": t_saved}
+
+
+    def needs_saving(self, url, now, max_age):
+        """Whether the class of url has changed since it was last saved, or
+        was saved more than max_age seconds before now."""
+        entry = self.entries.get(url)
+        return (not entry or entry["t_saved"] is None
+                or now - entry["t_saved"] >= max_age)
+
+
+    def mark_saved(self, urls, now):
+        for url in urls:
+            if url in self.entries:
+                self.entries[url]["t_saved"] = now
+
+
+    def save(self):
+        # Write to a temporary file first so an interrupted save never leaves
+        # a partially written cache
+        tmp_path = "{}.{}".format(self.path, os.getpid())
+        with open(tmp_path, "wb") as fh:
+            pickle.dump({"class_tests_key": self.class_tests_key,
+                         "entries": self.entries}, fh)
+        os.replace(tmp_path, self.path)
+
+
+class TorInstance:
+    """A tor process with its own SOCKS port, data directory, and aiohttp
+    session, and a record of how fetches through it have gone."""
+    def __init__(self, torrc_config):
+        self.torrc_config = torrc_config
+        self.socks_port = int(torrc_config["SocksPort"])
+        self.process = None
+        self.session = None
+
+        self.active = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.disabled_until = None
+
+
+    def start(self, take_ownership=True, tor_cmd="tor"):
+        """Launch the tor process. Blocks until tor has bootstrapped.
+
+        stem times the launch out with SIGALRM, so this must be called from
+        the main thread."""
+        if "DataDirectory" in self.torrc_config:
+            os.makedirs(self.torrc_config["DataDirectory"], exist_ok=True)
+        self.process = launch_tor_with_config(config=self.torrc_config,
+                                              tor_cmd=tor_cmd,
+                                              take_ownership=take_ownership)
+
+
+    def open_session(self, loop):
+        onion_proxy = aiosocks.Socks5Addr('127.0.0.1', self.socks_port)
+        conn = SocksConnector(proxy=onion_proxy, remote_resolve=True)
+        # aiohttp's ClientSession does connection pooling and HTTP keep-alives
+        # for us
+        self.session = aiohttp.ClientSession(loop=loop, connector=conn)
+
+
+    def is_healthy(self, now):
+        return self.disabled_until is None or now >= self.disabled_until
+
+
+    def close(self):
+        if self.session:
+            self.session.close()
+        if self.process:
+            self.process.kill()
+
+
+class TorPool:
+    """Spreads fetches over a number of tor processes, so that no single tor
+    client has to build every circuit and look up every onion service
+    descriptor.
+
+    Each fetch goes to the healthy instance with the fewest fetches in
+    progress. An instance that fails max_consecutive_failures fetches in a row
+    (by timing out or failing to connect) is left out for cooldown seconds. If
+    every instance is cooling down, the one that will recover first is used.
+    """
+    def __init__(self, instances, max_consecutive_failures=5, cooldown=60,
+                 logger=None):
+        self.instances = list(instances)
+        self.max_consecutive_failures = max_consecutive_failures
+        self.cooldown = cooldown
+        self.logger = logger
+        self.next_index = 0
+
+
+    @classmethod
+    def launch(cls, size, torrc_config, socks_port, take_ownership=True,
+               loop=None, data_dir_prefix=None, logger=None, tor_cmd="tor",
+               **kwargs):
+        """Start size tor processes with torrc_config plus a SocksPort (and
+        ControlPort and DataDirectory, where needed) of their own. Instances
+        that fail to start are left out.
+
+        The processes are started one after another from the calling thread,
+        which must be the main thread: stem times each launch out with
+        SIGALRM, which is process-wide and can only be set from the main
+        thread.
+
+        With more than one instance, each needs its own DataDirectory. If
+        torrc_config doesn't set one, they are kept under data_dir_prefix
+        (persistently, so cached consensuses and descriptors speed up the next
+        bootstrap). Passing data_dir_prefix explicitly also gives a single
+        instance a DataDirectory of its own."""
+        separate_data_dirs = size > 1 or data_dir_prefix is not None
+        if data_dir_prefix is None:
+            data_dir_prefix = join(gettempdir(), "fpsd-sorter-tor")
+        used_ports = []
+        instances = []
+        for i in range(size):
+            config = dict(torrc_config)
+            config["SocksPort"] = str(find_free_port(socks_port + i,
+                                                     *used_ports))
+            used_ports.append(int(config["SocksPort"]))
+            if "ControlPort" in config:
+                config["ControlPort"] = str(find_free_port(
+                    int(config["ControlPort"]) + i, *used_ports))
+                used_ports.append(int(config["ControlPort"]))
+            if separate_data_dirs:
+                if "DataDirectory" in config:
+                    config["DataDirectory"] = join(config["DataDirectory"],
+                                                   str(i))
+                else:
+                    config["DataDirectory"] = "{}-{}".format(data_dir_prefix,
+                                                             i)
+            instances.append(TorInstance(config))
+
+        started = []
+        for instance in instances:
+            if logger:
+                logger.info("Starting tor process with config "
+                            "{instance.torrc_config}.".format(**locals()))
+            try:
+                instance.start(take_ownership, tor_cmd)
+            # stem raises OSError when tor is missing, exits, or times out
+            # while bootstrapping
+            except OSError as exc:
+                if logger:
+                    logger.warning("Tor process with config "
+                                   "{instance.torrc_config} failed to start: "
+                                   "{exc}".format(**locals()))
+                continue
+            started.append(instance)
+        instances = started
+        if not instances:
+            raise OSError("None of the {size} tor processes could be "
+                          "started.".format(**locals()))
+        for instance in instances:
+            instance.open_session(loop)
+        return cls(instances, logger=logger, **kwargs)
+
+
+    def acquire(self, now):
+        """Pick an instance for a fetch starting at time now. Release it with
+        release() once the fetch is over."""
+        healthy = [x for x in self.instances if x.is_healthy(now)]
+        if healthy:
+            # Rotate the starting point so ties don't all go to the first
+            # instance
+            start = self.next_index % len(healthy)
+            self.next_index += 1
+            candidates = healthy[start:] + healthy[:start]
+            instance = min(candidates, key=lambda x: x.active)
+        else:
+            instance = min(self.instances, key=lambda x: x.disabled_until)
+        instance.active += 1
+        return instance
+
+
+    def release(self, instance, error, now):
+        """Record the outcome of a fetch through instance, ending at time now:
+        whether it failed in a way that suggests the instance is in trouble."""
+        instance.active -= 1
+        if not error:
+            instance.successes += 1
+            instance.consecutive_failures = 0
+            return
+        instance.failures += 1
+        instance.consecutive_failures += 1
+        if instance.consecutive_failures >= self.max_consecutive_failures:
+            instance.consecutive_failures = 0
+            instance.disabled_until = now + self.cooldown
+            if self.logger:
+                self.logger.warning("Tor instance on SOCKS port "
+                                    "{instance.socks_port} failed "
+                                    "{self.max_consecutive_failures} fetches "
+                                    "in a row; leaving it out for "
+                                    "{self.cooldown}s.".format(**locals()))
+
+
+    def close(self):
+        for instance in self.instances:
+            instance.close()
+
+
 class Sorter:
     def __init__(self,
                  take_ownership=True, # Tor dies when the Sorter does
                  torrc_config={"ControlPort": "9051",
                                "CookieAuth": "1"},
                  socks_port=9050,
+                 tor_instances=1,
                  page_load_timeout=20,
                  max_tasks=10,
+                 adaptive_concurrency=False,
+                 min_tasks=1,
+                 stream_responses=False,
+                 max_response_size=2*1024**2,
+                 response_chunk_size=64*1024,
+                 use_sort_cache=False,
+                 sort_cache_max_age=7*24*3600,
+                 shards=1,
+                 classify_workers=0,
+                 tor_data_dir_prefix=None,
                  db_handler=None):
+        # Kept to create the Sorters of shards with
+        self.init_kwargs = {k: v for k, v in locals().items()
+                            if k not in ("self", "db_handler")}
 
         self.logger = setup_logging(_log_dir, "sorter")
         self.db_handler = db_handler
@@ -74,31 +810,59 @@ class Sorter:
         self.logger.info("Opening event loop for Sorter...")
         self.loop = asyncio.get_event_loop()
         self.max_tasks = max_tasks
+        # We always run max_tasks workers, but with adaptive concurrency,
+        # only as many of them fetch at once as the tor circuits can carry
+        self.concurrency = ConcurrencyController(max_tasks,
+                                                 min_tasks=min_tasks,
+                                                 adaptive=adaptive_concurrency,
+                                                 logger=self.logger)
         self.logger.info("Creating Sorter queue...")
         self.q = asyncio.Queue()
 
-        # Start tor and create an aiohttp tor connector
+        # Start tor_instances tor processes, each with an aiohttp session
+        # using it as a proxy, and spread fetches over them
         self.torrc_config = torrc_config
-        self.socks_port = str(find_free_port(socks_port))
-        self.torrc_config.update({"SocksPort": self.socks_port})
-        self.logger.info("Starting tor process with config "
-                         "{self.torrc_config}.".format(**locals()))
-        self.tor_process = launch_tor_with_config(config=self.torrc_config,
-                                                  take_ownership=take_ownership)
-        onion_proxy = aiosocks.Socks5Addr('127.0.0.1', socks_port)
-        conn = SocksConnector(proxy=onion_proxy, remote_resolve=True)
-
-        # aiohttp's ClientSession does connection pooling and HTTP keep-alives
-        # for us
-        self.logger.info("Creating aiohttp ClientSession with our event loop "
-                         "and tor proxy connector...")
-        self.session = aiohttp.ClientSession(loop=self.loop, connector=conn)
+        self.logger.info("Starting {tor_instances} tor process(es)...".format(
+            **locals()))
+        self.tor_pool = TorPool.launch(tor_instances, self.torrc_config,
+                                       socks_port,
+                                       take_ownership=take_ownership,
+                                       loop=self.loop,
+                                       data_dir_prefix=tor_data_dir_prefix,
+                                       logger=self.logger)
 
         # Pretend we're Tor Browser in order to get rejected by less sites/WAFs
         u = "Mozilla/5.0 (Windows NT 6.1; rv:45.0) Gecko/20100101 Firefox/45.0"
         self.headers = {'user-agent': u}
 
         self.page_load_timeout = page_load_timeout
+        # In streaming mode, response bodies are scanned as they are read,
+        # reading stops once a page has been sorted, and at most
+        # max_response_size bytes are read from any page being sorted
+        # (directories are read in full)
+        self.stream_responses = stream_responses
+        self.max_response_size = max_response_size
+        self.response_chunk_size = response_chunk_size
+        # With the sort cache, pages are re-requested conditionally, pages
+        # that haven't changed aren't classified again, and a class is only
+        # saved again when it changes or sort_cache_max_age seconds after it
+        # was last saved (which must stay below the crawler's
+        # hs_history_lookback)
+        self.use_sort_cache = use_sort_cache
+        self.sort_cache_max_age = sort_cache_max_age
+        self.sort_cache = None
+
+        # With shards > 1, sort_onions splits the onions between that many
+        # worker processes, each running a Sorter with its own event loop and
+        # tor processes. With classify_workers > 0, class tests and link
+        # extraction on large pages run in a process pool, rather than
+        # stalling the event loop.
+        self.shards = shards
+        if classify_workers:
+            self.classify_executor = ProcessPoolExecutor(
+                max_workers=classify_workers)
+        else:
+            self.classify_executor = None
 
 
     def __enter__(self):
@@ -115,15 +879,17 @@ class Sorter:
 
     def close(self):
         self.logger.info("Beginning the Sorter exit process...")
-        if "session" in dir(self):
-            self.logger.info("Closing out any lingering HTTP connections...")
-            self.session.close()
+        if getattr(self, "classify_executor", None):
+            self.logger.info("Shutting down the classification workers...")
+            self.classify_executor.shutdown()
+            self.classify_executor = None
+        if "tor_pool" in dir(self):
+            self.logger.info("Closing out any lingering HTTP connections and "
+                             "killing the Tor process(es)...")
+            self.tor_pool.close()
         if "loop" in dir(self):
             self.logger.info("Closing the event loop...")
             self.loop.close()
-        if "tor_process" in dir(self):
-            self.logger.info("Killing the Tor process...")
-            self.tor_process.kill()
         self.logger.info("Sorter exit complete.")
 
 
@@ -170,12 +936,7 @@ class Sorter:
             onion_dir = await self.q.get()
             self.onions.add(onion_dir)
             try:
-                response = await self.fetch(onion_dir)
-                self.logger.info("{onion_dir}: parsing hidden service links "
-                                 "on page...".format(**locals()))
-                onions = await self.parse_onion_links(response)
-                self.logger.info("{onion_dir}: found {} links on "
-                                 "page...".format(len(onions), **locals()))
+                onions = await self.scrape_onion_links(onion_dir)
                 self.onions.update(onions)
             except SorterLoggedError:
                 self.failed_onion_dirs.add(onion_dir)
@@ -195,15 +956,173 @@ class Sorter:
                 self.q.task_done()
 
 
-    async def fetch(self, url):
-        """Load a webpage and read return the body as plaintext."""
+    def discover_onions(self, onion_dirs, max_depth=2, max_pages=10000,
+                        frontier_size=1000):
+        """Like scrape_directories, but also scrapes the onion services
+        linked from the directories, those linked from them, and so on, up to
+        max_depth links away from the directory URLs (which are at depth 1).
+        At most max_pages pages are fetched. At most frontier_size pages wait
+        in the frontier queue at any time; pages discovered while it is full
+        wait in an overflow list until there is room, so none are lost.
+        Creates the self.onions attribute of the Sorter as an OnionSet."""
+        self.loop.run_until_complete(self._discover_onions(onion_dirs,
+                                                           max_depth,
+                                                           max_pages,
+                                                           frontier_size))
+
+
+    async def _discover_onions(self, onion_dirs, max_depth, max_pages,
+                               frontier_size):
+        self.onions = OnionSet()
+        self.failed_onion_dirs = set()
+        self.pages_queued = 0
+        self.pages_dropped = 0
+        self.frontier = asyncio.Queue(maxsize=frontier_size)
+        self.frontier_overflow = deque()
+
+        self.logger.info("Putting directory URLs {onion_dirs} in the "
+                         "frontier...".format(**locals()))
+        for onion_dir in onion_dirs:
+            if self.onions.add(onion_dir):
+                self.enqueue_page(onion_dir, 1, max_pages)
+
+        self.logger.info("Starting {self.max_tasks} workers discovering "
+                         ".onion URLs up to {max_depth} links away from the "
+                         "directory URLs...".format(**locals()))
+        workers = [asyncio.Task(self.discover_links(max_depth, max_pages))
+                   for _ in range(self.max_tasks)]
+
+        await self.frontier.join()
+
+        if self.failed_onion_dirs:
+            self.logger.info("Retrying directory URLs "
+                             "{self.failed_onion_dirs} unable to be "
+                             "processed on first "
+                             "attempt.".format(**locals()))
+            for failed_dir in list(self.failed_onion_dirs):
+                await self.frontier.put((failed_dir, 1))
+                self.pages_queued += 1
+
+        await self.frontier.join()
+        self.logger.info("Discovery completed after fetching "
+                         "{self.pages_queued} pages ({self.pages_dropped} "
+                         "pages were not fetched because the page budget "
+                         "was exhausted). {} unique .onion URLs have been "
+                         "stored.".format(len(self.onions), **locals()))
+        self.logger.info("Stopping all workers...")
+        for w in workers:
+            w.cancel()
+
+
+    def enqueue_page(self, url, depth, max_pages):
+        """Add a page to the discovery frontier (or, if it is full, to the
+        overflow list), unless max_pages pages have already been queued."""
+        if self.pages_queued >= max_pages:
+            self.pages_dropped += 1
+            return
+        self.pages_queued += 1
+        if self.frontier_overflow or self.frontier.full():
+            self.frontier_overflow.append((url, depth))
+        else:
+            self.frontier.put_nowait((url, depth))
+
+
+    def refill_frontier(self):
+        """Move pages from the overflow list into the frontier while there
+        is room."""
+        while self.frontier_overflow and not self.frontier.full():
+            self.frontier.put_nowait(self.frontier_overflow.popleft())
+
+
+    async def discover_links(self, max_depth, max_pages):
+        while True:
+            url, depth = await self.frontier.get()
+            try:
+                onions = await self.scrape_onion_links(url)
+                # Only follow links to onion services we haven't seen yet, so
+                # no page is fetched twice
+                new_onions = [x for x in onions if self.onions.add(x)]
+                if depth < max_depth:
+                    for onion in new_onions:
+                        self.enqueue_page(onion, depth + 1, max_pages)
+            except SorterLoggedError:
+                if depth == 1:
+                    self.failed_onion_dirs.add(url)
+            except SorterEmptyDirectoryError:
+                # Most onion services aren't directories, but the directory
+                # URLs are retried in case the page just didn't load properly
+                self.logger.info("{url}: no .onion links "
+                                 "found.".format(**locals()))
+                if depth == 1:
+                    self.failed_onion_dirs.add(url)
+            except:
+                self.logger.exception("{url}: unusual exception "
+                                      "encountered:".format(**locals()))
+                if depth == 1:
+                    self.failed_onion_dirs.add(url)
+            finally:
+                # Refill before marking this page done, so that the frontier
+                # can't be joined while pages are still waiting to go in
+                self.refill_frontier()
+                self.frontier.task_done()
+
+
+    async def scrape_onion_links(self, url):
+        """Fetch a page and return the set of .onion URLs linked from it."""
+        if self.stream_responses:
+            # Only the links found are kept, not the page, so directories are
+            # read in full rather than stopping at max_response_size (reading
+            # is still bounded by page_load_timeout)
+            scanner = ResponseScanner(find_onions=True)
+            await self.fetch(url, scanner)
+            onions = await self.parse_onion_links(scanner)
+        else:
+            response = await self.fetch(url)
+            self.logger.info("{url}: parsing hidden service links on "
+                             "page...".format(**locals()))
+            onions = await self.parse_onion_links(response)
+        self.logger.info("{url}: found {} links on page...".format(
+            len(onions), **locals()))
+        return onions
+
+
+    async def fetch(self, url, scanner=None, headers=None, validators=None):
+        """Load a webpage and read return the body as plaintext. If a
+        ResponseScanner is passed, the body is instead fed to it in chunks
+        (until it has seen enough), and the scanner is returned. Extra request
+        headers may be passed in headers. If a validators dict is passed, the
+        response's ETag and Last-Modified header values are stored in it."""
+        async with self.concurrency:
+            start_time = self.loop.time()
+            tor = self.tor_pool.acquire(start_time)
+            congestion_error = False
+            try:
+                return await self._fetch(url, scanner, tor.session,
+                                         headers, validators)
+            except (SorterTimeoutError, SorterConnectionError):
+                congestion_error = True
+                raise
+            finally:
+                end_time = self.loop.time()
+                self.tor_pool.release(tor, congestion_error, end_time)
+                self.concurrency.record(end_time - start_time,
+                                        congestion_error)
+
+
+    async def _fetch(self, url, scanner, session, headers=None,
+                     validators=None):
         self.logger.info("{url}: loading...".format(**locals()))
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
         try:
             with aiohttp.Timeout(self.page_load_timeout, loop=self.loop):
-                async with self.session.get(url,
-                                            allow_redirects=True,
-                                            headers=self.headers) as resp:
+                async with session.get(url,
+                                       allow_redirects=True,
+                                       headers=request_headers) as resp:
 
+                    if resp.status == 304 and headers:
+                        raise SorterNotModified
                     if resp.status != 200:
                         self.logger.warning("{url} was not reachable. HTTP "
                                             "error code {resp.status} was "
@@ -212,6 +1131,12 @@ class Sorter:
 
                     self.logger.info("{url}: loaded "
                                      "successfully.".format(**locals()))
+                    if validators is not None:
+                        validators["etag"] = resp.headers.get("ETag")
+                        validators["last_modified"] = resp.headers.get(
+                            "Last-Modified")
+                    if scanner:
+                        return await self.scan_response(resp, scanner)
                     return await resp.text()
         except asyncio.TimeoutError:
             self.logger.warning("{url}: timed out after "
@@ -238,10 +1163,33 @@ class Sorter:
             raise SorterCertError
 
 
+    async def scan_response(self, resp, scanner):
+        """Feed the body of a response to a ResponseScanner chunk by chunk,
+        stopping as soon as it has seen enough."""
+        scanner.set_encoding(resp.charset or "utf-8")
+        while True:
+            chunk = await resp.content.read(self.response_chunk_size)
+            if not chunk or scanner.feed(chunk):
+                break
+        if scanner.truncated and not scanner.decided:
+            self.logger.warning("{resp.url}: stopped reading after {} bytes "
+                                "(max_response_size); scanning only what was "
+                                "read.".format(scanner.size, **locals()))
+        scanner.close()
+        return scanner
+
+
     async def parse_onion_links(self, response):
-        """Find all .onion URLs in a webpage text."""
-        onion_regex = "[0-9a-z]{16}\.onion"
-        onions = re.findall(onion_regex, response)
+        """Find all .onion URLs in a webpage text (or return those found by
+        a ResponseScanner)."""
+        if isinstance(response, ResponseScanner):
+            onions = response.onions
+        elif (self.classify_executor
+              and len(response) >= _offload_min_size):
+            onions = await self.loop.run_in_executor(
+                self.classify_executor, _onion_regex.findall, response)
+        else:
+            onions = _onion_regex.findall(response)
         if not onions:
             raise SorterEmptyDirectoryError
         return set(["http://" + x for x in onions])
@@ -250,13 +1198,83 @@ class Sorter:
     def sort_onions(self, class_tests):
         """Sort the self.onions set of onion services into the sets defined by
         the keys of the class_tests dictionary using the tests given by the
-        associated values."""
-        self.loop.run_until_complete(self._sort_onions(class_tests))
+        associated values. class_tests may also be a ClassTests object."""
+        if not isinstance(class_tests, ClassTests):
+            class_tests = ClassTests(class_tests)
+        if self.use_sort_cache:
+            self.sort_cache = SortCache(_sort_cache, class_tests)
+            self.logger.info("Loaded {} entries from the sort "
+                             "cache.".format(len(self.sort_cache.entries)))
+        if self.shards > 1:
+            self.sort_shards(class_tests)
+        else:
+            self.loop.run_until_complete(self._sort_onions(class_tests))
+
+        if self.db_handler:
+            self.upload_onions()
+        else:
+            self.pickle_onions()
+        if self.sort_cache:
+            self.sort_cache.save()
+
+
+    def sort_shards(self, class_tests):
+        """Split self.onions into self.shards shards and sort each in a
+        worker process of its own, merging their results into
+        self.class_data and self.failed_onions."""
+        shards = [[] for _ in range(self.shards)]
+        for i, onion_service in enumerate(self.onions):
+            shards[i % self.shards].append(onion_service)
+
+        self.logger.info("Sorting {} onions in {self.shards} "
+                         "shards...".format(len(self.onions), **locals()))
+        self.class_data = OrderedDict()
+        for class_name in class_tests.class_tests.keys():
+            self.class_data[class_name] = set()
+        self.failed_onions = set()
+        with ProcessPoolExecutor(max_workers=self.shards) as executor:
+            futures = []
+            for i, shard in enumerate(shards):
+                if self.sort_cache:
+                    sort_cache = self.sort_cache.subset(shard)
+                else:
+                    sort_cache = None
+                futures.append(executor.submit(
+                    _sort_shard, shard, class_tests,
+                    self.shard_kwargs(i), sort_cache))
+            for i, future in enumerate(futures):
+                class_data, failed_onions, sort_cache = future.result()
+                self.logger.info("Shard {i} sorted {} onions.".format(
+                    sum(len(x) for x in class_data.values()), **locals()))
+                for class_name, class_urls in class_data.items():
+                    self.class_data[class_name].update(class_urls)
+                self.failed_onions.update(failed_onions)
+                if sort_cache:
+                    self.sort_cache.entries.update(sort_cache.entries)
+
+
+    def shard_kwargs(self, shard_index):
+        """Return the arguments to create the Sorter of a shard with. Each
+        shard gets its own range of ports and tor data directories, and
+        leaves saving results to us."""
+        kwargs = dict(self.init_kwargs)
+        kwargs.update(
+            torrc_config=dict(self.torrc_config),
+            socks_port=self.init_kwargs["socks_port"] + 100*(shard_index + 1),
+            tor_data_dir_prefix=join(gettempdir(),
+                                     "fpsd-sorter-tor-shard{}".format(
+                                         shard_index)),
+            use_sort_cache=False,
+            shards=1,
+            # Split the classification workers between the shards, rather
+            # than giving each shard a pool of its own of the full size
+            classify_workers=self.init_kwargs["classify_workers"] // self.shards)
+        return kwargs
 
 
     async def _sort_onions(self, class_tests):
         self.class_data = OrderedDict()
-        for class_name in class_tests.keys():
+        for class_name in class_tests.class_tests.keys():
             self.class_data[class_name] = set()
         self.failed_onions = set()
 
@@ -266,7 +1284,7 @@ class Sorter:
             self.q.put_nowait(onion_service)
 
         self.logger.info("Starting {self.max_tasks} workers sorting .onion "
-                         "URLs into the sets {}...".format(list(class_tests),
+                         "URLs into the sets {}...".format(list(self.class_data),
                                                           **locals()))
         workers = [asyncio.Task(self.sort_onion(class_tests)) for _ in range(self.max_tasks)]
 
@@ -285,24 +1303,17 @@ class Sorter:
         for w in workers:
             w.cancel()
 
-        if self.db_handler:
-            self.upload_onions()
-        else:
-            self.pickle_onions()
-
 
     async def sort_onion(self, class_tests):
         while True:
             onion_service = await self.q.get()
             try:
-                response = await self.fetch(onion_service)
-                for class_name, class_test in class_tests.items():
-                    lambda_fn = lambda text: eval(class_test)
-                    if lambda_fn(response):
-                        self.logger.info("{onion_service}: sorted into "
-                                         "{class_name}.".format(**locals()))
-                        self.class_data[class_name].add(onion_service)
-                        break
+                class_name = await self.classify_onion(onion_service,
+                                                       class_tests)
+                if class_name:
+                    self.logger.info("{onion_service}: sorted into "
+                                     "{class_name}.".format(**locals()))
+                    self.class_data[class_name].add(onion_service)
             except SorterLoggedError:
                 self.failed_onions.add(onion_service)
             except:
@@ -313,6 +1324,43 @@ class Sorter:
                 self.q.task_done()
 
 
+    async def classify_onion(self, onion_service, class_tests):
+        """Fetch an onion service and return the class it belongs in (or
+        None). With the sort cache, the page is requested conditionally, and
+        isn't classified again if it hasn't changed."""
+        cached = self.sort_cache.get(onion_service) if self.sort_cache else None
+        headers = SortCache.conditional_headers(cached)
+        validators = {}
+        try:
+            if self.stream_responses:
+                scanner = ResponseScanner(class_tests=class_tests,
+                                          max_size=self.max_response_size)
+                await self.fetch(onion_service, scanner, headers, validators)
+                class_name = scanner.class_name
+                body_hash = scanner.body_hash
+            else:
+                response = await self.fetch(onion_service, headers=headers,
+                                            validators=validators)
+                body_hash = hashlib.sha1(response.encode()).hexdigest()
+                if cached and cached["body_hash"] == body_hash:
+                    class_name = cached["class_name"]
+                elif (self.classify_executor
+                      and len(response) >= _offload_min_size):
+                    class_name = await self.loop.run_in_executor(
+                        self.classify_executor, _classify,
+                        tuple(class_tests.class_tests.items()), response)
+                else:
+                    class_name = class_tests.classify(response)
+        except SorterNotModified:
+            self.logger.info("{onion_service}: not modified since it was "
+                             "last sorted.".format(**locals()))
+            return cached["class_name"]
+        if self.sort_cache:
+            self.sort_cache.update(onion_service, class_name, body_hash,
+                                   **validators)
+        return class_name
+
+
     def pickle_onions(self):
         ts = get_timestamp("log")
         pickle_jar = join(_log_dir, "class-data_{}.pickle".format(ts))
@@ -324,8 +1372,50 @@ class Sorter:
 
 
     def upload_onions(self):
+        class_data = self.class_data
+        if self.sort_cache:
+            # Only save onions whose class changed or was last saved too long
+            # ago to still be within the crawler's lookback
+            now = time()
+            class_data = OrderedDict()
+            for class_name, class_urls in self.class_data.items():
+                class_data[class_name] = set(
+                    url for url in class_urls if self.sort_cache.needs_saving(
+                        url, now, self.sort_cache_max_age))
+            unchanged = (sum(len(x) for x in self.class_data.values()) -
+                         sum(len(x) for x in class_data.values()))
+            self.logger.info("Skipping {unchanged} onions whose class is "
+                             "unchanged.".format(**locals()))
         self.logger.info("Saving class data to database...")
-        self.db_handler.add_onions(self.class_data)
+        self.db_handler.add_onions(class_data, seen_urls=set().union(
+            *self.class_data.values()))
+        if self.sort_cache:
+            for class_urls in class_data.values():
+                self.sort_cache.mark_saved(class_urls, now)
+
+
+@lru_cache(maxsize=8)
+def _load_class_tests(class_tests):
+    return ClassTests(OrderedDict(class_tests))
+
+
+def _classify(class_tests, text):
+    """Classify text in a worker process. class_tests is passed as a tuple
+    of (class name, test) pairs, and compiled only once per worker."""
+    return _load_class_tests(class_tests).classify(text)
+
+
+def _sort_shard(onions, class_tests, sorter_kwargs, sort_cache=None):
+    """Sort a shard of onion services in a worker process, returning the
+    class data, the onions that couldn't be reached, and the updated sort
+    cache."""
+    # Don't reuse an event loop inherited from the parent process
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    with Sorter(**sorter_kwargs) as sorter:
+        sorter.onions = onions
+        sorter.sort_cache = sort_cache
+        sorter.loop.run_until_complete(sorter._sort_onions(class_tests))
+        return sorter.class_data, sorter.failed_onions, sort_cache
 
 
 def _securedrop_sort():
@@ -334,12 +1424,36 @@ def _securedrop_sort():
         fpdb = RawStorage()
     else:
         fpdb = None
-    class_tests = coalesce_ordered_dict(config["class_tests"])
+    class_tests = ClassTests(coalesce_ordered_dict(config["class_tests"]))
     
+    adaptive_concurrency = config.getboolean("adaptive_concurrency")
+    # max_tasks is a fixed number of connections, adaptive_max_tasks only
+    # an upper bound for the adaptive controller
+    if adaptive_concurrency:
+        max_tasks = config.getint("adaptive_max_tasks")
+    else:
+        max_tasks = config.getint("max_tasks")
+
     with Sorter(page_load_timeout=config.getint("page_load_timeout"),
-                max_tasks=config.getint("max_tasks"),
+                max_tasks=max_tasks,
+                tor_instances=config.getint("tor_instances"),
+                adaptive_concurrency=adaptive_concurrency,
+                min_tasks=config.getint("min_tasks"),
+                stream_responses=config.getboolean("stream_responses"),
+                max_response_size=config.getint("max_response_size"),
+                use_sort_cache=config.getboolean("use_sort_cache"),
+                sort_cache_max_age=get_lookback(
+                    config["sort_cache_max_age"]).total_seconds(),
+                shards=config.getint("shards"),
+                classify_workers=config.getint("classify_workers"),
                 db_handler=fpdb) as sorter:
-        sorter.scrape_directories(config["onion_dirs"].split(","))
+        if config.getint("discovery_depth") > 1:
+            sorter.discover_onions(config["onion_dirs"].split(","),
+                                   max_depth=config.getint("discovery_depth"),
+                                   max_pages=config.getint("max_discovery_pages"),
+                                   frontier_size=config.getint("discovery_frontier_size"))
+        else:
+            sorter.scrape_directories(config["onion_dirs"].split(","))
         sorter.sort_onions(class_tests)
 
 
@@ -0,0 +1,79 @@
+import os
+from os.path import exists, join
+import shutil
+import tempfile
+import unittest
+
+from cell_log import CellLog
+
+
+class CellLogTest(unittest.TestCase):
+    """Tests that positions in the cell log survive rotations and that the
+    rotated segments are kept in a bounded ring."""
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = join(self.log_dir, "tor_cell_seq.log")
+        self.cell_log = CellLog(self.path, max_bytes=10, backup_count=2)
+
+    def tearDown(self):
+        self.cell_log.close()
+        shutil.rmtree(self.log_dir)
+
+    def log_cells(self, cells):
+        # Mimic the patched tor, which re-opens the log for every cell
+        with open(self.path, "ab") as fh:
+            fh.write(cells)
+
+    def test_read_range(self):
+        self.log_cells(b"before")
+        start = self.cell_log.tell()
+        self.log_cells(b"trace")
+        end = self.cell_log.tell()
+        self.log_cells(b"after")
+        self.assertEqual(self.cell_log.read(start, end), b"trace")
+
+    def test_read_across_external_rotation(self):
+        start = self.cell_log.tell()
+        self.log_cells(b"first")
+        os.rename(self.path, self.path + ".old")
+        self.log_cells(b"second")
+        end = self.cell_log.tell()
+        self.assertGreater(end, start)
+        self.assertEqual(self.cell_log.read(start, end), b"firstsecond")
+
+    def test_release_rotates_into_bounded_ring(self):
+        for i in range(4):
+            start = self.cell_log.tell()
+            self.log_cells(b"0123456789")
+            end = self.cell_log.tell()
+            self.assertEqual(self.cell_log.read(start, end), b"0123456789")
+            self.cell_log.release(end)
+        self.assertTrue(exists(self.path + ".1"))
+        self.assertTrue(exists(self.path + ".2"))
+        self.assertFalse(exists(self.path + ".3"))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        # Rotated segments are only closed once released
+        self.cell_log.release(self.cell_log.tell())
+        self.assertEqual(len(self.cell_log.segments), 1)
+
+    def test_truncate_without_backups(self):
+        self.cell_log.backup_count = 0
+        self.log_cells(b"0123456789")
+        self.cell_log.release(self.cell_log.tell())
+        self.assertFalse(exists(self.path + ".1"))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        start = self.cell_log.tell()
+        self.log_cells(b"trace")
+        self.assertEqual(self.cell_log.read(start, self.cell_log.tell()),
+                         b"trace")
+
+    def test_iter_read_chunks(self):
+        start = self.cell_log.tell()
+        self.log_cells(b"abcdefg")
+        chunks = list(self.cell_log.iter_read(start, self.cell_log.tell(),
+                                              chunk_size=3))
+        self.assertEqual(chunks, [b"abc", b"def", b"g"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,422 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import database
+from classify import (DatasetCache, Experiment, ExperimentPool, FoldCache,
+                      PredictionStore, evaluate_warm_started,
+                      group_warm_start, impute_array, make_folds)
+
+
+class FoldCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(50, 4) * 10
+        self.y = np.array([0, 1] * 25)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_seeded_folds(self):
+        folds = make_folds(self.y, 5, seed=1)
+        again = make_folds(self.y, 5, seed=1)
+        for (train, test), (train_again, test_again) in zip(folds, again):
+            np.testing.assert_array_equal(test, test_again)
+        self.assertEqual(sorted(np.concatenate([t for _, t in folds])),
+                         list(range(50)))
+
+    def test_build_and_reuse(self):
+        cache = FoldCache.build(self.x, self.y, 5, cache_dir=self.cache_dir)
+        self.assertEqual(len(cache), 5)
+        x_train, y_train, x_test, y_test = cache.load_fold(0)
+        self.assertEqual(len(x_train) + len(x_test), 50)
+        self.assertEqual(len(y_train), len(x_train))
+        # Scaled with the training set's mean and standard deviation
+        np.testing.assert_allclose(x_train.mean(axis=0), 0, atol=1e-10)
+
+        again = FoldCache.build(self.x, self.y, 5, cache_dir=self.cache_dir)
+        self.assertEqual(again.directory, cache.directory)
+        other_seed = FoldCache.build(self.x, self.y, 5, seed=1,
+                                     cache_dir=self.cache_dir)
+        self.assertNotEqual(other_seed.directory, cache.directory)
+
+    def test_removes_other_versions(self):
+        old = FoldCache.build(self.x, self.y, 5, cache_dir=self.cache_dir,
+                              version='v1')
+        old_seed = FoldCache.build(self.x, self.y, 5, seed=1,
+                                   cache_dir=self.cache_dir, version='v1')
+        new = FoldCache.build(self.x, self.y, 5, cache_dir=self.cache_dir,
+                              version='v2')
+        self.assertFalse(os.path.isdir(old.directory))
+        self.assertTrue(os.path.isdir(old_seed.directory))
+        self.assertTrue(os.path.isdir(new.directory))
+
+    def test_open_world_folds(self):
+        rng = np.random.RandomState(0)
+        y = np.array([1] * 20 + [0] * 200)
+        groups = np.concatenate((np.zeros(20, dtype=int),
+                                 rng.randint(1, 41, size=200)))
+        folds = make_folds(y, 4, seed=0, world_type="open", groups=groups,
+                           observed_fraction=0.5)
+        self.assertEqual(len(folds), 4)
+        tested = []
+        for train, test in folds:
+            negative_train = set(groups[train][y[train] == 0])
+            negative_test = set(groups[test][y[test] == 0])
+            self.assertFalse(negative_train & negative_test)
+            self.assertEqual(len(negative_train),
+                             round(0.5 * (40 - len(negative_test))))
+            tested.extend(test)
+        # Every example is tested exactly once
+        self.assertEqual(sorted(tested), list(range(220)))
+        with self.assertRaises(ValueError):
+            make_folds(y, 4, world_type="open")
+
+        # Fewer unmonitored sites than folds: some folds have no training
+        # sites, and no fold observes more sites than it has
+        small_y = np.array([1] * 8 + [0] * 10)
+        for n_sites in (1, 2):
+            small_groups = np.concatenate(
+                (np.zeros(8, dtype=int), np.arange(10) % n_sites + 1))
+            for fraction in (0.1, 1.0, 2.0):
+                small_folds = make_folds(small_y, 4, world_type="open",
+                                         groups=small_groups,
+                                         observed_fraction=fraction)
+                self.assertEqual(len(small_folds), 4)
+                for train, test in small_folds:
+                    negative = small_y == 0
+                    negative_train = set(small_groups[train[negative[train]]])
+                    negative_test = set(small_groups[test[negative[test]]])
+                    self.assertFalse(negative_train & negative_test)
+                    n_training_sites = n_sites - len(negative_test)
+                    if fraction < 1:
+                        n_training_sites = min(1, n_training_sites)
+                    self.assertEqual(len(negative_train), n_training_sites)
+
+        # Experiments without a fold cache generate the same folds lazily
+        experiment = Experiment(model_timestamp="2017-03-01T00:00:00",
+                                world={"type": "open",
+                                       "observed_fraction": 0.5},
+                                model_type="GaussianNB", hyperparameters={},
+                                feature_scaling=False, k=4)
+        x = rng.rand(220, 2)
+        evaluated = list(experiment.iter_folds(x, y, folds=[3, 1],
+                                               groups=groups))
+        self.assertEqual([i for i, _, _ in evaluated], [1, 3])
+        for i, _, test in evaluated:
+            np.testing.assert_array_equal(test, folds[i][1])
+
+    def test_test_index(self):
+        cache = FoldCache.build(self.x, self.y, 5, cache_dir=self.cache_dir)
+        _, _, _, y_test = cache.load_fold(2)
+        test = cache.load_test_index(2)
+        np.testing.assert_array_equal(self.y[test], y_test)
+        np.testing.assert_array_equal(test, make_folds(self.y, 5)[2][1])
+
+
+class DatasetCacheTest(unittest.TestCase):
+    class FakeLoader:
+        """Stands in for a DatasetLoader."""
+        def __init__(self):
+            self.version, self.n_loads = 'v1', 0
+
+        def dataset_version(self):
+            return self.version
+
+        def load_arrays(self, world_type, dtype):
+            self.n_loads += 1
+            x = np.array([[1, np.nan], [3, 4]], dtype=dtype)
+            groups = (np.array(['a.onion', 'b.onion']) if world_type == 'open'
+                      else None)
+            return x, np.array([1, 0]), np.array([7, 8]), ['f1', 'f2'], groups
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = DatasetCache(self.cache_dir)
+        self.db = self.FakeLoader()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_load_once_per_version(self):
+        x, y, exampleids, feature_names, groups = self.cache.load(self.db,
+                                                                  'closed')
+        x, y, exampleids, feature_names, groups = self.cache.load(self.db,
+                                                                  'closed')
+        self.assertEqual(self.db.n_loads, 1)
+        self.assertEqual(x.dtype, np.float32)
+        self.assertIsInstance(x, np.memmap)
+        np.testing.assert_array_equal(exampleids, [7, 8])
+        self.assertEqual(feature_names, ['f1', 'f2'])
+        self.assertIsNone(groups)
+
+        # Imputing doesn't change the cache
+        impute_array(x)
+        self.assertEqual(x[0, 1], 0)
+        x, _, _, _, _ = self.cache.load(self.db, 'closed')
+        self.assertTrue(np.isnan(x[0, 1]))
+
+        _, _, _, _, groups = self.cache.load(self.db, 'open')
+        self.assertEqual(list(groups), ['a.onion', 'b.onion'])
+        self.assertEqual(self.db.n_loads, 2)
+
+    def test_new_version_replaces_old(self):
+        self.cache.load(self.db, 'closed')
+        self.db.version = 'v2'
+        self.cache.load(self.db, 'closed')
+        self.assertEqual(self.db.n_loads, 2)
+        self.assertEqual(os.listdir(self.cache_dir), ['v2_closed_float32'])
+
+
+class WarmStartTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        # Experiments pickle their trained models to the working directory
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def experiment(self, model_type, **hyperparameters):
+        return Experiment(model_timestamp="2017-03-01T00:00:00",
+                          world={"type": "closed", "observed_fraction": 0.2},
+                          model_type=model_type,
+                          hyperparameters=hyperparameters, n_cores=1, k=3)
+
+    def test_group_warm_start(self):
+        forests = [self.experiment("RandomForest", n_estimators=n,
+                                   max_depth=5, max_features="sqrt",
+                                   criterion="gini", min_samples_split=2)
+                   for n in (50, 10)]
+        deeper = self.experiment("RandomForest", n_estimators=10,
+                                 max_depth=10, max_features="sqrt",
+                                 criterion="gini", min_samples_split=2)
+        adaboost = [self.experiment("AdaBoost", n_estimators=n,
+                                    learning_rate=1, algorithm="SAMME")
+                    for n in (1, 10)]
+        groups = group_warm_start(forests + [deeper] + adaboost)
+        self.assertEqual([len(group) for group in groups], [2, 1, 1, 1])
+
+    def test_evaluate_warm_started(self):
+        rng = np.random.RandomState(0)
+        x = rng.rand(60, 3)
+        y = (x[:, 0] > 0.5).astype(int)
+        experiments = [self.experiment("ExtraTrees", n_estimators=n,
+                                       max_depth=3, max_features=None,
+                                       criterion="gini", min_samples_split=2)
+                       for n in (20, 5)]
+        fold_results = evaluate_warm_started(experiments, x, y)
+        self.assertEqual([[fold['fold'] for fold in results]
+                          for results in fold_results], [[0, 1, 2]] * 2)
+        self.assertEqual(len(os.listdir(self.work_dir)), 6)
+
+
+class PredictionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        self.store = PredictionStore(os.path.join(self.work_dir, "predictions"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_save_and_load(self):
+        path = self.store.save("2017-03-01T00:00:00", 3, [0, 1, 1],
+                               [0.25, 0.5, 2.0], exampleids=[7, 8, 9])
+        predictions = PredictionStore.load(path)
+        self.assertEqual(predictions['y_score'].dtype, np.float32)
+        np.testing.assert_array_equal(predictions['y_true'], [0, 1, 1])
+        np.testing.assert_array_equal(predictions['y_score'], [0.25, 0.5, 2])
+        np.testing.assert_array_equal(predictions['exampleids'], [7, 8, 9])
+        self.assertEqual(os.listdir(self.store.directory),
+                         [os.path.basename(path)])
+
+    def test_evaluate_all_folds(self):
+        rng = np.random.RandomState(0)
+        x = rng.rand(30, 2)
+        y = (x[:, 0] > 0.5).astype(int)
+        exampleids = np.arange(100, 130)
+        experiment = Experiment(model_timestamp="2017-03-01T00:00:00",
+                                world={"type": "closed",
+                                       "observed_fraction": 0.2},
+                                model_type="LogisticRegression",
+                                hyperparameters={"C_reg": 1,
+                                                 "penalty": "l2"},
+                                n_cores=1, k=3)
+        experiment.prediction_store = self.store
+        fold_results = experiment.evaluate_all_folds(x, y,
+                                                     exampleids=exampleids)
+        stored = [PredictionStore.load(fold['predictions'])
+                  for fold in fold_results]
+        self.assertEqual(sorted(np.concatenate(
+            [predictions['exampleids'] for predictions in stored])),
+            list(exampleids))
+        for predictions in stored:
+            np.testing.assert_array_equal(
+                predictions['y_true'], y[predictions['exampleids'] - 100])
+        self.assertNotIn('prediction_store', experiment.get_options())
+
+
+class ScoreTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(40, 2)
+        self.y = (self.x[:, 0] > 0.5).astype(int)
+
+    def experiment(self, calibrated_scores):
+        return Experiment(model_timestamp="2017-03-01T00:00:00",
+                          world={"type": "closed", "observed_fraction": 0.2},
+                          model_type="SVM",
+                          hyperparameters={"C_reg": 1, "kernel": "linear"},
+                          n_cores=1, calibrated_scores=calibrated_scores)
+
+    def test_rank_only_scores(self):
+        experiment = self.experiment(calibrated_scores=False)
+        model = experiment.train_single_fold(self.x, self.y)
+        self.assertFalse(model.probability)
+        scores = experiment.score(self.x, model)
+        np.testing.assert_array_equal(scores, model.decision_function(self.x))
+
+    def test_calibrated_scores(self):
+        experiment = self.experiment(calibrated_scores=True)
+        model = experiment.train_single_fold(self.x, self.y)
+        scores = experiment.score(self.x, model)
+        self.assertTrue(((scores >= 0) & (scores <= 1)).all())
+
+    def test_samme_scores(self):
+        class Model:
+            def decision_function(self, x):
+                return np.array([2., 1.])
+
+            def predict_proba(self, x):
+                return np.array([[0.5, 0.5], [0.2, 0.8]])
+
+        for algorithm, expected in (("SAMME", [0.5, 0.8]),
+                                    ("SAMME.R", [2., 1.])):
+            experiment = Experiment(
+                model_timestamp="2017-03-01T00:00:00",
+                world={"type": "closed", "observed_fraction": 0.2},
+                model_type="AdaBoost",
+                hyperparameters={"learning_rate": 1, "algorithm": algorithm,
+                                 "n_estimators": 5},
+                n_cores=1, calibrated_scores=False)
+            # With SAMME, decision_function is a weighted vote of hard
+            # predictions, so scores must come from predict_proba
+            np.testing.assert_array_equal(
+                experiment.score(self.x[:2], Model()), expected)
+
+
+class FakeModelStorage:
+    """Stands in for a database.ModelStorage, recording what is saved."""
+    saved = []
+
+    def __getattr__(self, name):
+        if not name.startswith('save_'):
+            raise AttributeError(name)
+        return lambda *args: self.saved.append((name, args))
+
+
+class FakeExperimentQueue:
+    """Stands in for a database.ExperimentQueue."""
+    def __init__(self, experiments):
+        self.jobs = {jobid: experiment.to_job()
+                     for jobid, experiment in enumerate(experiments)}
+        self.status = {jobid: 'pending' for jobid in self.jobs}
+
+    def claim(self, sweep, worker):
+        for jobid, status in self.status.items():
+            if status == 'pending':
+                self.status[jobid] = 'running'
+                return dict(self.jobs[jobid], jobid=jobid)
+
+    def heartbeat(self, jobids, worker):
+        return list(jobids)
+
+    def finish(self, jobid, worker):
+        self.status[jobid] = 'done'
+        return True
+
+    def fail(self, jobid, worker, error):
+        self.status[jobid] = 'failed'
+
+    def count_unfinished(self, sweep):
+        return sum(status in ('pending', 'running')
+                   for status in self.status.values())
+
+
+class SaveResultsTest(unittest.TestCase):
+    """Runs experiments end to end, saving their results in a
+    FakeModelStorage."""
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        # Trained models and ROC curves are saved in the working directory
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        patcher = mock.patch.object(database, 'ModelStorage',
+                                    FakeModelStorage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        FakeModelStorage.saved = []
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(60, 3)
+        self.y = (self.x[:, 0] > 0.5).astype(int)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def experiments(self, n=2):
+        return [Experiment(model_timestamp="2017-03-01T00:00:0{}".format(i),
+                           world={"type": "closed", "observed_fraction": 1},
+                           model_type="LogisticRegression",
+                           hyperparameters={"C_reg": 10 ** i, "penalty": "l2"},
+                           n_cores=1, k=3) for i in range(n)]
+
+    def saved(self, name):
+        return [args for saved_name, args in FakeModelStorage.saved
+                if saved_name == name]
+
+    def pool(self):
+        return ExperimentPool(self.x, self.y, n_workers=1,
+                              work_dir=self.work_dir,
+                              fold_cache_dir=self.work_dir,
+                              predictions_dir=self.work_dir)
+
+    def test_save_results(self):
+        experiment = self.experiments(1)[0]
+        experiment.save_results(experiment.evaluate_all_folds(self.x, self.y))
+        self.assertEqual(len(self.saved('save_fold_of_model')), 3)
+        (avg_metrics, model_timestamp, options), = self.saved(
+            'save_full_model')
+        self.assertEqual(model_timestamp, experiment.model_timestamp)
+        self.assertGreater(avg_metrics['auc'], 0.9)
+        self.assertTrue(os.path.exists('{}_roc.png'.format(model_timestamp)))
+
+    def test_pool_run(self):
+        self.assertEqual(self.pool().run(self.experiments()), [])
+        self.assertEqual(len(self.saved('save_full_model')), 2)
+
+    def test_run_queue(self):
+        experiment_queue = FakeExperimentQueue(self.experiments())
+        self.assertEqual(self.pool().run_queue(experiment_queue, "sweep",
+                                               "worker"), 2)
+        self.assertEqual(experiment_queue.count_unfinished("sweep"), 0)
+        self.assertEqual(len(self.saved('save_full_model')), 2)
+
+    def test_successive_halving(self):
+        finalists = self.pool().successive_halving(self.experiments(3))
+        self.assertEqual(len(finalists), 1)
+        self.assertEqual(len(self.saved('save_full_model')), 1)
+        self.assertEqual(len(self.saved('save_search_rung')), 3)
+
+if __name__ == "__main__":
+    unittest.main()
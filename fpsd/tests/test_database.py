@@ -8,7 +8,8 @@ from time import sleep
 import unittest
 
 from crawler import Crawler
-from database import RawStorage
+from database import ExperimentQueue, RawStorage, _fill_arrays
+import numpy as np
 from sorter import Sorter
 from . import common
 from utils import coalesce_ordered_dict, get_config, get_lookback
@@ -82,5 +83,107 @@ class TestDatabaseMethods(unittest.TestCase):
         # tests will be added here to verify Crawler-related data is being
         # read/written to the database in the expected manner.
 
+
+    def test_add_onions_currency(self):
+        url_a = "http://aaaaaaaaaaaaaaaa.onion"
+        url_b = "http://bbbbbbbbbbbbbbbb.onion"
+        self.db_handler.add_onions(OrderedDict([("nonmonitored", {url_a}),
+                                                ("sd_0310", {url_b})]))
+        # b's class is unchanged, so it is seen but not inserted again, and a
+        # is not seen at all
+        self.db_handler.add_onions(OrderedDict([("nonmonitored", set()),
+                                                ("sd_0310", set())]),
+                                   seen_urls={url_b})
+
+        with self.db_handler.safe_session() as session:
+            history = {row.hs_url: row.is_current for row in
+                       session.query(self.db_handler.Onion)}
+        self.assertEqual(history, {url_a: False, url_b: True})
+
+        monitored_class, monitored_name = \
+                self.db_handler.get_onion_class(self.get_cur_runtime(), True)
+        self.assertEqual(list(monitored_class), [url_b])
+        self.assertEqual(monitored_name, "sd_0310")
+
+
+class TestExperimentQueue(unittest.TestCase):
+    sweep = "test-sweep"
+
+    def setUp(self):
+        class TestExperimentQueue(ExperimentQueue, common.TestDatabase):
+            pass
+
+        self.queue = TestExperimentQueue(max_attempts=2)
+        jobs = [{'model_timestamp': datetime.now().isoformat(),
+                 'model_type': 'RandomForest',
+                 'hyperparameters': {'n_estimators': n},
+                 'options': {'k': 10}} for n in (10, 100)]
+        self.assertEqual(self.queue.enqueue(self.sweep, jobs), 2)
+        # Enqueuing the same sweep again adds nothing
+        self.assertEqual(self.queue.enqueue(self.sweep, jobs), 0)
+
+    def tearDown(self):
+        with self.queue.safe_session() as session:
+            session.execute("DELETE FROM models.experiment_queue "
+                            "WHERE sweep = '{}'".format(self.sweep))
+
+    def test_claim_until_drained(self):
+        first = self.queue.claim(self.sweep, "worker-1")
+        second = self.queue.claim(self.sweep, "worker-2")
+        self.assertNotEqual(first['jobid'], second['jobid'])
+        self.assertIsNone(self.queue.claim(self.sweep, "worker-3"))
+        self.assertEqual(self.queue.heartbeat([first['jobid']], "worker-1"),
+                         [first['jobid']])
+        self.assertEqual(self.queue.heartbeat([first['jobid']], "worker-2"),
+                         [])
+
+        self.assertTrue(self.queue.finish(first['jobid'], "worker-1"))
+        self.assertFalse(self.queue.finish(second['jobid'], "worker-1"))
+        self.queue.fail(second['jobid'], "worker-2", "Traceback ...")
+        self.assertEqual(self.queue.count_unfinished(self.sweep), 1)
+        retry = self.queue.claim(self.sweep, "worker-1")
+        self.assertEqual(retry['jobid'], second['jobid'])
+        # Out of attempts
+        self.queue.fail(retry['jobid'], "worker-1", "Traceback ...")
+        self.assertEqual(self.queue.count_unfinished(self.sweep), 0)
+        self.assertIsNone(self.queue.claim(self.sweep, "worker-1"))
+
+    def test_expired_last_attempt_fails(self):
+        self.queue.lease_timeout = 0
+        first = self.queue.claim(self.sweep, "worker-1")
+        # The lease expired, so the job is handed out again...
+        retry = self.queue.claim(self.sweep, "worker-2")
+        self.assertEqual(retry['jobid'], first['jobid'])
+        self.assertFalse(self.queue.finish(first['jobid'], "worker-1"))
+        # ...until it has used up its attempts. Abandon the other job twice
+        # too
+        self.assertNotEqual(self.queue.claim(self.sweep, "worker-2")['jobid'],
+                            first['jobid'])
+        self.queue.claim(self.sweep, "worker-2")
+        self.assertIsNone(self.queue.claim(self.sweep, "worker-3"))
+        self.assertEqual(self.queue.count_unfinished(self.sweep), 0)
+
+
+class TestFillArrays(unittest.TestCase):
+    def test_fill_arrays(self):
+        chunks = [[(1, True, 'a.onion', 0.5, None),
+                   (2, False, 'b.onion', 1, 2)],
+                  [(3, False, 'c.onion', 3, 4)]]
+        # Fewer rows than expected are trimmed off
+        x, y, exampleids, groups = _fill_arrays(iter(chunks), 4, 2,
+                                                with_groups=True)
+        self.assertEqual(x.dtype, np.float32)
+        np.testing.assert_array_equal(x, [[0.5, np.nan], [1, 2], [3, 4]])
+        np.testing.assert_array_equal(y, [1, 0, 0])
+        np.testing.assert_array_equal(exampleids, [1, 2, 3])
+        np.testing.assert_array_equal(groups, ['a.onion', 'b.onion', 'c.onion'])
+
+        closed = [[row[:2] + row[3:] for row in chunk] for chunk in chunks]
+        x, _, _, groups = _fill_arrays(iter(closed), 3, 2, dtype=np.float64)
+        self.assertEqual(x.dtype, np.float64)
+        self.assertIsNone(groups)
+        with self.assertRaises(ValueError):
+            _fill_arrays(iter(closed), 2, 2)
+
 if __name__ == "__main__":
     unittest.main()
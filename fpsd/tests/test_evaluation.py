@@ -1,6 +1,12 @@
 import unittest
 
-from evaluation import precision_recall_at_x_proportion
+import numpy as np
+from sklearn import metrics
+
+from evaluation import (get_base_rate_metrics,
+                        precision_recall_at_base_rates,
+                        precision_recall_at_x_proportion,
+                        precision_recall_at_x_proportions)
 
 
 class EvaluationTest(unittest.TestCase):
@@ -35,5 +41,72 @@ class EvaluationTest(unittest.TestCase):
         self.assertEqual(f1, 0.5)
 
 
+    def test_precision_recall_f1_vectorized(self):
+        rng = np.random.RandomState(0)
+        test_labels = rng.randint(2, size=500)
+        # Rounding makes for plenty of tied predictions
+        test_predictions = np.round(rng.rand(500) + 0.3 * test_labels, 1)
+        x_proportions = np.linspace(0, 1, 101)
+        precision, recall, f1, cutoff = precision_recall_at_x_proportions(
+            test_labels, test_predictions, x_proportions, return_cutoff=True)
+
+        sorted_predictions = np.sort(test_predictions)[::-1]
+        for i, x_proportion in enumerate(x_proportions):
+            cutoff_index = min(int(500 * x_proportion), 499)
+            self.assertEqual(cutoff[i], sorted_predictions[cutoff_index])
+            binary = (test_predictions > cutoff[i]).astype(int)
+            if not binary.any():
+                self.assertEqual((precision[i], recall[i], f1[i]), (0, 0, 0))
+                continue
+            expected = metrics.precision_recall_fscore_support(test_labels,
+                                                               binary)
+            self.assertAlmostEqual(precision[i], expected[0][1])
+            self.assertAlmostEqual(recall[i], expected[1][1])
+            self.assertAlmostEqual(f1[i], expected[2][1])
+
+    def test_base_rates(self):
+        rng = np.random.RandomState(0)
+        test_labels = rng.randint(2, size=500)
+        test_predictions = np.round(rng.rand(500) + 0.3 * test_labels, 1)
+        x_proportions = [0.01, 0.1, 0.25, 0.5]
+        base_rate = test_labels.mean()
+        precision, recall, f1 = precision_recall_at_base_rates(
+            test_labels, test_predictions, [base_rate, 0.001], x_proportions)
+        self.assertEqual(precision.shape, (2, 4))
+        # The test set's own base rate gives the unweighted metrics
+        expected = precision_recall_at_x_proportions(
+            test_labels, test_predictions, x_proportions)
+        for computed, unweighted in zip((precision, recall, f1), expected):
+            np.testing.assert_allclose(computed[0], unweighted)
+
+        # At another base rate, flag the most predictions above any cutoff
+        # whose weighted share of the population is within each proportion
+        positive, negative = test_labels == 1, test_labels == 0
+        for j, x_proportion in enumerate(x_proportions):
+            best = (-1, 0, 0)
+            for cutoff in np.unique(test_predictions):
+                flagged = test_predictions > cutoff
+                tpr = (flagged & positive).sum() / positive.sum()
+                fpr = (flagged & negative).sum() / negative.sum()
+                weighted = 0.001 * tpr + 0.999 * fpr
+                if best[0] < weighted <= x_proportion:
+                    best = (weighted, tpr,
+                            0.001 * tpr / weighted if weighted else 0)
+            self.assertAlmostEqual(recall[1, j], best[1])
+            self.assertAlmostEqual(precision[1, j], best[2])
+
+    def test_base_rates_weighting(self):
+        # One positive ranked above three negatives: at a base rate of 1/2,
+        # flagging half the population flags the positive and no negatives
+        test_labels = [1, 0, 0, 0]
+        test_predictions = [0.9, 0.8, 0.7, 0.6]
+        precision, recall, f1 = precision_recall_at_base_rates(
+            test_labels, test_predictions, [0.5], [0.5])
+        self.assertEqual((precision[0, 0], recall[0, 0]), (1, 1))
+        rows = get_base_rate_metrics(test_labels, test_predictions, [0.5])
+        self.assertEqual([row['base_rate'] for row in rows],
+                         [0.5] * len(rows))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+
+from knn import WeightedKNN, weighted_l1_distances
+
+
+class WeightedL1DistancesTest(unittest.TestCase):
+    def test_matches_direct_computation(self):
+        rng = np.random.RandomState(0)
+        a, b = rng.rand(7, 5), rng.rand(11, 5)
+        weights = rng.rand(5)
+        expected = np.array([[np.sum(weights * np.abs(row_a - row_b))
+                              for row_b in b] for row_a in a])
+        # Small blocks and several threads, so the tiles don't divide evenly
+        distances = weighted_l1_distances(a, b, weights, n_jobs=3,
+                                          block_elements=17)
+        np.testing.assert_allclose(distances, expected)
+        np.testing.assert_allclose(weighted_l1_distances(a, b, weights),
+                                   expected)
+
+
+class WeightedKNNTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Only the first feature separates the classes; the rest is noise
+        self.y = np.array([0, 1] * 40)
+        self.x = np.column_stack((self.y + rng.normal(0, 0.1, 80),
+                                  rng.normal(0, 3, (80, 4))))
+
+    def test_learns_informative_weights(self):
+        model = WeightedKNN(n_neighbors=2, rounds=2, random_state=0)
+        model.fit(self.x, self.y)
+        self.assertEqual(model.weights_.argmax(), 0)
+
+    def test_predict(self):
+        model = WeightedKNN(n_neighbors=3, rounds=2, n_weight_points=20,
+                            n_jobs=2).fit(self.x[:60], self.y[:60])
+        scores = model.predict_proba(self.x[60:])
+        self.assertEqual(scores.shape, (20, 2))
+        np.testing.assert_allclose(scores.sum(axis=1), 1)
+        self.assertGreater(np.mean(model.predict(self.x[60:]) == self.y[60:]),
+                           0.9)
+
+    def test_predict_in_blocks(self):
+        model = WeightedKNN(n_neighbors=3, rounds=2).fit(self.x[:60],
+                                                         self.y[:60])
+        scores = model.predict_proba(self.x[60:])
+        # Two test points per block
+        model.block_elements = 120
+        np.testing.assert_array_equal(model.predict_proba(self.x[60:]), scores)
+
+    def test_keeps_float32(self):
+        x = self.x.astype(np.float32)
+        model = WeightedKNN(rounds=2).fit(x, self.y)
+        self.assertEqual(model._fit_X.dtype, np.float32)
+        self.assertEqual(weighted_l1_distances(x, x, model.weights_).dtype,
+                         np.float32)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from knn_go import (_knn_go, export_batch, format_features, select_instances,
+                    set_constants)
+
+
+class KnnGoTest(unittest.TestCase):
+    def setUp(self):
+        self.batch_dir = tempfile.mkdtemp()
+        rows = []
+        for site, n_instances in (('sd1', 5), ('sd2', 3), ('sd3', 6)):
+            rows.extend({'hs_url': site, 'is_sd': True}
+                        for _ in range(n_instances))
+        rows.extend({'hs_url': 'site{}'.format(i), 'is_sd': False}
+                    for i in range(10))
+        self.df = pd.DataFrame(rows)
+        self.df['exampleid'] = np.arange(len(self.df))
+        self.df['f1'] = np.arange(len(self.df), dtype=float)
+        self.df['f2'] = np.nan
+
+    def tearDown(self):
+        shutil.rmtree(self.batch_dir)
+
+    def test_select_instances(self):
+        monitored, open_world = select_instances(self.df, 100, 3, 2, 4)
+        # sd2 has too few instances
+        self.assertEqual([list(site['hs_url'].unique()) for site in monitored],
+                         [['sd1'], ['sd3']])
+        self.assertEqual([len(site) for site in monitored], [5, 5])
+        self.assertEqual(len(open_world), 4)
+        self.assertFalse(open_world['is_sd'].any())
+
+    def test_export_batch(self):
+        monitored, open_world = select_instances(self.df, 1, 3, 2, 2)
+        export_batch(self.batch_dir, monitored, open_world, ['f1', 'f2'],
+                     n_workers=2, chunk_size=3)
+        self.assertEqual(sorted(os.listdir(self.batch_dir)),
+                         ['0-0s', '0-1s', '0-2s', '0-3s', '0-4s', '0s', '1s'])
+        with open(os.path.join(self.batch_dir, '0-1s')) as f:
+            self.assertEqual(f.read(), "1.0 'X'")
+
+    def test_format_features(self):
+        self.assertEqual(format_features([0.5, np.nan, 2]), "0.5 'X' 2.0")
+
+    def test_set_constants(self):
+        with open(_knn_go) as f:
+            source = set_constants(f.read(), {'SiteNum': 7, 'FeatNum': 42})
+        self.assertIn('SiteNum int = 7', source)
+        self.assertIn('FeatNum int = 42', source)
+        with self.assertRaises(ValueError):
+            set_constants(source, {'NoSuchConstant': 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
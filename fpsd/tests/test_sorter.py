@@ -0,0 +1,382 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pickle
+import shutil
+import stat
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+from sorter import (ClassTests, ConcurrencyController, OnionSet,
+                    ResponseScanner, SortCache, Sorter, TorInstance, TorPool,
+                    _classify)
+
+
+class ClassTestsTest(unittest.TestCase):
+    """Tests that compiled class tests sort pages like evaluating the class
+    test expressions directly would."""
+    class_tests = {"sd_0310": "'Powered by SecureDrop 0.3.10.' in text",
+                   "sd_other": "'SecureDrop' in text and 'Secure' in text",
+                   "nonmonitored": "'SecureDrop' not in text"}
+
+    def setUp(self):
+        self.class_tests = ClassTests(self.class_tests)
+
+    def test_substrings_scanned_once(self):
+        self.assertEqual(sorted(self.class_tests.substrings),
+                         ['Powered by SecureDrop 0.3.10.', 'Secure',
+                          'SecureDrop'])
+
+    def test_overlapping_substrings(self):
+        text = "<p>Powered by SecureDrop 0.3.10.</p>"
+        self.assertEqual(len(self.class_tests.find_substrings(text)), 3)
+        self.assertEqual(self.class_tests.classify(text), "sd_0310")
+
+    def test_first_matching_class_wins(self):
+        self.assertEqual(self.class_tests.classify("SecureDrop 0.3.9"),
+                         "sd_other")
+        self.assertEqual(self.class_tests.classify("nothing to see"),
+                         "nonmonitored")
+
+    def test_no_matching_class(self):
+        class_tests = ClassTests({"sd": "'SecureDrop' in text"})
+        self.assertIsNone(class_tests.classify("nothing to see"))
+
+    def test_arbitrary_expressions(self):
+        class_tests = ClassTests({"long": "len(text) > 5 and 'a' in text",
+                                  "short": "True"})
+        self.assertEqual(class_tests.classify("aaaaaa"), "long")
+        self.assertEqual(class_tests.classify("aaa"), "short")
+
+    def test_pickling(self):
+        class_tests = pickle.loads(pickle.dumps(self.class_tests))
+        self.assertEqual(class_tests.classify("SecureDrop"), "sd_other")
+
+
+class ResponseScannerTest(unittest.TestCase):
+    """Tests that scanning a page in chunks gives the same results as
+    scanning it all at once."""
+    class_tests = ClassTests({"sd_0310": "'SecureDrop 0.3.10' in text",
+                              "nonmonitored": "'SecureDrop' not in text"})
+
+    def feed_all(self, scanner, chunks):
+        for i, chunk in enumerate(chunks):
+            if scanner.feed(chunk):
+                break
+        scanner.close()
+        return i
+
+    def test_match_across_chunk_boundary(self):
+        scanner = ResponseScanner(class_tests=self.class_tests)
+        self.feed_all(scanner, [b"Powered by Secu", b"reDrop 0.3.", b"10"])
+        self.assertEqual(scanner.class_name, "sd_0310")
+
+    def test_stops_once_class_is_certain(self):
+        scanner = ResponseScanner(class_tests=self.class_tests)
+        chunks_read = self.feed_all(scanner, [b"SecureDrop 0.3.10", b"more"])
+        self.assertEqual(chunks_read, 0)
+        self.assertEqual(scanner.class_name, "sd_0310")
+
+    def test_negative_test_needs_whole_page(self):
+        scanner = ResponseScanner(class_tests=self.class_tests)
+        chunks_read = self.feed_all(scanner, [b"nothing", b" to see"])
+        self.assertEqual(chunks_read, 1)
+        self.assertEqual(scanner.class_name, "nonmonitored")
+
+    def test_unsorted_page(self):
+        scanner = ResponseScanner(class_tests=self.class_tests)
+        self.feed_all(scanner, [b"SecureDrop 0.3.9"])
+        self.assertIsNone(scanner.class_name)
+
+    def test_arbitrary_expressions_see_whole_page(self):
+        class_tests = ClassTests({"long": "len(text) > 8"})
+        scanner = ResponseScanner(class_tests=class_tests)
+        self.feed_all(scanner, [b"abcde", b"fghij"])
+        self.assertEqual(scanner.class_name, "long")
+
+    def test_onions_across_chunk_boundary(self):
+        scanner = ResponseScanner(find_onions=True)
+        self.feed_all(scanner, [b"<a href='http://secrdrop5wyp",
+                                b"hb5x.onion'>", b"expyuzz4wqqyqhjn.onion"])
+        self.assertEqual(scanner.onions, {"secrdrop5wyphb5x.onion",
+                                          "expyuzz4wqqyqhjn.onion"})
+
+    def test_max_size(self):
+        scanner = ResponseScanner(find_onions=True, max_size=8)
+        chunks_read = self.feed_all(scanner, [b"0123", b"4567", b"89"])
+        self.assertEqual(chunks_read, 1)
+        self.assertTrue(scanner.truncated)
+        scanner = ResponseScanner(find_onions=True)
+        self.feed_all(scanner, [b"0123", b"4567", b"89"])
+        self.assertFalse(scanner.truncated)
+
+    def test_multibyte_characters_across_chunk_boundary(self):
+        scanner = ResponseScanner(
+            class_tests=ClassTests({"sd": "'Sécurité' in text"}))
+        encoded = "Sécurité".encode()
+        self.feed_all(scanner, [encoded[:2], encoded[2:]])
+        self.assertEqual(scanner.class_name, "sd")
+
+
+class OnionSetTest(unittest.TestCase):
+    def test_add_and_contains(self):
+        onions = OnionSet()
+        self.assertTrue(onions.add("http://secrdrop5wyphb5x.onion"))
+        self.assertFalse(onions.add("http://secrdrop5wyphb5x.onion"))
+        self.assertIn("http://secrdrop5wyphb5x.onion", onions)
+        self.assertNotIn("http://expyuzz4wqqyqhjn.onion", onions)
+        self.assertEqual(len(onions), 1)
+
+    def test_iteration_round_trips(self):
+        urls = {"http://secrdrop5wyphb5x.onion",
+                "http://expyuzz4wqqyqhjn.onion",
+                # Same bucket as the above
+                "http://expyuzz4wqqyqhjm.onion",
+                # Kept as is
+                "http://secrdrop5wyphb5x.onion/securedrop_list.txt",
+                "http://0000000000000000.onion"}
+        onions = OnionSet(urls)
+        self.assertEqual(len(onions), len(urls))
+        self.assertEqual(set(onions), urls)
+
+    def test_only_aligned_suffixes_match(self):
+        onions = OnionSet(["http://aaaaaaaaaaaaaaaa.onion",
+                           "http://aaaaaaaaaaaaaaab.onion"])
+        self.assertNotIn("http://aaaaaaaaaaaaaaac.onion", onions)
+        self.assertEqual(len(onions), 2)
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+    def record_window(self, controller, latency, error):
+        for _ in range(controller.window_size):
+            controller.record(latency, error)
+
+    def test_additive_increase(self):
+        controller = ConcurrencyController(10, min_tasks=2, window_size=5)
+        self.record_window(controller, 1.0, False)
+        self.record_window(controller, 1.0, False)
+        self.assertEqual(controller.limit, 4)
+
+    def test_multiplicative_decrease_on_errors(self):
+        controller = ConcurrencyController(10, initial_tasks=8,
+                                           window_size=5)
+        self.record_window(controller, 1.0, True)
+        self.assertEqual(controller.limit, 4)
+        self.record_window(controller, 1.0, True)
+        self.record_window(controller, 1.0, True)
+        self.record_window(controller, 1.0, True)
+        self.assertEqual(controller.limit, 1)
+
+    def test_decrease_on_latency_inflation(self):
+        controller = ConcurrencyController(10, initial_tasks=8,
+                                           window_size=5)
+        self.record_window(controller, 1.0, False)
+        self.assertEqual(controller.limit, 9)
+        self.record_window(controller, 3.0, False)
+        self.assertEqual(controller.limit, 4.5)
+
+    def test_bounded_by_max_tasks(self):
+        controller = ConcurrencyController(3, window_size=1)
+        for _ in range(10):
+            controller.record(1.0, False)
+        self.assertEqual(controller.limit, 3)
+
+    def test_fixed_limit(self):
+        controller = ConcurrencyController(10, adaptive=False, window_size=1)
+        controller.record(1.0, True)
+        self.assertEqual(controller.limit, 10)
+
+    def test_limits_active_fetches(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.max_active = 0
+
+        async def fetch(controller):
+            async with controller:
+                self.max_active = max(self.max_active, controller.active)
+                await asyncio.sleep(0.01)
+
+        async def fetch_all():
+            controller = ConcurrencyController(10, initial_tasks=3,
+                                               adaptive=True)
+            await asyncio.gather(*[fetch(controller) for _ in range(10)])
+
+        loop.run_until_complete(fetch_all())
+        loop.close()
+        self.assertEqual(self.max_active, 3)
+
+
+class SortCacheTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.class_tests = ClassTests({"sd": "'SecureDrop' in text"})
+        self.url = "http://aaaaaaaaaaaaaaaa.onion"
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_unchanged_class_saved_once(self):
+        cache = SortCache(self.path, self.class_tests)
+        cache.update(self.url, "sd", "hash", etag='"1"')
+        self.assertTrue(cache.needs_saving(self.url, 0, 100))
+        cache.mark_saved([self.url], 0)
+        cache.update(self.url, "sd", "hash2", etag='"2"')
+        self.assertFalse(cache.needs_saving(self.url, 50, 100))
+        self.assertTrue(cache.needs_saving(self.url, 100, 100))
+        cache.update(self.url, None, "hash3")
+        self.assertTrue(cache.needs_saving(self.url, 50, 100))
+
+    def test_persistence(self):
+        cache = SortCache(self.path, self.class_tests)
+        cache.update(self.url, "sd", "hash", etag='"1"',
+                     last_modified="Mon, 06 Mar 2017 00:00:00 GMT")
+        cache.save()
+        entry = SortCache(self.path, self.class_tests).get(self.url)
+        self.assertEqual(SortCache.conditional_headers(entry),
+                         {"If-None-Match": '"1"',
+                          "If-Modified-Since":
+                          "Mon, 06 Mar 2017 00:00:00 GMT"})
+        other_tests = ClassTests({"sd": "'SecureDrop 0.4' in text"})
+        self.assertIsNone(SortCache(self.path, other_tests).get(self.url))
+
+    def test_subset(self):
+        cache = SortCache(self.path, self.class_tests)
+        other_url = "http://bbbbbbbbbbbbbbbb.onion"
+        cache.update(self.url, "sd", "hash")
+        cache.update(other_url, None, "hash")
+        shard_cache = pickle.loads(pickle.dumps(cache.subset([self.url])))
+        self.assertEqual(list(shard_cache.entries), [self.url])
+        shard_cache.update(self.url, None, "hash2")
+        cache.entries.update(shard_cache.entries)
+        self.assertIsNone(cache.get(self.url)["class_name"])
+        self.assertIsNotNone(cache.get(other_url))
+
+
+class ClassifyInWorkerTest(unittest.TestCase):
+    def test_classify(self):
+        class_tests = (("sd", "'SecureDrop' in text"),
+                       ("other", "True"))
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(
+                _classify, class_tests, "SecureDrop").result(), "sd")
+            self.assertEqual(executor.submit(
+                _classify, class_tests, "").result(), "other")
+
+
+class DiscoverOnionsTest(unittest.TestCase):
+    """Discovers onions on a made-up tree of pages, each linking to 5 new
+    onion services, without fetching anything."""
+    def setUp(self):
+        async def scrape_onion_links(sorter, url):
+            await asyncio.sleep(0)
+            return {"{}{}".format(url, i) for i in range(5)}
+
+        patcher = mock.patch.object(Sorter, "scrape_onion_links",
+                                    scrape_onion_links)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Skip __init__, which launches tor
+        self.sorter = Sorter.__new__(Sorter)
+        self.sorter.logger = logging.getLogger("test_sorter")
+        self.sorter.max_tasks = 3
+        # The frontier is created on the current event loop
+        self.sorter.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.sorter.loop)
+        self.addCleanup(self.sorter.loop.close)
+
+    def discover(self, max_pages):
+        self.sorter.loop.run_until_complete(self.sorter._discover_onions(
+            ["d"], max_depth=4, max_pages=max_pages, frontier_size=2))
+
+    def test_full_frontier_loses_no_pages(self):
+        self.discover(max_pages=10000)
+        self.assertEqual(len(self.sorter.onions), 1 + 5 + 25 + 125 + 625)
+        self.assertEqual(self.sorter.pages_queued, 1 + 5 + 25 + 125)
+        self.assertEqual(self.sorter.pages_dropped, 0)
+
+    def test_page_budget(self):
+        self.discover(max_pages=10)
+        self.assertEqual(self.sorter.pages_queued, 10)
+        self.assertEqual(self.sorter.pages_dropped, 41)
+
+
+class TorPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = TorPool([TorInstance({"SocksPort": str(port)})
+                             for port in (9050, 9052, 9054)],
+                            max_consecutive_failures=2, cooldown=60)
+
+    def test_spreads_fetches(self):
+        instances = [self.pool.acquire(0) for _ in range(6)]
+        self.assertEqual([x.active for x in self.pool.instances], [2, 2, 2])
+        for instance in instances:
+            self.pool.release(instance, False, 1)
+        self.assertEqual([x.successes for x in self.pool.instances],
+                         [2, 2, 2])
+
+    def test_cools_down_failing_instance(self):
+        bad = self.pool.instances[0]
+        for _ in range(2):
+            bad.active += 1
+            self.pool.release(bad, True, 10)
+        self.assertFalse(bad.is_healthy(69))
+        self.assertTrue(all(self.pool.acquire(20) is not bad
+                            for _ in range(10)))
+        self.assertTrue(bad.is_healthy(70))
+
+    def test_all_cooling_down(self):
+        for i, instance in enumerate(self.pool.instances):
+            instance.disabled_until = 100 - i
+        self.assertIs(self.pool.acquire(0), self.pool.instances[2])
+
+
+class TorPoolLaunchTest(unittest.TestCase):
+    """Launches pools through stem's real launch code, with a stand-in for
+    the tor binary."""
+    fake_tor = ('#!/bin/sh\n'
+                'if [ "$1" = "--version" ]; then\n'
+                '  echo "Tor version 0.2.9.10."; exit 0\n'
+                'fi\n'
+                '{}\n')
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_tor(self, name, body):
+        tor_cmd = os.path.join(self.tmp_dir, name)
+        with open(tor_cmd, 'w') as f:
+            f.write(self.fake_tor.format(body))
+        os.chmod(tor_cmd, stat.S_IRWXU)
+        return tor_cmd
+
+    def test_launch(self):
+        tor_cmd = self.write_tor("tor", 'echo "[notice] Bootstrapped 100%: '
+                                 'Done"; exec sleep 60')
+        pool = TorPool.launch(2, {}, 19050, take_ownership=False,
+                              data_dir_prefix=os.path.join(self.tmp_dir,
+                                                           "tor"),
+                              tor_cmd=tor_cmd)
+        try:
+            self.assertEqual(len(pool.instances), 2)
+            self.assertEqual(len({x.socks_port for x in pool.instances}), 2)
+            self.assertTrue(all(x.process.poll() is None
+                                for x in pool.instances))
+        finally:
+            pool.close()
+
+    def test_launch_failure(self):
+        tor_cmd = self.write_tor("tor", 'echo "[err] No way"; exit 1')
+        with self.assertRaises(OSError):
+            TorPool.launch(2, {}, 19050, take_ownership=False,
+                           data_dir_prefix=os.path.join(self.tmp_dir, "tor"),
+                           tor_cmd=tor_cmd)
+
+
+if __name__ == "__main__":
+    unittest.main()
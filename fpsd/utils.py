@@ -51,17 +51,20 @@ def find_free_port(desired_port, *additional_conflicts):
     Returns:
         port: int of port determined unused and conflict-free.
     """
+    port = desired_port
+    while port in additional_conflicts or _port_in_use(port):
+        # The range 49152–65535 contains dynamic or private ports that
+        # cannot be registered with IANA.
+        port = random.randint(49152, 65535)
+    return port
+
+
+def _port_in_use(port):
+    sock = socket.socket()
     try:
-        sock = socket.socket()
-        port = desired_port
-        while not sock.connect_ex(('127.0.0.1', port)) and \
-              port not in additional_conflicts:
-            # The range 49152–65535 contains dynamic or private ports that
-            # cannot be registered with IANA.
-            port = random.randint(49152, 65536)
+        return not sock.connect_ex(('127.0.0.1', port))
     finally:
         sock.close()
-    return port
 
 
 def get_lookback(lookback_length):
@@ -0,0 +1,18 @@
+CREATE TABLE models.experiment_queue (
+    jobid SERIAL PRIMARY KEY,
+    sweep VARCHAR(64) NOT NULL,
+    model_timestamp TIMESTAMP NOT NULL,
+    model_type VARCHAR(100) NOT NULL,
+    hyperparameters JSONB NOT NULL,
+    options JSONB NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    worker VARCHAR(255),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    t_enqueued TIMESTAMP NOT NULL DEFAULT now(),
+    t_claimed TIMESTAMP,
+    t_heartbeat TIMESTAMP,
+    t_finished TIMESTAMP,
+    error TEXT,
+    UNIQUE (sweep, model_type, hyperparameters)
+);
+CREATE INDEX experiment_queue_sweep_status_idx ON models.experiment_queue (sweep, status);
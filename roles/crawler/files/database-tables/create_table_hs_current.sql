@@ -0,0 +1,16 @@
+CREATE TABLE raw.hs_current (
+    hs_url VARCHAR(40) PRIMARY KEY,
+    hsid INTEGER NOT NULL REFERENCES raw.hs_history (hsid),
+    is_sd BOOLEAN NOT NULL,
+    sd_version VARCHAR(10) NOT NULL,
+    sorted_class VARCHAR(40) NOT NULL,
+    t_sort TIMESTAMP NOT NULL,
+    t_seen TIMESTAMP NOT NULL
+);
+CREATE INDEX hs_current_is_sd_t_seen_idx ON raw.hs_current (is_sd, t_seen);
+CREATE INDEX hs_history_hs_url_idx ON raw.hs_history (hs_url);
+INSERT INTO raw.hs_current
+    SELECT DISTINCT ON (hs_url) hs_url, hsid, is_sd, sd_version, sorted_class,
+        t_sort, t_sort
+    FROM raw.hs_history
+    ORDER BY hs_url, t_sort DESC, hsid DESC;
@@ -0,0 +1,10 @@
+CREATE TABLE models.search_rungs (
+    rungid SERIAL PRIMARY KEY,
+    model_timestamp TIMESTAMP NOT NULL,
+    model_type VARCHAR(100),
+    hyperparameters JSON NOT NULL,
+    rung INTEGER NOT NULL,
+    numfolds INTEGER NOT NULL,
+    auc NUMERIC NOT NULL,
+    promoted BOOLEAN NOT NULL
+);
@@ -0,0 +1,10 @@
+CREATE TABLE models.undefended_frontpage_base_rates (
+    base_rate_metricid SERIAL PRIMARY KEY,
+    model_timestamp TIMESTAMP NOT NULL,
+    fold_timestamp TIMESTAMP NOT NULL,
+    base_rate NUMERIC NOT NULL,
+    x_proportion NUMERIC NOT NULL,
+    precision NUMERIC,
+    recall NUMERIC,
+    f1 NUMERIC
+);
@@ -0,0 +1,10 @@
+CREATE TABLE models.undefended_frontpage_predictions (
+    predictionid SERIAL PRIMARY KEY,
+    model_timestamp TIMESTAMP NOT NULL,
+    fold_timestamp TIMESTAMP NOT NULL,
+    fold INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    n_examples INTEGER NOT NULL,
+    calibrated_scores BOOLEAN NOT NULL,
+    UNIQUE (model_timestamp, fold)
+);